@@ -0,0 +1,594 @@
+#!/usr/bin/env python3
+"""Benchmark slidefactory on a synthetic course
+
+A course tree (about.yml with modules, decks, slides, images, and math)
+is generated in a temporary directory and converted with the `slides` and
+`pages` commands. With --fake-tools, pandoc, chromium, and ghostscript are
+replaced with minimal stand-ins so that only the overhead of slidefactory
+itself (orchestration, I/O, startup) is measured.
+
+The results are written as JSON; compare them between versions with
+--compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+
+BENCHMARK_ROOT = Path(__file__).parent.absolute()
+SLIDEFACTORY = BENCHMARK_ROOT.parent / 'slidefactory.py'
+
+SCENARIOS = ['slides-html', 'slides-pdf', 'pages', 'pages-cached',
+             'pages-devtools']
+
+
+# Stand-in for pandoc: understands slide headers, images, and math,
+# reads and writes the json AST (for filters), and writes html otherwise
+FAKE_PANDOC = r'''#!/usr/bin/env python3
+import html, json, os, re, subprocess, sys
+
+if sys.argv[1:] == ['--version']:
+    print('pandoc 3.1.3')
+    sys.exit(0)
+
+out = inp = None
+to = 'revealjs'
+frm = 'markdown'
+filters = []
+for arg in sys.argv[1:]:
+    if arg.startswith('--output='):
+        out = arg.split('=', 1)[1]
+    elif arg.startswith('--to='):
+        to = arg.split('=', 1)[1]
+    elif arg.startswith('--from='):
+        frm = arg.split('=', 1)[1]
+    elif arg.startswith('--filter='):
+        filters.append(arg.split('=', 1)[1])
+    elif not arg.startswith('-'):
+        inp = arg
+
+with open(inp) as f:
+    text = f.read()
+
+if frm == 'json':
+    doc = json.loads(text)
+else:
+    body = text.split('---', 2)[-1]
+    blocks = []
+    for line in body.splitlines():
+        if line.startswith('# '):
+            blocks.append({'t': 'Header',
+                           'c': [1, ['', [], []],
+                                 [{'t': 'Str', 'c': line[2:]}]]})
+            continue
+        inlines = []
+        for tok in re.findall(r'!\[[^\]]*\]\([^)\s]+\)(?:\{[^}]*\})?'
+                              r'|\$\$.*?\$\$|\S+', line):
+            m = re.match(r'!\[[^\]]*\]\(([^)\s]+)\)', tok)
+            if m:
+                inlines.append({'t': 'Image',
+                                'c': [['', [], []], [], [m.group(1), '']]})
+            elif tok.startswith('$$'):
+                inlines.append({'t': 'Math',
+                                'c': [{'t': 'DisplayMath'}, tok[2:-2]]})
+            else:
+                inlines.append({'t': 'Str', 'c': tok})
+        if inlines:
+            blocks.append({'t': 'Para', 'c': inlines})
+    doc = {'pandoc-api-version': [1, 23], 'meta': {}, 'blocks': blocks}
+
+env = dict(os.environ, PANDOC_VERSION='3.1.3',
+           PANDOC_READER_OPTIONS=json.dumps({'standalone': True}))
+for fpath in filters:
+    cmd = [sys.executable, fpath, to] if fpath.endswith('.py') \
+        else [fpath, to]
+    doc = json.loads(subprocess.run(cmd, input=json.dumps(doc).encode(),
+                                    capture_output=True, check=True,
+                                    env=env).stdout)
+
+if to == 'json':
+    result = json.dumps(doc)
+else:
+    parts = []
+    for block in doc['blocks']:
+        if block['t'] == 'Header':
+            if parts:
+                parts.append('</section>')
+            parts.append('<section><h1>'
+                         + html.escape(block['c'][2][0]['c']) + '</h1>')
+            continue
+        para = []
+        for inline in block['c']:
+            if inline['t'] == 'Image':
+                para.append(f'<img data-src="{inline["c"][2][0]}">')
+            elif inline['t'] == 'Math':
+                para.append('<span class="math display">\\['
+                            + html.escape(inline['c'][1]) + '\\]</span>')
+            elif inline['t'] == 'Str':
+                para.append(html.escape(inline['c']))
+        parts.append('<p>' + ' '.join(para) + '</p>')
+    if parts:
+        parts.append('</section>')
+    result = '<html><body>\n' + '\n'.join(parts) + '\n</body></html>\n'
+
+if out in (None, '-'):
+    sys.stdout.write(result)
+else:
+    with open(out, 'w') as f:
+        f.write(result)
+'''
+
+# Stand-in for chromium: prints a minimal pdf with a page per slide
+# with --print-to-pdf or over the DevTools protocol with
+# --remote-debugging-pipe, where it also typesets math as placeholder svgs
+FAKE_CHROMIUM = r'''#!/usr/bin/env python3
+import base64, html, json, os, re, sys
+from urllib.parse import unquote, urlparse
+
+
+def get_sections(url):
+    path = unquote(urlparse(url).path)
+    try:
+        with open(path) as f:
+            text = f.read()
+    except OSError:
+        return ['<section></section>']
+    return re.findall(r'<section.*?</section>', text, re.DOTALL) \
+        or ['<section></section>']
+
+
+def get_pages(page_ranges, npages):
+    pages = []
+    for item in filter(None, page_ranges.replace(' ', '').split(',')):
+        first, _, last = item.partition('-')
+        pages += range(int(first), int(last or first) + 1)
+    return [i for i in pages if 1 <= i <= npages] or range(1, npages + 1)
+
+
+def make_pdf(url, page_ranges=''):
+    """Return a pdf of the pages with a named destination on each page
+    and a link to the first page, as printed by chromium"""
+    pages = get_pages(page_ranges, len(get_sections(url)))
+    objs = ['<< /Type /Catalog /Pages 2 0 R /Dests 3 0 R >>',
+            f'<< /Type /Pages /Kids ['
+            f'{" ".join(f"{6 + 3 * j} 0 R" for j in range(len(pages)))}]'
+            f' /Count {len(pages)} >>',
+            '<< ' + ' '.join(f'/slide-{i} [{6 + 3 * j} 0 R /Fit]'
+                             for j, i in enumerate(pages)) + ' >>',
+            '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+            '<< /Producer (Skia/PDF) >>']
+    for j, i in enumerate(pages):
+        content = f'BT /F1 24 Tf 72 400 Td (Slide {i}) Tj ET'
+        objs += [f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 960 540]'
+                 f' /Resources << /Font << /F1 4 0 R >> >>'
+                 f' /Contents {7 + 3 * j} 0 R /Annots [{8 + 3 * j} 0 R] >>',
+                 f'<< /Length {len(content)} >>\nstream\n{content}\n'
+                 f'endstream',
+                 '<< /Type /Annot /Subtype /Link /Rect [0 0 100 20]'
+                 ' /Dest /slide-1 >>']
+    data = b'%PDF-1.4\n'
+    offsets = []
+    for num, obj in enumerate(objs, 1):
+        offsets.append(len(data))
+        data += f'{num} 0 obj\n{obj}\nendobj\n'.encode()
+    xref = len(data)
+    data += f'xref\n0 {len(objs) + 1}\n0000000000 65535 f \n'.encode()
+    data += ''.join(f'{o:010d} 00000 n \n' for o in offsets).encode()
+    data += (f'trailer\n<< /Size {len(objs) + 1} /Root 1 0 R /Info 5 0 R >>'
+             f'\nstartxref\n{xref}\n%%EOF\n').encode()
+    return data
+
+
+def evaluate(url, expression):
+    """Return the number of pages or their html as reveal.js does,
+    or math typeset as MathJax does"""
+    m = re.search(r'Promise\.all\((.*)\.map\(\(\[tex, display\]\)',
+                  expression, re.DOTALL)
+    if m:
+        return {'svgs': [f'<svg data-tex="{html.escape(tex)}" '
+                         f'data-display="{str(display).lower()}"></svg>'
+                         for tex, display in json.loads(m.group(1))],
+                'style': '<style id="MJX-SVG-styles"></style>'}
+    sections = get_sections(url)
+    if "'.pdf-page').length" in expression:
+        return len(sections)
+    if 'pages:' in expression:
+        return {'document': '<html><body><div class="slides"></div>'
+                            '</body></html>',
+                'pages': [f'<div class="pdf-page">{section}</div>'
+                          for section in sections]}
+    return {}
+
+
+args = sys.argv[1:]
+for arg in args:
+    if arg.startswith('--print-to-pdf='):
+        with open(arg.split('=', 1)[1], 'wb') as f:
+            f.write(make_pdf(args[-1]))
+if '--remote-debugging-pipe' not in args:
+    sys.exit(0)
+
+
+def send(msg):
+    data = json.dumps(msg).encode() + b'\0'
+    while data:
+        data = data[os.write(4, data):]
+
+
+urls = {}
+buf = b''
+n = 0
+while True:
+    chunk = os.read(3, 65536)
+    if not chunk:
+        break
+    buf += chunk
+    while b'\0' in buf:
+        raw, buf = buf.split(b'\0', 1)
+        msg = json.loads(raw)
+        method, session = msg['method'], msg.get('sessionId')
+        n += 1
+        result = {}
+        if method == 'Target.createBrowserContext':
+            result = {'browserContextId': f'c{n}'}
+        elif method == 'Target.createTarget':
+            result = {'targetId': f't{n}'}
+        elif method == 'Target.attachToTarget':
+            result = {'sessionId': f's{n}'}
+        elif method == 'Page.navigate':
+            urls[session] = msg['params']['url']
+            result = {'frameId': f'f{n}'}
+        elif method == 'Runtime.evaluate':
+            value = evaluate(urls.get(session, ''),
+                             msg['params']['expression'])
+            result = {'result': {'type': 'object', 'value': value}}
+        elif method == 'Page.printToPDF':
+            data = make_pdf(urls.get(session, ''),
+                            msg['params'].get('pageRanges', ''))
+            result = {'data': base64.b64encode(data).decode()}
+        reply = {'id': msg['id'], 'result': result}
+        if session:
+            reply['sessionId'] = session
+        send(reply)
+        if method == 'Page.navigate':
+            send({'method': 'Page.loadEventFired', 'params': {},
+                  'sessionId': session})
+        elif method == 'Browser.close':
+            sys.exit(0)
+'''
+
+# Stand-in for ghostscript: copies the input pdf to the output file
+FAKE_GS = r'''#!/usr/bin/env python3
+import shutil, sys
+
+out = [a for a in sys.argv if a.startswith('-sOutputFile=')][0]
+ins = [a for a in sys.argv[1:]
+       if not a.startswith('-') and a.endswith('.pdf')]
+shutil.copyfile(ins[0], out.split('=', 1)[1])
+'''
+
+
+def info(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def write_png(fpath, width, height, rng):
+    """Write an RGB png of noise (poorly compressible, like photos)"""
+    raw = b''.join(b'\0' + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data)))
+
+    with open(fpath, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB',
+                                           width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw)))
+        f.write(chunk(b'IEND', b''))
+
+
+def create_course(dpath, *, modules, decks, slides, images, math,
+                  image_size, seed=0):
+    """Create a course with about.yml files as expected by `pages`"""
+    rng = random.Random(seed)
+    words = ('parallel node core memory thread process rank buffer cache '
+             'vector kernel device queue stream').split()
+
+    module_names = [f'module-{m + 1:02d}' for m in range(modules)]
+    with open(dpath / 'about.yml', 'w') as f:
+        f.write('title: Benchmark course\n')
+        f.write('modules:\n')
+        for name in module_names:
+            f.write(f'  - {name}\n')
+
+    for m, name in enumerate(module_names):
+        slides_dpath = dpath / name / 'slides'
+        (slides_dpath / 'img').mkdir(parents=True)
+        with open(dpath / name / 'about.yml', 'w') as f:
+            f.write(f'title: Module {m + 1}\n')
+            f.write('slidesdir: slides\n')
+
+        for i in range(images):
+            write_png(slides_dpath / 'img' / f'image-{i + 1}.png',
+                      image_size, image_size, rng)
+
+        for d in range(decks):
+            with open(slides_dpath / f'{d + 1:02d}-deck.md', 'w') as f:
+                f.write('---\n'
+                        f'title: Deck {d + 1} of module {m + 1}\n'
+                        'event: Benchmark course\n'
+                        'lang: en\n'
+                        '---\n\n')
+                for s in range(slides):
+                    f.write(f'# Slide {s + 1}\n\n')
+                    f.write(' '.join(rng.choices(words, k=40)) + '\n\n')
+                    if images and s % 2 == 0:
+                        i = (d + s) % images + 1
+                        f.write(f'![](img/image-{i}.png){{width=60%}}\n\n')
+                    if math and s % 3 == 0:
+                        f.write(f'$$ \\int_0^1 x^{{{s}}}\\,dx '
+                                f'= \\frac{{1}}{{{s + 1}}} $$\n\n')
+
+
+def create_fake_tools(dpath):
+    dpath.mkdir()
+    for name, script in [('pandoc', FAKE_PANDOC),
+                         ('chromium', FAKE_CHROMIUM),
+                         ('gs', FAKE_GS)]:
+        fpath = dpath / name
+        fpath.write_text(script)
+        fpath.chmod(0o755)
+
+
+def supported_options(slidefactory, command):
+    """Return the options of the command (older versions have fewer)"""
+    p = subprocess.run([sys.executable, slidefactory, command, '-h'],
+                       capture_output=True, text=True)
+    return set(re.findall(r'--[a-z][a-z-]*', p.stdout))
+
+
+def read_profile(fpath):
+    """Sum the Chrome trace events written by --profile by stage
+
+    The cpu time and memory are None for stages that do not record them
+    (e.g., printing with the devtools backend).
+    """
+    with open(fpath) as f:
+        events = json.load(f)['traceEvents']
+    stages = {}
+    for event in events:
+        st = stages.setdefault(event['name'],
+                               dict(count=0, wall=0, cpu=None,
+                                    max_rss_mb=None))
+        st['count'] += 1
+        st['wall'] += event['dur'] / 1e6
+        cpu = event['args'].get('cpu_s')
+        if cpu is not None:
+            st['cpu'] = (st['cpu'] or 0) + cpu
+        max_rss_mb = event['args'].get('max_rss_mb')
+        if max_rss_mb is not None:
+            st['max_rss_mb'] = max(st['max_rss_mb'] or 0, max_rss_mb)
+    return stages
+
+
+def run_scenario(name, *, slidefactory, course_dpath, work_dpath, env,
+                 extra_args, jobs):
+    """Run one scenario once and return its measurements"""
+    command = 'slides' if name.startswith('slides') else 'pages'
+    options = supported_options(slidefactory, command)
+    out_dpath = Path(tempfile.mkdtemp(dir=work_dpath, prefix=f'{name}-'))
+    shutil.rmtree(out_dpath)
+    profile_fpath = out_dpath.with_suffix('.json')
+
+    run_args = [sys.executable, slidefactory, command, '--quiet']
+    if '--no-cache' in options:
+        if name == 'pages-cached':
+            run_args += ['--cache-dir', work_dpath / 'cache']
+        else:
+            run_args += ['--no-cache']
+    if '--jobs' in options and jobs is not None:
+        run_args += ['--jobs', jobs]
+    if '--profile' in options:
+        run_args += ['--profile', profile_fpath]
+    if name == 'pages-devtools':
+        run_args += ['--pdf-backend', 'devtools']
+    run_args += extra_args
+
+    if command == 'slides':
+        fmt = name.split('-')[1]
+        run_args += ['--format', fmt, '--output', out_dpath]
+        run_args += sorted(course_dpath.glob('*/slides/*.md'))
+    else:
+        run_args += ['--with-pdf', 'about.yml', out_dpath]
+    run_args = [str(a) for a in run_args]
+
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    p = subprocess.run(run_args, cwd=course_dpath, env=env,
+                       capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    if p.returncode != 0:
+        sys.exit(f'{name} failed with exit code {p.returncode}:\n'
+                 f'{p.stderr}')
+
+    result = dict(
+        wall=wall,
+        cpu=(after.ru_utime - before.ru_utime
+             + after.ru_stime - before.ru_stime),
+        max_rss_mb=after.ru_maxrss / 1024,
+        )
+    if profile_fpath.exists():
+        result['stages'] = read_profile(profile_fpath)
+    return result
+
+
+def summarize(runs):
+    walls = [r['wall'] for r in runs]
+    summary = dict(
+        wall_median=statistics.median(walls),
+        wall_min=min(walls),
+        wall_max=max(walls),
+        cpu_median=statistics.median(r['cpu'] for r in runs),
+        max_rss_mb=max(r['max_rss_mb'] for r in runs),
+        runs=runs,
+        )
+    # Stage times of the median run
+    median_run = sorted(runs, key=lambda r: r['wall'])[len(runs) // 2]
+    if 'stages' in median_run:
+        summary['stages'] = median_run['stages']
+    return summary
+
+
+def compare(results, baseline):
+    info(f'{"Scenario":16} {"Baseline (s)":>13} {"Current (s)":>12} '
+         f'{"Change":>8}')
+    for name, current in results['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None:
+            continue
+        old, new = base['wall_median'], current['wall_median']
+        info(f'{name:16} {old:13.2f} {new:12.2f} '
+             f'{(new - old) / old * 100:+7.1f}%')
+
+
+def get_version(slidefactory):
+    with open(slidefactory) as f:
+        m = re.search(r'^VERSION = "(.*?)"', f.read(), re.MULTILINE)
+    return m.group(1) if m else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[1],
+        )
+    parser.add_argument(
+        '--slidefactory', type=Path, default=SLIDEFACTORY,
+        help='slidefactory.py to benchmark (default: %(default)s)')
+    parser.add_argument(
+        '--modules', type=int, default=3,
+        help='number of modules (default: %(default)s)')
+    parser.add_argument(
+        '--decks', type=int, default=5,
+        help='number of decks per module (default: %(default)s)')
+    parser.add_argument(
+        '--slides', type=int, default=20,
+        help='number of slides per deck (default: %(default)s)')
+    parser.add_argument(
+        '--images', type=int, default=4,
+        help='number of images per module (default: %(default)s)')
+    parser.add_argument(
+        '--image-size', type=int, default=512, metavar='PIXELS',
+        help='width and height of the images (default: %(default)s)')
+    parser.add_argument(
+        '--no-math', dest='math', action='store_false',
+        help='do not include equations in the slides')
+    parser.add_argument(
+        '--fake-tools', action='store_true',
+        help='use stand-ins for pandoc, chromium, and ghostscript')
+    parser.add_argument(
+        '--scenarios', default=','.join(SCENARIOS),
+        help='comma-separated scenarios to run (default: %(default)s)')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='number of runs of each scenario (default: %(default)s)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='--jobs passed to slidefactory')
+    parser.add_argument(
+        '-o', '--output', type=Path, default=None,
+        help='write the results as JSON to this file (default: stdout)')
+    parser.add_argument(
+        '--compare', metavar='BASELINE', type=Path, default=None,
+        help='compare the results to earlier results in BASELINE')
+    parser.add_argument(
+        'extra_args', nargs=argparse.REMAINDER,
+        help='extra arguments passed to slidefactory after --')
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario: {name}')
+    extra_args = args.extra_args
+    if extra_args[:1] == ['--']:
+        extra_args = extra_args[1:]
+
+    results = dict(
+        slidefactory=dict(path=str(args.slidefactory),
+                          version=get_version(args.slidefactory)),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        config=dict(modules=args.modules, decks=args.decks,
+                    slides=args.slides, images=args.images,
+                    image_size=args.image_size, math=args.math,
+                    fake_tools=args.fake_tools, jobs=args.jobs,
+                    repeat=args.repeat, extra_args=extra_args),
+        scenarios={},
+        )
+
+    with tempfile.TemporaryDirectory(prefix='slidefactory-benchmark-') \
+         as tmp_dpath:
+        tmp_dpath = Path(tmp_dpath)
+        course_dpath = tmp_dpath / 'course'
+        course_dpath.mkdir()
+        work_dpath = tmp_dpath / 'work'
+        work_dpath.mkdir()
+        create_course(course_dpath, modules=args.modules, decks=args.decks,
+                      slides=args.slides, images=args.images,
+                      math=args.math, image_size=args.image_size)
+
+        env = dict(os.environ)
+        if args.fake_tools:
+            create_fake_tools(tmp_dpath / 'bin')
+            env['PATH'] = f'{tmp_dpath / "bin"}{os.pathsep}{env["PATH"]}'
+
+        for name in scenarios:
+            kwargs = dict(slidefactory=args.slidefactory.absolute(),
+                          course_dpath=course_dpath, work_dpath=work_dpath,
+                          env=env, extra_args=extra_args, jobs=args.jobs)
+            if name == 'pages-devtools' and '--pdf-backend' not in \
+               supported_options(kwargs['slidefactory'], 'pages'):
+                info(f'{name}: not supported by {args.slidefactory}')
+                continue
+            if name == 'pages-cached':
+                # Populate the cache
+                run_scenario(name, **kwargs)
+            runs = []
+            for i in range(args.repeat):
+                runs.append(run_scenario(name, **kwargs))
+                info(f'{name} run {i + 1}/{args.repeat}: '
+                     f'{runs[-1]["wall"]:.2f} s')
+            results['scenarios'][name] = summarize(runs)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        info(f'Wrote results to {args.output}')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,22 +6,49 @@
 # Help:  python slidefactory.py --help                                      #
 # ------------------------------------------------------------------------- #
 import argparse
+import ast
+import asyncio
+import base64
+import builtins
+import codecs
+import concurrent.futures
+import contextvars
 import copy
+import ctypes
+import ctypes.util
+import fcntl
 import functools
 import hashlib
+import html
 import html.parser
+import http.server
 import inspect
+import json
 import os
+import queue
 import re
+import resource
+import runpy
+import select
+import selectors
 import shlex
 import shutil
+import signal
+import socket
 import sys
 import subprocess
 import tempfile
+import threading
+import time
+import traceback
+import types
 import yaml
-from collections import namedtuple
+import zipfile
+import zlib
+from collections import deque, namedtuple
 from contextlib import contextmanager
 from urllib.parse import quote as urlquote, urlparse
+from urllib.parse import unquote as urlunquote
 from pathlib import Path
 
 
@@ -60,7 +87,22 @@ URL_KEYS = (
     'fonts_url',
     )
 
+# ioctl request for cloning a file (linux/fs.h)
+FICLONE = 0x40049409
+
+RASTER_SUFFIXES = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff',
+                   '.webp')
+
+# Formats that do not get smaller with zip compression
+COMPRESSED_SUFFIXES = ('.pdf', '.png', '.jpg', '.jpeg', '.gif', '.webp',
+                       '.zip', '.gz', '.woff', '.woff2')
+
 Theme = namedtuple('Theme', ['name', 'dpath', 'is_custom'])
+Conversion = namedtuple('Conversion', ['in_fpath', 'out_fpath', 'args'])
+
+
+class BuildError(RuntimeError):
+    """Error in converting a presentation"""
 
 
 def get_default_url(key: str, format: str, theme: Theme):
@@ -111,7 +153,38 @@ class HTMLParser(html.parser.HTMLParser):
                         self.sources.add(value)
 
 
-def run_template(run_args, *, dry_run):
+# Attributes that link files
+LINK_ATTRIBUTES = ('src', 'data-src', 'data-background',
+                   'data-background-image', 'data-background-video',
+                   'data-background-iframe')
+# Values of data-background that are colors rather than files
+BACKGROUND_COLOR_RE = re.compile(r'#|[a-z]+$|[a-z]+\(', re.I)
+
+
+class SourcesParser(html.parser.HTMLParser):
+    """Collect the values of the attributes that link files"""
+
+    def __init__(self):
+        super().__init__()
+        self.sources = set()
+
+    def handle_starttag(self, tag, attrs):
+        for key, value in attrs:
+            if not value or key not in LINK_ATTRIBUTES:
+                continue
+            if key == 'data-background' and BACKGROUND_COLOR_RE.match(value):
+                continue
+            self.sources.add(value)
+
+
+def get_html_sources(text):
+    parser = SourcesParser()
+    parser.feed(text)
+    parser.close()
+    return parser.sources
+
+
+def run_template(run_args, *, dry_run, timeout=None):
     run_args = [str(a) for a in run_args]
 
     if dry_run:
@@ -119,21 +192,505 @@ def run_template(run_args, *, dry_run):
         return
 
     verbose_info(shlex.join(run_args))
-    p = subprocess.run(run_args,
-                       check=False, shell=False,
-                       capture_output=True)
+    name = Path(run_args[0]).name
+    # The time includes waiting for a free slot of the stage and for memory
+    with stage(name) as record, stage_slot(name), admit(name) as usage:
+        oom_kills = get_oom_kills()
+        if pipeline is None:
+            returncode, stdout, stderr = \
+                run_process(run_args, timeout=timeout, record=record)
+        else:
+            returncode, stdout, stderr = \
+                pipeline.run(run_args, timeout=timeout, record=record)
+        if record['max_rss'] is not None:
+            usage['max_rss'] = record['max_rss']
+
+        if returncode == -signal.SIGKILL:
+            usage['killed'] = True
+            if (get_oom_kills() or 0) > (oom_kills or 0):
+                reason = 'by the out-of-memory killer'
+            else:
+                reason = 'with SIGKILL, most likely because the system ' \
+                         'ran out of memory'
+            peak = ''
+            if 'max_rss' in usage:
+                peak = f' (peak memory use {usage["max_rss"] / 1024**2:.0f} MB)'  # noqa: E501
+            raise BuildError(f'error: {repr(run_args[0])} was killed '
+                             f'{reason}{peak}; reduce --jobs or '
+                             f'--memory-budget')
+
+    verbose_info(stdout.decode())
+
+    if returncode != 0:
+        raise BuildError(f'error: {repr(run_args[0])} failed '
+                         f'with exit code {returncode}:\n'
+                         f'{stderr.decode()}')
+
+
+def run_process(run_args, *, timeout=None, record=None):
+    """Run a process and return its exit code and output
+
+    The resource usage of the process is stored in record.
+    """
+    if record is None:
+        record = {}
+    with tempfile.TemporaryFile() as stdout, \
+         tempfile.TemporaryFile() as stderr:
+        try:
+            p = subprocess.Popen(run_args, shell=False,
+                                 stdout=stdout, stderr=stderr)
+        except OSError as exc:
+            raise BuildError(f'error: {repr(run_args[0])} failed: {exc}')
+
+        timer = None
+        timed_out = threading.Event()
+        if timeout is not None:
+            def kill():
+                timed_out.set()
+                p.kill()
+
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+
+        # Wait with wait4 to get the resource usage of the process
+        _, status, rusage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        record.update(cpu=rusage.ru_utime + rusage.ru_stime,
+                      max_rss=rusage.ru_maxrss * 1024)
+
+        if timer is not None:
+            timer.cancel()
+            # Other kills (e.g., by the out-of-memory killer) are not timeouts
+            if timed_out.is_set():
+                raise BuildError(f'error: {repr(run_args[0])} timed out '
+                                 f'after {timeout} s')
+
+        stdout.seek(0)
+        stderr.seek(0)
+        return p.returncode, stdout.read(), stderr.read()
+
+
+def get_process_usage(pid):
+    """Return the cpu time and peak memory of a running process tree
+
+    The cpu time includes the descendants that have exited, and the peak
+    memory is the largest peak RSS of the running processes (as in the
+    resource usage of waited processes). Returns None if not available.
+    """
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    cpu = max_rss = 0
+    pids = [pid]
+    while pids:
+        child_pid = pids.pop()
+        try:
+            with open(f'/proc/{child_pid}/stat') as f:
+                # Fields after the command name, which may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+            # utime, stime, cutime, and cstime
+            cpu += sum(int(v) for v in fields[11:15]) / clock_ticks
+            with open(f'/proc/{child_pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        max_rss = max(max_rss, int(line.split()[1]) * 1024)
+            for tid in os.listdir(f'/proc/{child_pid}/task'):
+                with open(f'/proc/{child_pid}/task/{tid}/children') as f:
+                    pids += [int(v) for v in f.read().split()]
+        except (OSError, ValueError, IndexError):
+            if child_pid == pid:
+                return None
+            # The descendant has exited
+    return cpu, max_rss
+
+
+class Pipeline:
+    """Run external tools on an asyncio event loop with a limit per stage
+
+    Conversions still run in worker threads, as converting is sequential
+    code, but the tools they call run as asyncio subprocesses on a shared
+    event loop once there is a free slot of their stage (pandoc, chromium,
+    gs). With more presentations in flight than slots per stage, pandoc for
+    the next presentation and gs for the previous one run while chromium
+    prints the current one.
+
+    asyncio reaps the processes itself, so their resource usage is sampled
+    from /proc while they run.
+    """
+
+    STAGES = ('pandoc', 'chromium', 'gs')
+    SAMPLE_INTERVAL = 0.05
+
+    def __init__(self, jobs, limits=None):
+        self.jobs = jobs
+        self.limits = limits or {}
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def limit(self, name):
+        return self.limits.get(name, self.jobs)
+
+    @property
+    def decks_in_flight(self):
+        return sum(self.limit(name) for name in self.STAGES)
+
+    @contextmanager
+    def slot(self, name):
+        """Wait for a free slot of the stage of the given tool"""
+        with self.lock:
+            if name not in self.semaphores:
+                self.semaphores[name] = asyncio.Semaphore(self.limit(name))
+            semaphore = self.semaphores[name]
+        asyncio.run_coroutine_threadsafe(semaphore.acquire(),
+                                         self.loop).result()
+        try:
+            yield
+        finally:
+            self.loop.call_soon_threadsafe(semaphore.release)
+
+    async def _sample(self, pid, record):
+        while True:
+            usage = get_process_usage(pid)
+            if usage is not None:
+                cpu, max_rss = usage
+                record['cpu'] = max(record.get('cpu') or 0, cpu)
+                record['max_rss'] = max(record.get('max_rss') or 0, max_rss)
+            await asyncio.sleep(self.SAMPLE_INTERVAL)
+
+    async def _run(self, run_args, timeout, record):
+        try:
+            p = await asyncio.create_subprocess_exec(
+                *run_args, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+        except OSError as exc:
+            raise BuildError(f'error: {repr(run_args[0])} failed: {exc}')
+        sampler = asyncio.create_task(self._sample(p.pid, record))
+        try:
+            stdout, stderr = await asyncio.wait_for(p.communicate(), timeout)
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()
+            raise BuildError(f'error: {repr(run_args[0])} timed out '
+                             f'after {timeout} s')
+        finally:
+            sampler.cancel()
+        return p.returncode, stdout, stderr
+
+    def run(self, run_args, *, timeout=None, record=None):
+        """Run a process and return its exit code and output
+
+        The resource usage of the process is stored in record (None if
+        not available). Call this in a slot of the stage of the tool.
+        """
+        if record is None:
+            record = {}
+        record.update(cpu=None, max_rss=None)
+        return asyncio.run_coroutine_threadsafe(
+            self._run(run_args, timeout, record), self.loop).result()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+# Pipeline of the running conversions (see conversion_context)
+pipeline = None
+
+
+@contextmanager
+def stage_slot(name):
+    """Wait for a free slot of the stage of the given tool"""
+    if pipeline is None:
+        yield
+    else:
+        with pipeline.slot(name):
+            yield
+
+
+def get_cgroup_dpath():
+    """Return the cgroup v2 directory of this process, if any"""
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                if line.startswith('0::'):
+                    dpath = Path('/sys/fs/cgroup') / \
+                        line[3:].strip().lstrip('/')
+                    if dpath.is_dir():
+                        return dpath
+    except OSError:
+        pass
+    return None
+
+
+def get_available_memory():
+    """Return the available memory in bytes, or None if not known
+
+    Both the system memory and the memory limit of the cgroup
+    (e.g., of a container or a batch job) are taken into account.
+    """
+    available = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+
+    dpath = get_cgroup_dpath()
+    if dpath is not None:
+        try:
+            limit = (dpath / 'memory.max').read_text().strip()
+            current = int((dpath / 'memory.current').read_text())
+        except (OSError, ValueError):
+            limit = 'max'
+        if limit != 'max':
+            cgroup_available = max(0, int(limit) - current)
+            if available is None or cgroup_available < available:
+                available = cgroup_available
+    return available
 
-    verbose_info(p.stdout.decode())
 
-    if p.returncode != 0:
-        error(f'error: {repr(run_args[0])} failed '
-              f'with exit code {p.returncode}:\n'
-              f'{p.stderr.decode()}')
+def get_oom_kills():
+    """Return the number of processes killed by the OOM killer in the cgroup"""
+    dpath = get_cgroup_dpath()
+    if dpath is None:
+        return None
+    try:
+        with open(dpath / 'memory.events') as f:
+            for line in f:
+                key, value = line.split()
+                if key == 'oom_kill':
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class MemoryGovernor:
+    """Start memory-heavy processes only when there is memory for them
+
+    A process is started when the estimate of its peak memory use fits in
+    both the memory that is currently available and the budget that is not
+    reserved for the processes already running. The estimate is the largest
+    peak RSS of the tool in recent runs (stored in the cache directory).
+    When memory runs low, e.g. due to other builds on the same node,
+    fewer processes run at the same time. At least one process always runs.
+    """
+
+    STAGES = ('chromium', 'gs')
+    DEFAULT_ESTIMATES = {'chromium': 1024 * 1024**2, 'gs': 256 * 1024**2}
+    HISTORY = 20
+
+    def __init__(self, stats_fpath, *, budget=None):
+        self.stats_fpath = stats_fpath
+        self.cond = threading.Condition()
+        self.reserved = 0
+        self.running = 0
+        self.peaks = {}
+        self.new_peaks = {}
+        try:
+            with open(stats_fpath) as f:
+                self.peaks = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        if budget is None:
+            available = get_available_memory()
+            # Leave some room for everything else
+            budget = None if available is None else int(available * 0.9)
+        self.budget = budget
+
+    def estimate(self, name):
+        peaks = self.peaks.get(name, []) + self.new_peaks.get(name, [])
+        if peaks:
+            return max(peaks[-self.HISTORY:])
+        return self.DEFAULT_ESTIMATES[name]
+
+    def free(self):
+        free = self.budget - self.reserved
+        available = get_available_memory()
+        if available is not None:
+            free = min(free, available)
+        return free
+
+    @contextmanager
+    def admit(self, name):
+        estimate = self.estimate(name)
+        with self.cond:
+            waiting = False
+            while self.running > 0 and estimate > self.free():
+                if not waiting:
+                    verbose_info(f'Waiting for memory to start {name} '
+                                 f'(needs {estimate / 1024**2:.0f} MB, '
+                                 f'{self.free() / 1024**2:.0f} MB free)')
+                    waiting = True
+                # Memory may also be freed by other processes
+                self.cond.wait(timeout=1)
+            self.running += 1
+            self.reserved += estimate
+
+        usage = {}
+        try:
+            yield usage
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.reserved -= estimate
+                peaks = self.new_peaks.setdefault(name, [])
+                if usage.get('killed'):
+                    # Be more careful with the next processes
+                    peaks.append(estimate * 2)
+                elif 'max_rss' in usage:
+                    peaks.append(usage['max_rss'])
+                self.cond.notify_all()
+
+    def save(self):
+        """Store the recent peaks for estimates in the next runs"""
+        if not self.new_peaks:
+            return
+        peaks = {}
+        try:
+            with open(self.stats_fpath) as f:
+                peaks = json.load(f)
+        except (OSError, ValueError):
+            pass
+        for name, new_peaks in self.new_peaks.items():
+            peaks[name] = (peaks.get(name, []) + new_peaks)[-self.HISTORY:]
+        # The estimates are only an optimization of later runs
+        try:
+            self.stats_fpath.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=self.stats_fpath.parent, prefix='.tmp-',
+                    delete=False) as f:
+                json.dump(peaks, f)
+            os.replace(f.name, self.stats_fpath)
+        except OSError as exc:
+            verbose_info(f'Could not store memory use to '
+                         f'{self.stats_fpath}: {exc}')
+
+
+# Memory governor of the running conversions (see conversion_context)
+governor = None
+
+
+@contextmanager
+def admit(name):
+    """Wait for memory for a process of the given tool"""
+    if governor is None or name not in MemoryGovernor.STAGES \
+       or governor.budget is None:
+        yield {}
+    else:
+        with governor.admit(name) as usage:
+            yield usage
+
+
+class Profiler:
+    """Record the time and resource usage of build stages
+
+    The records are written as Chrome trace events (viewable in
+    chrome://tracing or https://ui.perfetto.dev).
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.records = []
+        self.tids = {}
+
+    @contextmanager
+    def stage(self, name, deck):
+        record = dict(name=name, deck=deck)
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield record
+        finally:
+            record['start'] = start - self.start
+            record['wall'] = time.perf_counter() - start
+            # Work done in this process unless recorded otherwise
+            record.setdefault('cpu', time.thread_time() - cpu_start)
+            record.setdefault(
+                'max_rss',
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+            with self.lock:
+                record['tid'] = self.tids.setdefault(threading.get_ident(),
+                                                     len(self.tids))
+                self.records.append(record)
+
+    def write(self, fpath):
+        events = []
+        for r in self.records:
+            max_rss = r['max_rss']
+            args = dict(deck=r['deck'], cpu_s=r['cpu'],
+                        max_rss_mb=None if max_rss is None
+                        else max_rss / 1024**2)
+            events.append(dict(name=r['name'], ph='X', pid=os.getpid(),
+                               tid=r['tid'],
+                               ts=r['start'] * 1e6, dur=r['wall'] * 1e6,
+                               args=args))
+        with open(fpath, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+
+    def summary(self):
+        stages = {}
+        for r in self.records:
+            st = stages.setdefault(r['name'], dict(count=0, wall=0, cpu=None,
+                                                   max_rss=None))
+            st['count'] += 1
+            st['wall'] += r['wall']
+            if r['cpu'] is not None:
+                st['cpu'] = (st['cpu'] or 0) + r['cpu']
+            if r['max_rss'] is not None:
+                st['max_rss'] = max(st['max_rss'] or 0, r['max_rss'])
+
+        lines = [f'{"Stage":16} {"Count":>6} {"Wall (s)":>10} '
+                 f'{"CPU (s)":>10} {"Peak RSS (MB)":>14}']
+        for name, st in sorted(stages.items(),
+                               key=lambda item: -item[1]['wall']):
+            cpu = '-' if st['cpu'] is None else f'{st["cpu"]:.2f}'
+            max_rss = '-' if st['max_rss'] is None \
+                else f'{st["max_rss"] / 1024**2:.1f}'
+            lines.append(f'{name:16} {st["count"]:6d} {st["wall"]:10.2f} '
+                         f'{cpu:>10} {max_rss:>14}')
+
+        converts = sorted((r for r in self.records if r['name'] == 'convert'),
+                          key=lambda r: -r['wall'])
+        if converts:
+            lines += ['', 'Slowest conversions:']
+            for r in converts[:10]:
+                lines.append(f'{r["wall"]:10.2f} s  {r["deck"]}')
+        return '\n'.join(lines)
+
+
+current_deck = contextvars.ContextVar('current_deck', default=None)
+
+
+@contextmanager
+def stage_template(name, *, profiler, deck=None):
+    """Profile a build stage, optionally setting the deck of nested stages"""
+    token = None
+    if deck is not None:
+        token = current_deck.set(str(deck))
+    try:
+        if profiler is None:
+            yield {}
+        else:
+            with profiler.stage(name, current_deck.get()) as record:
+                yield record
+    finally:
+        if token is not None:
+            current_deck.reset(token)
 
 
 def info_template(msg, *, quiet):
     if not quiet:
-        print(msg, flush=True)
+        # Write message and newline at once as conversions run in threads
+        print(f'{msg}\n', end='', flush=True)
 
 
 def error(msg, code=1):
@@ -145,6 +702,53 @@ def error(msg, code=1):
     sys.exit(code)
 
 
+def positive_int(value):
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(
+            f'invalid positive int value: {value}')
+    return n
+
+
+def stage_limit(value):
+    name, sep, n = value.partition('=')
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(f'invalid stage limit: {value}')
+    return name, positive_int(n)
+
+
+def memory_budget(value):
+    if value == 'auto':
+        return None
+    n = int(value)
+    if n < 0:
+        raise argparse.ArgumentTypeError(f'invalid memory budget: {value}')
+    return n * 1024**2
+
+
+def shard_spec(value):
+    index, sep, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not sep or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f'invalid shard: {value}')
+    return index, count
+
+
+FORMATS = ('pdf', 'html', 'html-local', 'html-embedded')
+
+
+def format_list(value):
+    formats = value.split(',')
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise argparse.ArgumentTypeError(
+                f'invalid format: {fmt} (available: {", ".join(FORMATS)})')
+    return list(dict.fromkeys(formats))
+
+
 def get_available_themes(theme_root):
     available_themes = sorted([str(x.name) for x in theme_root.iterdir()
                                if x.is_dir()])
@@ -178,7 +782,12 @@ def create_html(input_fpath, html_fpath, *,
                 template_fpath,
                 pandoc_vars,
                 filters=[],
+                filter_mode='pandoc',
                 pandoc_args=[],
+                link_mode='auto',
+                assets_dpath=None,
+                image_optimizer=None,
+                math_renderer=None,
                 dry_run=False,
                 ):
     run_args = [
@@ -189,50 +798,635 @@ def create_html(input_fpath, html_fpath, *,
     for key, value in pandoc_vars.items():
         run_args += [f'--variable={key}:{value}']
     run_args += pandoc_args
-    run_args += [f'--filter={f}' for f in filters]
-    run_args += [
-        f'--output={html_fpath}',
-        input_fpath,
-        ]
-    run(run_args)
+
+    if filters and filter_mode == 'inprocess':
+        # Read to json, apply filters here, and write from json
+        with tempfile.TemporaryDirectory(dir=input_fpath.parent,
+                                         prefix=f'.{input_fpath.stem}-') \
+             as tmp_dpath:
+            json_fpath = Path(tmp_dpath) / 'ast.json'
+            reader_args = [a for a in pandoc_args
+                           if a not in WRITER_ONLY_PANDOC_ARGS]
+            run([
+                'pandoc',
+                f'--defaults={defaults_fpath}',
+                *reader_args,
+                '--to=json',
+                f'--output={json_fpath}',
+                input_fpath,
+                ])
+            env = None if dry_run else get_filter_env(defaults_fpath)
+            apply_filters(json_fpath, filters, 'revealjs', env=env,
+                          dry_run=dry_run)
+            run(run_args + [
+                '--from=json',
+                f'--output={html_fpath}',
+                json_fpath,
+                ])
+    else:
+        run_args += [f'--filter={f}' for f in filters]
+        run_args += [
+            f'--output={html_fpath}',
+            input_fpath,
+            ]
+        run(run_args)
+
+    if math_renderer is not None and not dry_run:
+        with stage('math'):
+            math_renderer.render(html_fpath)
 
     if not dry_run:
-        copy_html_externals(input_fpath, html_fpath)
+        return copy_html_externals(input_fpath, html_fpath,
+                                   link_mode=link_mode,
+                                   assets_dpath=assets_dpath,
+                                   image_optimizer=image_optimizer)
+
+
+# Pandoc arguments that only apply to the html writer
+WRITER_ONLY_PANDOC_ARGS = ('--embed-resources', '--self-contained')
+
+
+# Template variables that are only substituted in the output
+URL_VARS = ('theme-url', 'revealjs-url', 'mathjaxurl', 'css')
+
+
+class SharedRender:
+    """Pandoc output shared by several formats of a presentation
 
+    Pandoc renders the html once with placeholders in place of the
+    resource urls (see URL_VARS), and each format gets a copy with its
+    own urls filled in. The other template variables must be the same.
+    """
 
-def copy_html_externals(input_fpath, html_fpath):
+    def __init__(self):
+        self.token = os.urandom(8).hex()
+        self.placeholders = None
+        self.pandoc_vars = None
+        self.html = None
+        self.externals = None
+        self.exc = None
+
+    def split_vars(self, pandoc_vars):
+        return ({key: value for key, value in pandoc_vars.items()
+                 if key in URL_VARS},
+                {key: value for key, value in pandoc_vars.items()
+                 if key not in URL_VARS})
+
+    def render(self, input_fpath, pandoc_vars, kwargs):
+        url_vars, self.pandoc_vars = self.split_vars(pandoc_vars)
+        self.placeholders = {
+            key: f'slidefactory-{self.token}-{key}' for key in url_vars}
+        with tempfile.NamedTemporaryFile(
+                 dir=input_fpath.parent,
+                 prefix=f'{input_fpath.stem}-',
+                 suffix='.html',
+             ) as tmpfile:
+            html_fpath = Path(tmpfile.name)
+            try:
+                self.externals = create_html(
+                    input_fpath, html_fpath,
+                    pandoc_vars=dict(self.pandoc_vars, **self.placeholders),
+                    **kwargs)
+            except BuildError as exc:
+                self.exc = exc
+                raise
+            self.html = html_fpath.read_text()
+
+    def create_html(self, input_fpath, html_fpath, *, pandoc_vars,
+                    link_mode='auto', assets_dpath=None,
+                    image_optimizer=None, dry_run=False, **kwargs):
+        url_vars, other_vars = self.split_vars(pandoc_vars)
+        if dry_run or (self.placeholders is not None
+                       and (set(url_vars) != set(self.placeholders)
+                            or other_vars != self.pandoc_vars)):
+            return create_html(input_fpath, html_fpath,
+                               pandoc_vars=pandoc_vars,
+                               link_mode=link_mode,
+                               assets_dpath=assets_dpath,
+                               image_optimizer=image_optimizer,
+                               dry_run=dry_run, **kwargs)
+
+        if self.exc is not None:
+            raise self.exc
+        if self.html is None:
+            self.render(input_fpath, pandoc_vars, kwargs)
+
+        content = self.html
+        for key, value in url_vars.items():
+            content = content.replace(self.placeholders[key], str(value))
+        html_fpath.write_text(content)
+        return copy_html_externals(input_fpath, html_fpath,
+                                   list(self.externals),
+                                   link_mode=link_mode,
+                                   assets_dpath=assets_dpath,
+                                   image_optimizer=image_optimizer)
+
+
+# Math as written by pandoc with --mathjax
+MATH_RE = re.compile(r'<span class="math (inline|display)">'
+                     r'\\[(\[](.*?)\\[)\]]</span>', re.DOTALL)
+
+MATH_RENDER_HTML = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<script>window.MathJax = {{startup: {{typeset: false}}}};</script>
+<script src="{url}"></script>
+</head>
+<body></body>
+</html>
+'''
+
+MATH_RENDER_EXPRESSION = '''
+MathJax.startup.promise
+.then(() => Promise.all({items}.map(([tex, display]) =>
+  MathJax.tex2svgPromise(tex, {{display}}).then(node => node.outerHTML))))
+.then(svgs => ({{svgs, style: MathJax.svgStylesheet().outerHTML}}))
+'''
+
+
+class MathRenderer:
+    """Typeset TeX math to SVG once with MathJax in a headless browser
+
+    The SVGs are stored in the cache directory keyed by the expression,
+    display mode and the MathJax url (which includes its version), and
+    inlined in the html so that MathJax does not run when the slides are
+    shown or printed.
+    """
+
+    def __init__(self, dpath, mathjax_url, *, browser_pool=None):
+        self.dpath = dpath
+        # The svg output of the same MathJax
+        self.url = re.sub(r'tex-chtml', 'tex-svg', mathjax_url)
+        self.own_pool = browser_pool is None
+        self.browser_pool = browser_pool or BrowserPool(1)
+
+    def _fpath(self, tex, display):
+        key = hashlib.sha256(
+            repr((self.url, display, tex)).encode()).hexdigest()
+        return self.dpath / key[:2] / f'{key}.svg'
+
+    def _load(self, fpath):
+        try:
+            with open(fpath, 'r') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _store(self, fpath, content):
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=fpath.parent,
+                                         prefix='.tmp-', delete=False) as f:
+            f.write(content)
+        os.replace(f.name, fpath)
+
+    def typeset(self, items):
+        """Return the svgs of (tex, display) items and their stylesheet"""
+        with tempfile.TemporaryDirectory(prefix='slidefactory-math-') \
+             as tmp_dpath:
+            html_fpath = Path(tmp_dpath) / 'math.html'
+            with open(html_fpath, 'w') as f:
+                f.write(MATH_RENDER_HTML.format(url=html.escape(self.url)))
+            with self.browser_pool.acquire() as browser, \
+                 admit('chromium'), \
+                 stage('chromium') as record:
+                # The work happens in the browser process
+                record.update(cpu=None, max_rss=None)
+                with browser.open_page(f'file://{html_fpath}') \
+                     as (session_id, _):
+                    result = browser.evaluate(
+                        MATH_RENDER_EXPRESSION.format(
+                            items=json.dumps(items)),
+                        session_id=session_id)
+        return result['svgs'], result['style']
+
+    def render(self, html_fpath):
+        """Replace the TeX math in html_fpath with svgs"""
+        with open(html_fpath, 'r') as f:
+            content = f.read()
+        items = list(dict.fromkeys(
+            (html.unescape(m.group(2)), m.group(1) == 'display')
+            for m in MATH_RE.finditer(content)))
+        if not items:
+            return
+
+        style_fpath = self._fpath('', None)
+        svgs = {item: self._load(self._fpath(*item)) for item in items}
+        style = self._load(style_fpath)
+        missing = [item for item, svg in svgs.items() if svg is None]
+        if missing or style is None:
+            verbose_info(f'Typeset {len(missing)} of {len(items)} '
+                         f'expressions in {html_fpath}')
+            new_svgs, style = self.typeset(missing)
+            for item, svg in zip(missing, new_svgs):
+                svgs[item] = svg
+                self._store(self._fpath(*item), svg)
+            self._store(style_fpath, style)
+
+        def replace(m):
+            item = (html.unescape(m.group(2)), m.group(1) == 'display')
+            return f'<span class="math {m.group(1)}">{svgs[item]}</span>'
+
+        content = MATH_RE.sub(replace, content)
+        content = content.replace('</head>', f'{style}\n</head>', 1)
+        with open(html_fpath, 'w') as f:
+            f.write(content)
+
+    def close(self):
+        if self.own_pool:
+            self.browser_pool.close()
+
+
+_filter_lock = threading.Lock()
+_filter_actions = {}
+
+
+def load_filter(fpath):
+    """Load the actions of a pandocfilters-based python filter
+
+    The filter script is run as __main__ with its imports of pandocfilters
+    resolved to a copy of the module whose entry points record the actions
+    instead of running them on stdin; the module itself is not changed.
+    The actions are loaded once and reused until the script changes.
+    Returns None for other filters, which are run as subprocesses.
+    """
+    fpath = Path(fpath)
+    key = (fpath.resolve(), fpath.stat().st_mtime_ns)
+    with _filter_lock:
+        if key in _filter_actions:
+            return _filter_actions[key]
+
+        actions = None
+        if fpath.suffix == '.py' and uses_pandocfilters(fpath):
+            import pandocfilters
+
+            actions = []
+            recorder = types.ModuleType(pandocfilters.__name__)
+            recorder.__dict__.update(pandocfilters.__dict__)
+            recorder.toJSONFilter = actions.append
+            recorder.toJSONFilters = actions.extend
+
+            def import_recorder(name, *args, **kwargs):
+                if name == pandocfilters.__name__:
+                    return recorder
+                return __import__(name, *args, **kwargs)
+
+            script_builtins = dict(builtins.__dict__,
+                                   __import__=import_recorder)
+            # Filters may check the pandoc version on loading
+            os.environ.setdefault('PANDOC_VERSION', get_pandoc_version())
+            try:
+                runpy.run_path(str(fpath),
+                               init_globals=dict(__builtins__=script_builtins),
+                               run_name='__main__')
+            except Exception as exc:
+                raise BuildError(f'error: loading filter {fpath} failed: '
+                                 f'{exc!r}')
+            verbose_info(f'Loaded {len(actions)} filter actions from {fpath}')
+
+        _filter_actions[key] = actions
+        return actions
+
+
+@functools.lru_cache(maxsize=None)
+def get_pandoc_version():
+    """Return the version of pandoc, as pandoc sets it for filters"""
+    try:
+        p = subprocess.run(['pandoc', '--version'], check=True,
+                           capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError) as exc:
+        raise BuildError(f'error: pandoc --version failed: {exc}')
+    m = re.match(r'\S+ (\S+)', p.stdout)
+    if m is None:
+        raise BuildError(f'error: unknown pandoc version {p.stdout!r}')
+    return m.group(1)
+
+
+# Reader options that pandoc passes to filters, with their defaults
+PANDOC_READER_OPTIONS = {
+    'abbreviations': [],
+    'columns': 80,
+    'default-image-extension': '',
+    'indented-code-classes': [],
+    'standalone': False,
+    'strip-comments': False,
+    'tab-stop': 4,
+    'track-changes': 'accept-changes',
+    }
+
+
+def get_filter_env(defaults_fpath):
+    """Return the environment in which pandoc runs filters
+
+    The reader options are the defaults of pandoc updated with those set
+    in the defaults file (the enabled extensions are not included).
+    """
+    with open(defaults_fpath) as f:
+        defaults = next(yaml.safe_load_all(f), None) or {}
+    reader_options = {key: defaults.get(key, value)
+                      for key, value in PANDOC_READER_OPTIONS.items()}
+    return dict(os.environ,
+                PANDOC_VERSION=get_pandoc_version(),
+                PANDOC_READER_OPTIONS=json.dumps(reader_options))
+
+
+def uses_pandocfilters(fpath):
+    try:
+        import pandocfilters  # noqa: F401
+    except ImportError:
+        return False
+    with open(fpath, 'r') as f:
+        try:
+            tree = ast.parse(f.read())
+        except SyntaxError:
+            return False
+    names = {node.attr if isinstance(node, ast.Attribute) else node.id
+             for node in ast.walk(tree)
+             if isinstance(node, (ast.Attribute, ast.Name))}
+    return bool(names & {'toJSONFilter', 'toJSONFilters'})
+
+
+def apply_filters(json_fpath, filters, format, *, env=None, dry_run=False):
+    """Apply filters to the pandoc json file in place
+
+    The filters that are run as subprocesses get env (see get_filter_env).
+    """
+    if dry_run:
+        info(f'apply filters {" ".join(map(str, filters))} to {json_fpath}')
+        return
+
+    verbose_info(f'apply filters {" ".join(map(str, filters))} '
+                 f'to {json_fpath}')
+    with stage('filters'):
+        _apply_filters(json_fpath, filters, format, env=env)
+
+
+def _apply_filters(json_fpath, filters, format, *, env=None):
+    with open(json_fpath, 'r') as f:
+        doc = json.load(f)
+
+    for fpath in filters:
+        actions = load_filter(fpath)
+        if actions is None:
+            run_args = [fpath, format]
+            if Path(fpath).suffix == '.py':
+                run_args = [sys.executable] + run_args
+            verbose_info(shlex.join(map(str, run_args)))
+            p = subprocess.run(run_args, input=json.dumps(doc).encode(),
+                               check=False, capture_output=True, env=env)
+            if p.returncode != 0:
+                raise BuildError(f'error: filter {repr(str(fpath))} failed '
+                                 f'with exit code {p.returncode}:\n'
+                                 f'{p.stderr.decode()}')
+            doc = json.loads(p.stdout)
+        else:
+            import pandocfilters
+
+            if 'meta' in doc:
+                meta = doc['meta']
+            elif doc[0]:  # old API
+                meta = doc[0]['unMeta']
+            else:
+                meta = {}
+            for action in actions:
+                doc = pandocfilters.walk(doc, action, format, meta)
+
+    with open(json_fpath, 'w') as f:
+        json.dump(doc, f)
+
+
+def copy_html_externals(input_fpath, html_fpath, externals=None, *,
+                        link_mode='auto',
+                        assets_dpath=None,
+                        image_optimizer=None,
+                        ):
     # Find external file paths
-    parser = HTMLParser()
-    with open(html_fpath, 'r') as f:
-        parser.feed(f.read())
-    externals = parser.sources
+    if externals is None:
+        parser = HTMLParser()
+        with open(html_fpath, 'r') as f:
+            parser.feed(f.read())
+        externals = parser.sources
 
     # Check that files exist
     for fname in externals:
         fpath = input_fpath.parent / fname
         if not fpath.exists():
-            error(f'Linked file missing: {fpath}')
+            raise BuildError(f'Linked file missing: {fpath}')
 
     # Copy files to output path
-    if input_fpath.parent.resolve() != html_fpath.parent.resolve():
-        for fname in externals:
-            ext_fpath = input_fpath.parent / fname
-            tgt_fpath = html_fpath.parent / fname
-            verbose_info(f'cp {ext_fpath} {tgt_fpath}')
+    with stage('copy'):
+        if input_fpath.parent.resolve() != html_fpath.parent.resolve():
+            def get_src_fpath(ext_fpath):
+                if image_optimizer is None:
+                    return ext_fpath
+                return image_optimizer(ext_fpath)
+
+            if assets_dpath is None:
+                for fname in externals:
+                    publish_file(get_src_fpath(input_fpath.parent / fname),
+                                 html_fpath.parent / fname,
+                                 link_mode=link_mode)
+            else:
+                # Publish files once under content-addressed names
+                urls = {}
+                for fname in externals:
+                    ext_fpath = input_fpath.parent / fname
+                    tgt_fpath = assets_dpath / \
+                        get_asset_name(ext_fpath, hash_file(ext_fpath))
+                    publish_file(get_src_fpath(ext_fpath), tgt_fpath,
+                                 link_mode=link_mode)
+                    urls[fname] = urlquote(
+                        os.path.relpath(tgt_fpath, html_fpath.parent))
+                rewrite_html_sources(html_fpath, urls)
+
+    return externals
+
+
+def get_asset_name(fpath, digest):
+    """Return the content-addressed name of a shared asset"""
+    return f'{digest[:32]}{fpath.suffix.lower()}'
+
+
+# Scripts that load further files relative to their own location,
+# bundled together with the given directories
+BUNDLED_DIRS = {
+    'tex-chtml-full.js': ['output/chtml/fonts/woff-v2'],
+    }
+
+
+class AssetBundler:
+    """Copy the local resources used by html files under hashed names
+
+    Resources are found from the file urls in the html that point under
+    the given root directories and, recursively, from the relative urls in
+    stylesheets. Each file is published under a content-addressed name
+    and the urls are rewritten to point to it. Scripts that load further
+    files relative to their own location (see BUNDLED_DIRS) are published
+    with those files in a content-addressed directory.
+    """
+
+    def __init__(self, roots, *, link_mode='auto'):
+        self.roots = [Path(dpath).resolve() for dpath in roots]
+        self.link_mode = link_mode
+        self.lock = threading.Lock()
+        self.hashes = {}
+
+    def is_local(self, fpath):
+        return any(fpath.is_relative_to(dpath) for dpath in self.roots)
+
+    def hash_file(self, fpath):
+        st = fpath.stat()
+        key = (fpath, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            digest = self.hashes.get(key)
+        if digest is None:
+            digest = hash_file(fpath)
+            with self.lock:
+                self.hashes[key] = digest
+        return digest
+
+    def bundle(self, html_fpath, assets_dpath):
+        """Bundle the local resources of html_fpath into assets_dpath
+
+        Returns the bundled files.
+        """
+        with open(html_fpath, 'r') as f:
+            content = f.read()
+        bundled = set()
+
+        def replace(m):
+            fpath = Path(urlunquote(m.group(1))).resolve()
+            if not fpath.is_file() or not self.is_local(fpath):
+                return m.group()
+            name = self.publish(fpath, assets_dpath, bundled)
+            return urlquote(os.path.relpath(assets_dpath / name,
+                                            html_fpath.parent))
+
+        content = re.sub(r'file://([^"\'\s()<>]+)', replace, content)
+        with open(html_fpath, 'w') as f:
+            f.write(content)
+        return sorted(bundled)
+
+    def publish(self, fpath, assets_dpath, bundled):
+        """Publish fpath and the files it uses and return its name"""
+        if fpath.name in BUNDLED_DIRS:
+            return self.publish_dir(fpath, assets_dpath, bundled)
+        if fpath.suffix.lower() == '.css':
+            return self.publish_css(fpath, assets_dpath, bundled)
+        name = get_asset_name(fpath, self.hash_file(fpath))
+        publish_file(fpath, assets_dpath / name, link_mode=self.link_mode)
+        bundled.add(assets_dpath / name)
+        return name
+
+    def publish_css(self, fpath, assets_dpath, bundled):
+        with open(fpath, 'r') as f:
+            content = f.read()
+
+        def rewrite(m):
+            prefix, url, suffix = m.group(1, 3, 4)
+            path = re.match(r'[^?#]*', url).group()
+            if not path or urlparse(url).scheme or url.startswith('/'):
+                return m.group()
+            dep_fpath = (fpath.parent / urlunquote(path)).resolve()
+            if not dep_fpath.is_file():
+                return m.group()
+            name = self.publish(dep_fpath, assets_dpath, bundled)
+            return f'{prefix}{urlquote(name)}{url[len(path):]}{suffix}'
+
+        content = re.sub(r'(url\(\s*([\'"]?))([^\'")]+)(\2\s*\))',
+                         rewrite, content)
+        content = re.sub(r'(@import\s+([\'"]))([^\'"]+)(\2)',
+                         rewrite, content)
+
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        tgt_fpath = assets_dpath / get_asset_name(fpath, digest)
+        if not tgt_fpath.exists():
             tgt_fpath.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(ext_fpath, tgt_fpath)
+            with tempfile.NamedTemporaryFile('w', dir=tgt_fpath.parent,
+                                             prefix='.tmp-',
+                                             delete=False) as f:
+                f.write(content)
+            os.chmod(f.name, 0o644)
+            os.replace(f.name, tgt_fpath)
+        bundled.add(tgt_fpath)
+        return tgt_fpath.name
 
+    def publish_dir(self, fpath, assets_dpath, bundled):
+        fpaths = [fpath]
+        for rel_dpath in BUNDLED_DIRS[fpath.name]:
+            dpath = fpath.parent / rel_dpath
+            if dpath.is_dir():
+                fpaths += sorted(p for p in dpath.rglob('*') if p.is_file())
+        h = hashlib.sha256()
+        for src_fpath in fpaths:
+            h.update(f'{src_fpath.relative_to(fpath.parent)}\0'
+                     f'{self.hash_file(src_fpath)}\0'.encode())
+        tgt_dpath = assets_dpath / h.hexdigest()[:32]
+        for src_fpath in fpaths:
+            tgt_fpath = tgt_dpath / src_fpath.relative_to(fpath.parent)
+            publish_file(src_fpath, tgt_fpath, link_mode=self.link_mode)
+            bundled.add(tgt_fpath)
+        return f'{tgt_dpath.name}/{fpath.name}'
+
+
+# Times are given in milliseconds since navigation start
+TIMINGS_EXPRESSION = '''
+Object.fromEntries(
+  Object.entries(window.slidefactory ? window.slidefactory.timings : {})
+  .map(([name, t]) => [name, t / 1000]))
+'''
+READY_EXPRESSION = f'''
+Promise.resolve(window.slidefactory ? window.slidefactory.ready
+                                    : document.fonts.ready)
+.then(() => {TIMINGS_EXPRESSION})
+'''
+# Number of pages of a reveal.js presentation in print mode
+PAGE_COUNT_EXPRESSION = "document.querySelectorAll('.pdf-page').length"
+# Html of the pages of a reveal.js presentation in print mode and what
+# else their layout depends on: the classes of the document and its style
+# sheets, but not its scripts, whose state changes from run to run
+PAGES_EXPRESSION = '''
+(() => {
+  const pages = Array.from(document.querySelectorAll('.pdf-page'));
+  const styles = Array.from(
+    document.querySelectorAll('style, link[rel~="stylesheet"]'));
+  const context = [document.documentElement.className,
+                   document.body.className,
+                   ...styles.map(element => element.outerHTML)];
+  return {document: JSON.stringify(context),
+          pages: pages.map(page => page.outerHTML)};
+})()
+'''
+
+
+def format_timings(timings):
+    return ', '.join(f'{name} {t:.1f} s' for name, t in timings.items())
+
+
+class Browser:
+    """Headless chromium controlled over the DevTools protocol
+
+    Messages are exchanged as null-terminated JSON over a pipe
+    (with --remote-debugging-pipe, chromium reads fd 3 and writes fd 4).
+    """
+
+    def __init__(self, *, timeout=60):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # Writing to the pipe may block, so it is not done under self.lock
+        # that the reader needs for dispatching the responses
+        self.write_lock = threading.Lock()
+        self.closed = False
+        self.msg_id = 0
+        self.pending = {}
+        self.waiters = {}
+        self.context_id = None
+        self.user_data_dpath = \
+            tempfile.mkdtemp(prefix='slidefactory-chromium-')
+
+        child_r, self.write_fd = os.pipe()
+        self.read_fd, child_w = os.pipe()
 
-def create_pdf(html_fpath, pdf_fpath, *,
-               meta={},
-               dry_run=False,
-               ):
-    with tempfile.NamedTemporaryFile(
-             dir=pdf_fpath.parent,
-             prefix=f'{pdf_fpath.stem}-',
-             suffix='.pdf') \
-         as tmpfile:
-        tmp_pdf_fpath = Path(tmpfile.name)
         run_args = [
             'chromium',
             '--no-sandbox',
@@ -240,200 +1434,2790 @@ def create_pdf(html_fpath, pdf_fpath, *,
             '--disable-gpu',
             '--disable-software-rasterizer',
             '--hide-scrollbars',
-            '--virtual-time-budget=2147483647',
-            '--run-all-compositor-stages-before-draw',
-            f'--print-to-pdf={tmp_pdf_fpath}',
-            f'file://{html_fpath.absolute()}?print-pdf'
+            '--remote-debugging-pipe',
+            f'--user-data-dir={self.user_data_dpath}',
             ]
-        run(run_args)
+        verbose_info(shlex.join(run_args))
+        try:
+            # Pass the pipe as stdin and stdout and move it to fds 3 and 4
+            self.process = subprocess.Popen(
+                ['sh', '-c',
+                 'exec "$@" 3<&0 4>&1 0</dev/null 1>/dev/null',
+                 'sh', *run_args],
+                stdin=child_r,
+                stdout=child_w,
+                stderr=subprocess.DEVNULL,
+                )
+        finally:
+            os.close(child_r)
+            os.close(child_w)
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
 
-        with tempfile.NamedTemporaryFile(
-                 dir=pdf_fpath.parent,
-                 prefix=f'{pdf_fpath.stem}-',
-                 suffix='.txt') \
-             as tmpfile:
-            pdfmark_fpath = Path(tmpfile.name)
+    def _read(self):
+        parts = []
+        while True:
+            try:
+                chunk = os.read(self.read_fd, 1 << 20)
+            except OSError:
+                break
+            if not chunk:
+                break
+            while True:
+                i = chunk.find(b'\0')
+                if i < 0:
+                    break
+                parts.append(chunk[:i])
+                self._dispatch(json.loads(b''.join(parts)))
+                parts = []
+                chunk = chunk[i + 1:]
+            parts.append(chunk)
 
-            pdfmark = '[ '
-            for key in ["Title", "Author", "Subject"]:
-                value = meta.get(key.lower())
-                if value is not None:
-                    pdfmark += f'/{key} ({value}) '
-            pdfmark += f'/Creator (Slidefactory {VERSION}) /DOCINFO pdfmark'
+        with self.lock:
+            self.closed = True
+            futures = list(self.pending.values())
+            for waiters in self.waiters.values():
+                futures += waiters
+        if not futures:
+            return
+        msg = 'error: chromium exited unexpectedly'
+        try:
+            if self.process.wait(timeout=1) == -signal.SIGKILL:
+                msg = 'error: chromium was killed, most likely because ' \
+                      'the system ran out of memory'
+        except subprocess.TimeoutExpired:
+            pass
+        for future in futures:
+            if not future.done():
+                future.set_exception(BuildError(msg))
 
-            verbose_info(f'write {pdfmark_fpath}')
-            verbose_info(f'{pdfmark}\n')
-            if not dry_run:
-                with open(pdfmark_fpath, 'w') as f:
-                    f.write(pdfmark)
+    def _dispatch(self, msg):
+        with self.lock:
+            if 'id' in msg:
+                futures = [self.pending.pop(msg['id'], None)]
+            else:
+                key = (msg.get('sessionId'), msg.get('method'))
+                futures = self.waiters.pop(key, [])
+        for future in futures:
+            if future is not None and not future.done():
+                future.set_result(msg)
+
+    def is_alive(self):
+        return not self.closed and self.process.poll() is None
+
+    def expect(self, method, *, session_id=None):
+        """Return a future for the next event of the given method"""
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.waiters.setdefault((session_id, method), []).append(future)
+        return future
+
+    def wait(self, future, what, *, timeout=None):
+        try:
+            return future.result(timeout or self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise BuildError(f'error: chromium timed out waiting for {what}')
+
+    def send(self, method, params={}, *, session_id=None, timeout=None):
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                raise BuildError('error: chromium is not running')
+            self.msg_id += 1
+            msg_id = self.msg_id
+            self.pending[msg_id] = future
+        msg = dict(id=msg_id, method=method, params=params)
+        if session_id is not None:
+            msg['sessionId'] = session_id
+        data = json.dumps(msg).encode() + b'\0'
+        try:
+            with self.write_lock:
+                while data:
+                    data = data[os.write(self.write_fd, data):]
+        except OSError as exc:
+            with self.lock:
+                self.pending.pop(msg_id, None)
+            raise BuildError(f'error: chromium is not running: {exc}')
+        try:
+            response = self.wait(future, method, timeout=timeout)
+        finally:
+            with self.lock:
+                self.pending.pop(msg_id, None)
+        if 'error' in response:
+            raise BuildError(f'error: chromium {method} failed: '
+                             f'{response["error"].get("message")}')
+        return response.get('result', {})
+
+    def evaluate(self, expression, *, session_id, timeout=None):
+        result = self.send('Runtime.evaluate',
+                           dict(expression=expression,
+                                awaitPromise=True,
+                                returnByValue=True),
+                           session_id=session_id,
+                           timeout=timeout)
+        if 'exceptionDetails' in result:
+            raise BuildError(f'error: javascript evaluation failed: '
+                             f'{result["exceptionDetails"].get("text")}')
+        return result['result'].get('value')
+
+    @contextmanager
+    def open_page(self, url, *, timeout=None):
+        """Open url in a new tab and yield its session when it is ready
+
+        The page is ready when it signals so (see the theme template) or,
+        lacking the signal, when its fonts are loaded. The yielded dict
+        of the times to reach readiness is filled in before yielding.
+        """
+        timeout = timeout or self.timeout
+        start = time.monotonic()
+
+        # Reuse the same browser context for all presentations
+        if self.context_id is None:
+            self.context_id = \
+                self.send('Target.createBrowserContext')['browserContextId']
+        target_id = self.send('Target.createTarget',
+                              dict(url='about:blank',
+                                   browserContextId=self.context_id),
+                              )['targetId']
+        try:
+            session_id = self.send('Target.attachToTarget',
+                                   dict(targetId=target_id, flatten=True),
+                                   )['sessionId']
+            self.send('Page.enable', session_id=session_id)
+            loaded = self.expect('Page.loadEventFired', session_id=session_id)
+            result = self.send('Page.navigate', dict(url=url),
+                               session_id=session_id)
+            if 'errorText' in result:
+                raise BuildError(f'error: chromium failed to load {url}: '
+                                 f'{result["errorText"]}')
+            self.wait(loaded, f'loading {url}', timeout=timeout)
+            timings = dict(load=time.monotonic() - start)
+            try:
+                timings.update(self.evaluate(
+                    READY_EXPRESSION, session_id=session_id,
+                    timeout=max(timeout - timings['load'], 1)))
+            except BuildError as exc:
+                # Report which milestones were reached
+                if self.is_alive():
+                    timings.update(self.evaluate(
+                        TIMINGS_EXPRESSION, session_id=session_id))
+                raise BuildError(f'{exc}\n'
+                                 f'reached: {format_timings(timings)}')
+            yield session_id, timings
+        finally:
+            if self.is_alive():
+                self.send('Target.closeTarget', dict(targetId=target_id))
+
+    def print_page(self, session_id, pdf_fpath, *, page_ranges='',
+                   timeout=None):
+        """Print the page of the session, or its given pages, to pdf"""
+        result = self.send('Page.printToPDF',
+                           dict(printBackground=True,
+                                preferCSSPageSize=True,
+                                pageRanges=page_ranges),
+                           session_id=session_id,
+                           timeout=timeout)
+        with open(pdf_fpath, 'wb') as f:
+            f.write(base64.b64decode(result['data']))
+
+    def print_pdf(self, url, pdf_fpath, *, timeout=None, page_ranges=''):
+        """Print url to pdf and return the times to reach readiness"""
+        with self.open_page(url, timeout=timeout) as (session_id, timings):
+            self.print_page(session_id, pdf_fpath, page_ranges=page_ranges,
+                            timeout=timeout)
+        return timings
+
+    def close(self):
+        if self.process.returncode is not None and self.reader is None:
+            return
+        if self.is_alive():
+            try:
+                self.send('Browser.close', timeout=5)
+            except BuildError:
+                pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        os.close(self.write_fd)
+        self.reader.join()
+        self.reader = None
+        os.close(self.read_fd)
+        shutil.rmtree(self.user_data_dpath, ignore_errors=True)
+
+
+class BrowserPool:
+    """Pool of long-lived browsers started on demand"""
+
+    def __init__(self, size, *, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self.browsers = []
+        self.lock = threading.Lock()
+        self.executor = None
+        # None marks a slot for a browser that is not yet running
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    @contextmanager
+    def acquire(self):
+        browser = self.idle.get()
+        if browser is None:
+            try:
+                browser = Browser(timeout=self.timeout)
+            except OSError as exc:
+                self.idle.put(None)
+                raise BuildError(f'error: failed to start chromium: {exc}')
+            with self.lock:
+                self.browsers.append(browser)
+        try:
+            yield browser
+        finally:
+            if browser.is_alive():
+                self.idle.put(browser)
+            else:
+                browser.close()
+                self.idle.put(None)
+
+    def submit(self, fn, *args):
+        """Run fn in a thread shared by the users of the pool
+
+        There are as many threads as browsers, as each of them is
+        expected to use a browser of the pool.
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.size)
+        return self.executor.submit(contextvars.copy_context().run,
+                                    fn, *args)
+
+    def close(self):
+        with self.lock:
+            browsers = self.browsers
+            self.browsers = []
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown()
+        for browser in browsers:
+            browser.close()
+
+
+def publish_file(src_fpath, tgt_fpath, *, link_mode='auto'):
+    """Make tgt_fpath a copy of src_fpath unless it is already up to date
+
+    Depending on link_mode, the target is a hard link, a reflink (a
+    copy-on-write clone on filesystems supporting it), or a regular copy.
+    Unsupported links fall back to copying.
+    """
+    try:
+        src_st = src_fpath.stat()
+        tgt_st = tgt_fpath.stat()
+        if (src_st.st_dev, src_st.st_ino) == (tgt_st.st_dev, tgt_st.st_ino):
+            return
+        if src_st.st_size == tgt_st.st_size and (
+                src_st.st_mtime_ns == tgt_st.st_mtime_ns
+                or hash_file(src_fpath) == hash_file(tgt_fpath)):
+            return
+    except FileNotFoundError:
+        pass
+
+    tgt_fpath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fpath = tgt_fpath.with_name(
+        f'.{tgt_fpath.name}.{os.getpid()}.{threading.get_ident()}')
+    try:
+        if link_mode == 'hardlink':
+            try:
+                os.link(src_fpath, tmp_fpath)
+                verbose_info(f'ln {src_fpath} {tgt_fpath}')
+            except OSError:
+                link_mode = 'copy'
+        elif link_mode in ['auto', 'reflink']:
+            try:
+                with open(src_fpath, 'rb') as src, \
+                     open(tmp_fpath, 'wb') as tgt:
+                    fcntl.ioctl(tgt.fileno(), FICLONE, src.fileno())
+                shutil.copystat(src_fpath, tmp_fpath)
+                verbose_info(f'cp --reflink {src_fpath} {tgt_fpath}')
+            except OSError:
+                link_mode = 'copy'
+        if link_mode == 'copy':
+            verbose_info(f'cp {src_fpath} {tgt_fpath}')
+            shutil.copy2(src_fpath, tmp_fpath)
+        os.replace(tmp_fpath, tgt_fpath)
+    finally:
+        tmp_fpath.unlink(missing_ok=True)
+
+
+def rewrite_html_sources(html_fpath, urls):
+    """Replace data-src attributes of html using the urls mapping"""
+    def replace(m):
+        value = html.unescape(m.group(1))
+        if value not in urls:
+            return m.group()
+        return f'data-src="{html.escape(urls[value])}"'
+
+    with open(html_fpath, 'r') as f:
+        content = f.read()
+    content = re.sub(r'data-src="([^"]*)"', replace, content)
+    with open(html_fpath, 'w') as f:
+        f.write(content)
+
+
+def get_shard_ranges(n_pages, shard_size):
+    """Return the page ranges of the parts to print separately
+
+    The whole presentation is printed at once (an empty range) if it
+    fits in one part.
+    """
+    ranges = [f'{first}-{min(first + shard_size - 1, n_pages)}'
+              for first in range(1, n_pages + 1, shard_size)]
+    return ranges if len(ranges) > 1 else ['']
+
+
+def print_pdf_shards(browser_pool, url, pdf_dpath, *, timeout, shard_size):
+    """Print url in ranges of shard_size pages with parallel browsers
+
+    The first browser counts the pages and prints the first range while
+    the others print the other ranges as they become free. Returns the
+    printed parts in page order and the times to reach readiness.
+    """
+    def print_range(i, page_ranges):
+        fpath = pdf_dpath / f'{i:04d}.pdf'
+        with browser_pool.acquire() as browser, \
+             admit('chromium'), \
+             stage('chromium') as record:
+            # The work happens in the browser process
+            record.update(cpu=None, max_rss=None)
+            browser.print_pdf(url, fpath, timeout=timeout,
+                              page_ranges=page_ranges)
+        return fpath
+
+    fpath = pdf_dpath / f'{0:04d}.pdf'
+    futures = []
+    try:
+        with browser_pool.acquire() as browser, \
+             admit('chromium'), \
+             stage('chromium') as record:
+            record.update(cpu=None, max_rss=None)
+            with browser.open_page(url, timeout=timeout) \
+                 as (session_id, timings):
+                n_pages = browser.evaluate(PAGE_COUNT_EXPRESSION,
+                                           session_id=session_id,
+                                           timeout=timeout) or 0
+                ranges = get_shard_ranges(n_pages, shard_size)
+                if len(ranges) > 1:
+                    verbose_info(f'print {url} in {len(ranges)} parts '
+                                 f'of {shard_size} pages')
+                # Start the other ranges before printing the first one
+                futures = [browser_pool.submit(print_range, i, page_ranges)
+                           for i, page_ranges in enumerate(ranges[1:], 1)]
+                browser.print_page(session_id, fpath,
+                                   page_ranges=ranges[0], timeout=timeout)
+        # The browser is released before waiting for the others
+        return [fpath] + [future.result() for future in futures], timings
+    finally:
+        for future in futures:
+            future.cancel()
+        concurrent.futures.wait(futures)
+
+
+# Ghostscript options that keep the images as they are
+GS_LOSSLESS_ARGS = [
+    '-dPassThroughJPEGImages=true',
+    '-dAutoFilterColorImages=false',
+    '-dColorImageFilter=/FlateEncode',
+    '-dAutoFilterGrayImages=false',
+    '-dGrayImageFilter=/FlateEncode',
+    ]
+
+
+def get_page_ranges(numbers):
+    """Return the ranges [first, last] of consecutive page numbers"""
+    ranges = []
+    for i in numbers:
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ranges
+
+
+def print_pdf_pages(browser_pool, url, pdf_dpath, *, timeout, page_cache):
+    """Print url, reusing the pages in page_cache
+
+    Consecutive pages missing from the cache are printed at once, and
+    the whole presentation in one go if no page is cached. The printed
+    ranges are split into pages for the cache without changing their
+    content (see split_pdf). Returns the parts in page order and the
+    times to reach readiness.
+    """
+    parts = []
+    # Printed parts with the keys and html of their pages
+    printed = []
+    with browser_pool.acquire() as browser, \
+         admit('chromium'), \
+         stage('chromium') as record:
+        # The work happens in the browser process
+        record.update(cpu=None, max_rss=None)
+        with browser.open_page(url, timeout=timeout) \
+             as (session_id, timings):
+            layout = browser.evaluate(PAGES_EXPRESSION,
+                                      session_id=session_id,
+                                      timeout=timeout)
+            if not layout['pages']:
+                fpath = pdf_dpath / 'all.pdf'
+                browser.print_page(session_id, fpath, timeout=timeout)
+                return [fpath], timings
+
+            pages = [(page_cache.get_key(layout['document'], page_html),
+                      page_html) for page_html in layout['pages']]
+            missing = []
+            for i, (key, page_html) in enumerate(pages, 1):
+                fpath = pdf_dpath / f'{i:04d}.pdf'
+                cached_fpath = page_cache.lookup(key)
+                try:
+                    if cached_fpath is None:
+                        raise FileNotFoundError(key)
+                    # Copy in case the entry is evicted before merging
+                    shutil.copyfile(cached_fpath, fpath)
+                except OSError:
+                    missing.append(i)
+                    continue
+                parts.append((i, fpath))
+
+            # Print the ranges of consecutive missing pages
+            for first, last in get_page_ranges(missing):
+                fpath = pdf_dpath / f'{first:04d}.pdf'
+                page_ranges = f'{first}-{last}'
+                if (first, last) == (1, len(pages)):
+                    page_ranges = ''
+                browser.print_page(session_id, fpath,
+                                   page_ranges=page_ranges, timeout=timeout)
+                parts.append((first, fpath))
+                printed.append((fpath, pages[first - 1:last]))
+    verbose_info(f'print {url}: {len(missing)} of {len(pages)} pages '
+                 f'printed, others from cache')
+
+    for fpath, printed_pages in printed:
+        pages_dpath = fpath.with_suffix('')
+        pages_dpath.mkdir()
+        try:
+            with stage('pdf-split'):
+                n_pages = split_pdf(fpath, pages_dpath)
+            if n_pages != len(printed_pages):
+                raise PdfError(f'{n_pages} pages instead of '
+                               f'{len(printed_pages)}')
+        except PdfError as exc:
+            # The pages are only not cached
+            verbose_info(f'Could not split {fpath} into pages: {exc}')
+            continue
+        with stage('cache'):
+            for i, (key, page_html) in enumerate(printed_pages, 1):
+                page_cache.store(key, pages_dpath / f'{i:04d}.pdf',
+                                 page_html)
+    if printed:
+        with stage('cache'):
+            page_cache.evict()
+    return [fpath for _, fpath in sorted(parts)], timings
+
+
+def get_pdf_optimize(optimize, html_fpath, externals):
+    """Return the post-processing of the pdf printed from html_fpath
+
+    With 'auto', the pdf is recompressed only if there are raster images
+    to downsample, including those of slide backgrounds.
+    """
+    if optimize != 'auto':
+        return optimize
+    with open(html_fpath) as f:
+        sources = get_html_sources(f.read())
+    sources.update(externals or [])
+    if any(Path(urlparse(src).path).suffix.lower() in RASTER_SUFFIXES
+           for src in sources):
+        return 'full'
+    return 'metadata'
+
+
+def create_pdf(html_fpath, pdf_fpath, *,
+               meta={},
+               browser_pool=None,
+               timeout=300,
+               optimize='full',
+               shard_size=None,
+               page_cache=None,
+               dry_run=False,
+               ):
+    with tempfile.NamedTemporaryFile(
+             dir=pdf_fpath.parent,
+             prefix=f'{pdf_fpath.stem}-',
+             suffix='.pdf') \
+         as tmpfile, \
+         tempfile.TemporaryDirectory(
+             dir=pdf_fpath.parent,
+             prefix=f'.{pdf_fpath.stem}-') \
+         as parts_dpath:
+        tmp_pdf_fpath = Path(tmpfile.name)
+        parts = [tmp_pdf_fpath]
+        url = f'file://{html_fpath.absolute()}?print-pdf'
+        start = time.monotonic()
+        timings = {}
+        if browser_pool is None:
+            run_args = [
+                'chromium',
+                '--no-sandbox',
+                '--headless',
+                '--disable-gpu',
+                '--disable-software-rasterizer',
+                '--hide-scrollbars',
+                f'--virtual-time-budget={timeout * 1000}',
+                '--run-all-compositor-stages-before-draw',
+                f'--print-to-pdf={tmp_pdf_fpath}',
+                url,
+                ]
+            run(run_args, timeout=timeout)
+        elif dry_run:
+            info(f'print {url} to {tmp_pdf_fpath} (devtools)')
+        elif page_cache is not None:
+            verbose_info(f'print {url} to {parts_dpath} (devtools)')
+            parts, timings = print_pdf_pages(
+                browser_pool, url, Path(parts_dpath),
+                timeout=timeout, page_cache=page_cache)
+        elif shard_size is not None:
+            verbose_info(f'print {url} to {parts_dpath} (devtools)')
+            parts, timings = print_pdf_shards(
+                browser_pool, url, Path(parts_dpath),
+                timeout=timeout, shard_size=shard_size)
+        else:
+            verbose_info(f'print {url} to {tmp_pdf_fpath} (devtools)')
+            with browser_pool.acquire() as browser, \
+                 admit('chromium'), \
+                 stage('chromium') as record:
+                # The work happens in the browser process
+                record.update(cpu=None, max_rss=None)
+                timings = browser.print_pdf(url, tmp_pdf_fpath,
+                                            timeout=timeout)
+        if not dry_run:
+            timings['print'] = time.monotonic() - start
+            verbose_info(f'Printed {pdf_fpath}: {format_timings(timings)}')
+
+        docinfo = {}
+        for key in ["Title", "Author", "Subject"]:
+            value = meta.get(key.lower())
+            if value is not None:
+                docinfo[key] = value
+        docinfo['Creator'] = f'Slidefactory {VERSION}'
+
+        # Parts printed separately are merged keeping their links, and
+        # with ghostscript if their structure is not supported
+        if len(parts) > 1 and not dry_run:
+            merged_fpath = Path(parts_dpath) / 'merged.pdf'
+            verbose_info(f'merge {len(parts)} parts to {merged_fpath}')
+            try:
+                with stage('pdf-merge'):
+                    merge_pdfs(parts, merged_fpath)
+                parts = [merged_fpath]
+            except PdfError as exc:
+                info(f'Could not merge the parts of {pdf_fpath} ({exc}), '
+                     f'links between the parts are lost')
+
+        if len(parts) == 1 and optimize in ['none', 'metadata']:
+            tmp_pdf_fpath, = parts
+            verbose_info(f'cp {tmp_pdf_fpath} {pdf_fpath}')
+            if not dry_run:
+                shutil.copyfile(tmp_pdf_fpath, pdf_fpath)
+            if optimize == 'none':
+                return
+            verbose_info(f'write metadata to {pdf_fpath}')
+            if dry_run:
+                return
+            with stage('pdf-metadata'):
+                written = write_pdf_docinfo(pdf_fpath, docinfo)
+            if written:
+                return
+            verbose_info(f'Unsupported pdf structure in {tmp_pdf_fpath}, '
+                         f'using ghostscript to write metadata')
+
+        with tempfile.NamedTemporaryFile(
+                 dir=pdf_fpath.parent,
+                 prefix=f'{pdf_fpath.stem}-',
+                 suffix='.txt') \
+             as tmpfile:
+            pdfmark_fpath = Path(tmpfile.name)
+
+            pdfmark = '[ '
+            for key, value in docinfo.items():
+                pdfmark += f'/{key} ({value}) '
+            pdfmark += '/DOCINFO pdfmark'
+
+            verbose_info(f'write {pdfmark_fpath}')
+            verbose_info(f'{pdfmark}\n')
+            if not dry_run:
+                with open(pdfmark_fpath, 'w') as f:
+                    f.write(pdfmark)
+
+            run_args = [
+                'gs',
+                '-q',
+                '-dNOPAUSE',
+                '-dBATCH',
+                '-dSAFER',
+                '-sDEVICE=pdfwrite',
+                '-dCompatibilityLevel=1.4',
+                ]
+            if optimize == 'full':
+                run_args += [
+                    '-dPDFSETTINGS=/printer',
+                    '-dDownsampleColorImages=true',
+                    '-dColorImageResolution=300',
+                    '-dDownsampleGrayImages=true',
+                    '-dGrayImageResolution=300',
+                    '-dDownsampleMonoImages=true',
+                    '-dMonoImageResolution=300',
+                    ]
+            else:
+                # Only merge the parts, keeping the images as they are
+                run_args += GS_LOSSLESS_ARGS
+            run_args += [
+                '-dColorConversionStrategy=/LeaveColorUnchanged',
+                '-dPreserveAnnots=true',
+                '-dDetectDuplicateImages=true',
+                f'-sOutputFile={pdf_fpath}',
+                *[f'{fpath}' for fpath in parts],
+                ]
+            if optimize != 'none':
+                run_args += [f'{pdfmark_fpath}']
+            run(run_args)
+
+
+def pdf_text_string(value):
+    return '<FEFF' + str(value).encode('utf-16-be').hex().upper() + '>'
+
+
+def write_pdf_docinfo(pdf_fpath, docinfo):
+    """Set the document information by appending an incremental update
+
+    The entries of the existing document information (e.g., Producer and
+    CreationDate) are kept unless given in docinfo. Only files with classic
+    cross-reference tables (as written by chromium) are supported (see
+    PdfReader). Returns False if the file is left untouched.
+    """
+    try:
+        reader = PdfReader(pdf_fpath)
+        obj_num = int(reader.trailer[b'Size'])
+        info = reader.resolve(reader.trailer.get(b'Info'))
+    except (PdfError, KeyError, ValueError):
+        return False
+    info = dict(info) if isinstance(info, dict) else {}
+    for key, value in docinfo.items():
+        info[PdfName(key.encode())] = PdfRaw(pdf_text_string(value).encode())
+    trailer = {b'Size': PdfRaw(b'%d' % (obj_num + 1)),
+               b'Root': reader.trailer[b'Root'],
+               b'Info': PdfRef(obj_num, 0),
+               b'Prev': PdfRaw(b'%d' % reader.startxref)}
+    if b'ID' in reader.trailer:
+        trailer[b'ID'] = reader.trailer[b'ID']
+
+    size = len(reader.data)
+    update = b'' if reader.data.endswith(b'\n') else b'\n'
+    obj_offset = size + len(update)
+    update += b'%d 0 obj\n%s\nendobj\n' % (obj_num, pdf_serialize(info))
+    xref_offset = size + len(update)
+    update += (b'xref\n'
+               b'0 1\n'
+               b'0000000000 65535 f \n'
+               b'%d 1\n'
+               b'%010d 00000 n \n'
+               b'trailer\n'
+               b'%s\n'
+               b'startxref\n'
+               b'%d\n'
+               b'%%%%EOF\n') % (obj_num, obj_offset, pdf_serialize(trailer),
+                               xref_offset)
+
+    with open(pdf_fpath, 'ab') as f:
+        f.write(update)
+    return True
+
+
+class PdfError(Exception):
+    """Unsupported or invalid pdf structure"""
+
+
+class PdfName(bytes):
+    """Name object of a pdf (without the slash)"""
+
+
+class PdfRaw(bytes):
+    """Number, string, boolean, or null as written in a pdf"""
+
+
+PdfRef = namedtuple('PdfRef', ['num', 'gen'])
+
+PDF_SPACE = re.compile(rb'(?:[\0\t\n\f\r ]+|%[^\r\n]*)*')
+PDF_REGULAR = re.compile(rb'[^\0\t\n\f\r ()<>\[\]{}/%]*')
+PDF_REF = re.compile(rb'[\0\t\n\f\r ]+(\d+)[\0\t\n\f\r ]+R'
+                     rb'(?![^\0\t\n\f\r ()<>\[\]{}/%])')
+PDF_OBJ = re.compile(rb'[\0\t\n\f\r ]*(\d+)[\0\t\n\f\r ]+(\d+)'
+                     rb'[\0\t\n\f\r ]+obj')
+PDF_XREF_SECTION = re.compile(rb'(\d+)[\0\t\n\f\r ]+(\d+)')
+PDF_XREF_ENTRY = re.compile(rb'[\0\t\n\f\r ]*(\d{10}) (\d{5}) ([nf])')
+PDF_STRING_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b',
+                      b'f': b'\f', b'(': b'(', b')': b')', b'\\': b'\\',
+                      b'\n': b'', b'\r': b''}
+# Attributes that pages inherit from the page tree
+PDF_INHERITABLE = (b'Resources', b'MediaBox', b'CropBox', b'Rotate')
+
+
+def pdf_parse(data, pos):
+    """Parse the pdf object at pos and return it and the end position"""
+    pos = PDF_SPACE.match(data, pos).end()
+    try:
+        if data[pos] == ord('/'):
+            end = PDF_REGULAR.match(data, pos + 1).end()
+            return PdfName(data[pos + 1:end]), end
+        if data.startswith(b'<<', pos):
+            value = {}
+            pos += 2
+            while True:
+                pos = PDF_SPACE.match(data, pos).end()
+                if data.startswith(b'>>', pos):
+                    return value, pos + 2
+                key, pos = pdf_parse(data, pos)
+                if not isinstance(key, PdfName):
+                    raise PdfError(f'invalid dictionary key at {pos}')
+                value[key], pos = pdf_parse(data, pos)
+        if data[pos] == ord('['):
+            value = []
+            pos += 1
+            while True:
+                pos = PDF_SPACE.match(data, pos).end()
+                if data[pos] == ord(']'):
+                    return value, pos + 1
+                item, pos = pdf_parse(data, pos)
+                value.append(item)
+        if data[pos] == ord('('):
+            # Parentheses are balanced unless escaped
+            depth = 0
+            end = pos
+            while True:
+                if data[end] == ord('\\'):
+                    end += 1
+                elif data[end] == ord('('):
+                    depth += 1
+                elif data[end] == ord(')'):
+                    depth -= 1
+                    if depth == 0:
+                        return PdfRaw(data[pos:end + 1]), end + 1
+                end += 1
+        if data[pos] == ord('<'):
+            end = data.index(b'>', pos)
+            return PdfRaw(data[pos:end + 1]), end + 1
+    except (IndexError, ValueError) as exc:
+        raise PdfError(f'invalid object at {pos}: {exc}')
+    end = PDF_REGULAR.match(data, pos).end()
+    if end == pos:
+        raise PdfError(f'unexpected {data[pos:pos + 1]!r} at {pos}')
+    token = data[pos:end]
+    if token.isdigit():
+        m = PDF_REF.match(data, end)
+        if m is not None:
+            return PdfRef(int(token), int(m.group(1))), m.end()
+    return PdfRaw(token), end
+
+
+def pdf_serialize(value):
+    if isinstance(value, PdfName):
+        return b'/' + value
+    if isinstance(value, PdfRaw):
+        return bytes(value)
+    if isinstance(value, PdfRef):
+        return b'%d %d R' % value
+    if isinstance(value, dict):
+        return b'<< ' + b' '.join(b'/%s %s' % (key, pdf_serialize(item))
+                                  for key, item in value.items()) + b' >>'
+    if isinstance(value, list):
+        return b'[' + b' '.join(map(pdf_serialize, value)) + b']'
+    raise TypeError(f'cannot serialize {value!r}')
+
+
+def pdf_string_bytes(value):
+    """Return the bytes of a pdf string object"""
+    if value.startswith(b'<'):
+        digits = re.sub(rb'[^0-9A-Fa-f]', b'', value)
+        return bytes.fromhex((digits + b'0' * (len(digits) % 2)).decode())
+
+    def unescape(m):
+        if m.group(1)[:1].isdigit():
+            return bytes([int(m.group(1), 8) & 0xff])
+        return PDF_STRING_ESCAPES.get(m.group(1), m.group(1))
+
+    return re.sub(rb'\\([0-7]{1,3}|\r\n|.)', unescape, value[1:-1],
+                  flags=re.DOTALL)
+
+
+class PdfReader:
+    """Objects of a pdf with classic cross-reference tables
+
+    Files with cross-reference streams (and thus object streams) are not
+    supported; chromium and ghostscript write classic tables.
+    """
+
+    def __init__(self, fpath):
+        with open(fpath, 'rb') as f:
+            self.data = f.read()
+        m = re.match(rb'%PDF-(\d\.\d)', self.data)
+        if m is None:
+            raise PdfError('not a pdf file')
+        self.version = m.group(1).decode()
+        # The last startxref, after any incremental updates
+        m = None
+        for m in re.finditer(rb'startxref[\0\t\n\f\r ]+(\d+)'
+                             rb'[\0\t\n\f\r ]+%%EOF', self.data[-1024:]):
+            pass
+        if m is None:
+            raise PdfError('no startxref')
+        # Offsets of the objects (None if free) and the merged trailer,
+        # where the newer sections take precedence
+        self.offsets = {}
+        self.trailer = {}
+        self.startxref = int(m.group(1))
+        self.objects = {}
+        xref = self.startxref
+        seen = set()
+        while xref is not None:
+            if xref in seen:
+                raise PdfError('cross-reference sections form a loop')
+            seen.add(xref)
+            trailer = self._read_xref(xref)
+            if b'XRefStm' in trailer:
+                raise PdfError('cross-reference streams are not supported')
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            prev = trailer.get(b'Prev')
+            xref = None if prev is None else int(prev)
+
+    def _read_xref(self, pos):
+        pos = PDF_SPACE.match(self.data, pos).end()
+        if not self.data.startswith(b'xref', pos):
+            raise PdfError('cross-reference streams are not supported')
+        pos += 4
+        while True:
+            pos = PDF_SPACE.match(self.data, pos).end()
+            if self.data.startswith(b'trailer', pos):
+                trailer, _ = pdf_parse(self.data, pos + 7)
+                if not isinstance(trailer, dict):
+                    raise PdfError('invalid trailer')
+                return trailer
+            m = PDF_XREF_SECTION.match(self.data, pos)
+            if m is None:
+                raise PdfError(f'invalid cross-reference table at {pos}')
+            first, count = int(m.group(1)), int(m.group(2))
+            pos = m.end()
+            for num in range(first, first + count):
+                m = PDF_XREF_ENTRY.match(self.data, pos)
+                if m is None:
+                    raise PdfError(f'invalid cross-reference entry at {pos}')
+                pos = m.end()
+                offset = int(m.group(1)) if m.group(3) == b'n' else None
+                self.offsets.setdefault(num, offset)
+
+    def get(self, ref):
+        """Return the object of ref and its stream (or None)"""
+        if ref.num in self.objects:
+            return self.objects[ref.num]
+        offset = self.offsets.get(ref.num)
+        if offset is None:
+            return PdfRaw(b'null'), None
+        m = PDF_OBJ.match(self.data, offset)
+        if m is None or int(m.group(1)) != ref.num:
+            raise PdfError(f'object {ref.num} not found at {offset}')
+        value, pos = pdf_parse(self.data, m.end())
+        stream = None
+        pos = PDF_SPACE.match(self.data, pos).end()
+        if isinstance(value, dict) and self.data.startswith(b'stream', pos):
+            pos += 6
+            if self.data.startswith(b'\r\n', pos):
+                pos += 2
+            elif self.data.startswith(b'\n', pos):
+                pos += 1
+            try:
+                length = int(self.resolve(value.get(b'Length')))
+            except (TypeError, ValueError):
+                raise PdfError(f'invalid stream length in object {ref.num}')
+            stream = self.data[pos:pos + length]
+            end = PDF_SPACE.match(self.data, pos + length).end()
+            if not self.data.startswith(b'endstream', end):
+                raise PdfError(f'invalid stream length in object {ref.num}')
+        self.objects[ref.num] = value, stream
+        return value, stream
+
+    def resolve(self, value):
+        """Return the object of value if it is a reference"""
+        seen = set()
+        while isinstance(value, PdfRef):
+            if value in seen:
+                raise PdfError(f'reference loop at object {value.num}')
+            seen.add(value)
+            value = self.get(value)[0]
+        return value
+
+    def catalog(self):
+        catalog = self.resolve(self.trailer.get(b'Root'))
+        if not isinstance(catalog, dict):
+            raise PdfError('no document catalog')
+        return catalog
+
+    def pages(self):
+        """Return the references and objects of the pages in order
+
+        The objects include the attributes inherited from the page tree.
+        """
+        pages = []
+        self.page_tree = set()
+
+        def walk(ref, inherited):
+            if not isinstance(ref, PdfRef) or ref in self.page_tree:
+                raise PdfError('invalid page tree')
+            node = self.resolve(ref)
+            if not isinstance(node, dict):
+                raise PdfError('invalid page tree')
+            if node.get(b'Type') == b'Pages':
+                self.page_tree.add(ref)
+                inherited = dict(inherited)
+                inherited.update((key, node[key]) for key in PDF_INHERITABLE
+                                 if key in node)
+                for kid in self.resolve(node.get(b'Kids', [])):
+                    walk(kid, inherited)
+            else:
+                page = dict(inherited)
+                page.update(node)
+                pages.append((ref, page))
+
+        walk(self.catalog().get(b'Pages'), {})
+        return pages
+
+    def dests(self):
+        """Return the named destinations as {(kind, name): dest}
+
+        The kind is 'name' for the Dests dictionary of the catalog and
+        'string' for the Dests name tree.
+        """
+        catalog = self.catalog()
+        dests = {}
+        dests_dict = self.resolve(catalog.get(b'Dests'))
+        if isinstance(dests_dict, dict):
+            for name, dest in dests_dict.items():
+                dests[('name', name)] = dest
+        names = self.resolve(catalog.get(b'Names'))
+        if isinstance(names, dict):
+            seen = set()
+            nodes = [names.get(b'Dests')]
+            while nodes:
+                ref = nodes.pop()
+                if isinstance(ref, PdfRef):
+                    if ref in seen:
+                        raise PdfError('invalid name tree')
+                    seen.add(ref)
+                node = self.resolve(ref)
+                if not isinstance(node, dict):
+                    continue
+                nodes += self.resolve(node.get(b'Kids', []))
+                items = self.resolve(node.get(b'Names', []))
+                for key, dest in zip(items[::2], items[1::2]):
+                    dests[('string', key)] = dest
+        return dests
+
+    def dest_page(self, dest):
+        """Return the reference of the page of a destination, if any"""
+        dest = self.resolve(dest)
+        if isinstance(dest, dict):
+            dest = self.resolve(dest.get(b'D'))
+        if isinstance(dest, list) and dest and isinstance(dest[0], PdfRef):
+            return dest[0]
+        return None
+
+
+class PdfWriter:
+    """Pdf written from objects copied from other pdfs"""
+
+    def __init__(self, version='1.4'):
+        self.version = version
+        self.objects = []
+
+    def reserve(self):
+        self.objects.append(None)
+        return PdfRef(len(self.objects), 0)
+
+    def set(self, ref, value, stream=None):
+        self.objects[ref.num - 1] = value, stream
+
+    def add(self, value, stream=None):
+        ref = self.reserve()
+        self.set(ref, value, stream)
+        return ref
+
+    def write(self, fpath, *, root, info=None):
+        offsets = []
+        with open(fpath, 'wb') as f:
+            f.write(b'%%PDF-%s\n%%\xe2\xe3\xcf\xd3\n' % self.version.encode())
+            for num, (value, stream) in enumerate(self.objects, 1):
+                offsets.append(f.tell())
+                f.write(b'%d 0 obj\n%s\n' % (num, pdf_serialize(value)))
+                if stream is not None:
+                    f.write(b'stream\n%s\nendstream\n' % stream)
+                f.write(b'endobj\n')
+            xref = f.tell()
+            f.write(b'xref\n0 %d\n0000000000 65535 f \n'
+                    % (len(offsets) + 1))
+            f.write(b''.join(b'%010d 00000 n \n' % offset
+                             for offset in offsets))
+            trailer = {b'Size': PdfRaw(b'%d' % (len(offsets) + 1)),
+                       b'Root': root}
+            if info is not None:
+                trailer[b'Info'] = info
+            f.write(b'trailer\n%s\nstartxref\n%d\n%%%%EOF\n'
+                    % (pdf_serialize(trailer), xref))
+
+
+class PdfCopier:
+    """Copy objects of a pdf to a writer, renumbering their references
+
+    References to the given pages are replaced with those of the copies,
+    and references to the other pages and to the page tree with null.
+    """
+
+    def __init__(self, reader, writer, pages):
+        self.reader = reader
+        self.writer = writer
+        self.refs = {ref: None for ref, _ in reader.pages()}
+        self.refs.update((ref, None) for ref in reader.page_tree)
+        self.refs.update((ref, writer.reserve()) for ref, _ in pages)
+        self.queue = []
+
+    def rewrite(self, value):
+        if isinstance(value, dict):
+            return {key: self.rewrite(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.rewrite(item) for item in value]
+        if isinstance(value, PdfRef):
+            if value not in self.refs:
+                self.refs[value] = self.writer.reserve()
+                self.queue.append(value)
+            new_ref = self.refs[value]
+            return PdfRaw(b'null') if new_ref is None else new_ref
+        return value
+
+    def flush(self):
+        """Copy the objects referenced so far"""
+        while self.queue:
+            ref = self.queue.pop()
+            value, stream = self.reader.get(ref)
+            value = self.rewrite(value)
+            if stream is not None:
+                value[b'Length'] = PdfRaw(b'%d' % len(stream))
+            self.writer.set(self.refs[ref], value, stream)
+
+
+def write_pdf_pages(sources, pdf_fpath):
+    """Write the pages of sources, a list of (reader, pages), to pdf_fpath
+
+    The page objects and their resources are copied without changing
+    their content. The named destinations on the pages are merged, so
+    links between the sources are kept. The document information is
+    taken from the first source.
+    """
+    writer = PdfWriter(max(reader.version for reader, _ in sources))
+    pages_ref = writer.reserve()
+    kids = []
+    dests = {}
+    info = None
+    for reader, pages in sources:
+        copier = PdfCopier(reader, writer, pages)
+        for ref, page in pages:
+            # Tagged pdf structure is not copied
+            page = {key: value for key, value in page.items()
+                    if key not in [b'Parent', b'StructParents']}
+            page = copier.rewrite(page)
+            page[b'Parent'] = pages_ref
+            writer.set(copier.refs[ref], page)
+            kids.append(copier.refs[ref])
+        page_refs = {ref for ref, _ in pages}
+        for key, dest in reader.dests().items():
+            if key not in dests and reader.dest_page(dest) in page_refs:
+                dests[key] = copier.rewrite(reader.resolve(dest))
+        if info is None:
+            info = reader.resolve(reader.trailer.get(b'Info'))
+            info = copier.rewrite(info) if isinstance(info, dict) else {}
+        copier.flush()
+
+    writer.set(pages_ref, {b'Type': PdfName(b'Pages'), b'Kids': kids,
+                           b'Count': PdfRaw(b'%d' % len(kids))})
+    catalog = {b'Type': PdfName(b'Catalog'), b'Pages': pages_ref}
+    name_dests = {name: dest for (kind, name), dest in dests.items()
+                  if kind == 'name'}
+    if name_dests:
+        catalog[b'Dests'] = writer.add(name_dests)
+    string_dests = sorted(((name, dest) for (kind, name), dest
+                           in dests.items() if kind == 'string'),
+                          key=lambda item: pdf_string_bytes(item[0]))
+    if string_dests:
+        catalog[b'Names'] = {b'Dests': writer.add(
+            {b'Names': [value for item in string_dests for value in item]})}
+    writer.write(pdf_fpath, root=writer.add(catalog),
+                 info=writer.add(info) if info else None)
+
+
+def merge_pdfs(fpaths, pdf_fpath):
+    """Merge the pages of the pdfs in fpaths into pdf_fpath
+
+    Raises PdfError if a file is not supported (see PdfReader).
+    """
+    sources = []
+    for fpath in fpaths:
+        reader = PdfReader(fpath)
+        sources.append((reader, reader.pages()))
+    write_pdf_pages(sources, pdf_fpath)
+
+
+def split_pdf(pdf_fpath, dpath):
+    """Split pdf_fpath into dpath/0001.pdf, dpath/0002.pdf, ...
+
+    Each page keeps the named destinations on it (see write_pdf_pages).
+    Returns the number of pages.
+    """
+    reader = PdfReader(pdf_fpath)
+    pages = reader.pages()
+    for i, page in enumerate(pages, 1):
+        write_pdf_pages([(reader, [page])], dpath / f'{i:04d}.pdf')
+    return len(pages)
+
+
+def get_file_size(fpath):
+    """Return the size of fpath, or 0 if it does not exist"""
+    try:
+        return fpath.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def hash_file(fpath):
+    h = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BuildCache:
+    """Persistent cache of converted presentations
+
+    Entries are keyed on a hash of the conversion inputs. The linked files
+    are found only after conversion, so their hashes are stored in the entry
+    and validated on lookup. Least recently used entries are evicted when
+    the cache exceeds its size limit. The size of the cache is scanned once
+    and then kept up to date with the stored entries (entries stored by
+    other builds are counted at the next eviction).
+    """
+
+    def __init__(self, dpath, max_size):
+        self.dpath = dpath
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.size = None
+
+    def _paths(self, key):
+        entry_dpath = self.dpath / key[:2]
+        return entry_dpath / f'{key}.out', entry_dpath / f'{key}.json'
+
+    def lookup(self, key, input_dpath):
+        """Return cached output path and linked files, or None"""
+        out_fpath, deps_fpath = self._paths(key)
+        try:
+            with open(deps_fpath, 'r') as f:
+                deps = json.load(f)
+            for fname, chk in deps['externals'].items():
+                if hash_file(input_dpath / fname) != chk:
+                    return None
+            if not out_fpath.is_file():
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            # Mark entry as recently used
+            os.utime(deps_fpath)
+        except OSError:
+            pass
+        return out_fpath, set(deps['externals'])
+
+    def store(self, key, fpath, externals, input_dpath, *, evict=True):
+        """Store fpath, or only warn if the cache is not writable"""
+        out_fpath, deps_fpath = self._paths(key)
+        try:
+            deps = dict(externals={fname: hash_file(input_dpath / fname)
+                                   for fname in sorted(externals)})
+            out_fpath.parent.mkdir(parents=True, exist_ok=True)
+            replaced_size = sum(get_file_size(p)
+                                for p in [out_fpath, deps_fpath])
+            with tempfile.TemporaryDirectory(dir=self.dpath,
+                                             prefix='.tmp-') as tmp_dpath:
+                tmp_out_fpath = Path(tmp_dpath) / out_fpath.name
+                tmp_deps_fpath = Path(tmp_dpath) / deps_fpath.name
+                shutil.copyfile(fpath, tmp_out_fpath)
+                with open(tmp_deps_fpath, 'w') as f:
+                    json.dump(deps, f)
+                # Entry is valid once its deps file exists
+                os.replace(tmp_out_fpath, out_fpath)
+                os.replace(tmp_deps_fpath, deps_fpath)
+            stored_size = sum(get_file_size(p)
+                              for p in [out_fpath, deps_fpath])
+        except OSError as exc:
+            info(f'Warning: could not store {fpath} in the cache '
+                 f'{self.dpath}: {exc}')
+            return
+        with self.lock:
+            if self.size is not None:
+                self.size += stored_size - replaced_size
+        if evict:
+            self.evict()
+
+    def _scan(self):
+        """Return the entries by time of use and their total size"""
+        entries = []
+        total_size = 0
+        for deps_fpath in self.dpath.glob('[!.]*/*.json'):
+            out_fpath = deps_fpath.with_suffix('.out')
+            try:
+                stat = deps_fpath.stat()
+                size = stat.st_size + out_fpath.stat().st_size
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, deps_fpath))
+            total_size += size
+        return sorted(entries), total_size
+
+    def evict(self):
+        """Evict entries if the cache exceeds its size limit"""
+        with self.lock:
+            if self.size is not None and self.size <= self.max_size:
+                return
+            entries, total_size = self._scan()
+            for _, deps_fpath in entries:
+                if total_size <= self.max_size:
+                    break
+                out_fpath = deps_fpath.with_suffix('.out')
+                verbose_info(f'Evict {deps_fpath.stem} from cache')
+                try:
+                    total_size -= (deps_fpath.stat().st_size
+                                   + out_fpath.stat().st_size)
+                    deps_fpath.unlink()
+                    out_fpath.unlink()
+                except OSError:
+                    pass
+            self.size = total_size
+
+
+class PageCache:
+    """Printed pdf pages of a presentation kept in the build cache
+
+    Pages are keyed on their html as laid out for printing (including
+    slide numbers), the classes and style sheets of the document (see
+    PAGES_EXPRESSION), and the theme, so that only the pages whose content
+    or layout changed are printed again.
+    The linked files shown on a page are validated as for presentations.
+    """
+
+    def __init__(self, cache, context, input_dpath, externals):
+        self.cache = cache
+        self.context = context
+        self.input_dpath = input_dpath
+        self.externals = externals
+
+    def get_key(self, document_context, page_html):
+        h = hashlib.sha256()
+        for value in [VERSION, CHECKSUM, 'pdf-page', self.context,
+                      document_context, page_html]:
+            h.update(repr(value).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def lookup(self, key):
+        cached = self.cache.lookup(key, self.input_dpath)
+        return None if cached is None else cached[0]
+
+    def store(self, key, fpath, page_html):
+        sources = get_html_sources(page_html)
+        externals = [fname for fname in self.externals
+                     if fname in sources or urlquote(fname) in sources]
+        self.cache.store(key, fpath, externals, self.input_dpath,
+                         evict=False)
+
+    def evict(self):
+        self.cache.evict()
+
+
+def get_build_cache(args):
+    if args.no_cache or args.dry_run:
+        return None
+    return BuildCache(args.cache_dir, args.cache_size * 1024**2)
+
+
+class ImageOptimizer:
+    """Downscale and re-encode raster images to fit the slide size
+
+    Results are cached by content hash and size so that each image is
+    processed only once. Images that do not get smaller are used as is.
+    """
+
+    def __init__(self, dpath, width, height):
+        self.dpath = dpath
+        self.size = (width, height)
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def __call__(self, fpath):
+        """Return the path of the optimized image"""
+        if fpath.suffix.lower() not in RASTER_SUFFIXES:
+            return fpath
+
+        with stage('images'):
+            return self._optimize(fpath)
+
+    def _optimize(self, fpath):
+
+        key = hashlib.sha256(
+            f'{hash_file(fpath)} {self.size} {VERSION}'.encode()).hexdigest()
+        out_fpath = self.dpath / key[:2] / f'{key}{fpath.suffix.lower()}'
+        skip_fpath = out_fpath.with_suffix('.skip')
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if skip_fpath.exists():
+                return fpath
+            if not out_fpath.exists():
+                out_fpath.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    optimized = self.optimize(fpath, out_fpath)
+                except (OSError, ValueError) as exc:
+                    verbose_info(f'Cannot optimize {fpath}: {exc}')
+                    optimized = False
+                if not optimized:
+                    skip_fpath.touch()
+                    return fpath
+        return out_fpath
+
+    def optimize(self, fpath, out_fpath):
+        from PIL import Image, ImageOps
+
+        with Image.open(fpath) as im:
+            if getattr(im, 'n_frames', 1) > 1:
+                return False
+            save_kwargs = dict(format=im.format)
+            if 'icc_profile' in im.info:
+                save_kwargs['icc_profile'] = im.info['icc_profile']
+            if im.format == 'JPEG':
+                save_kwargs.update(quality=85, optimize=True,
+                                   progressive=True)
+            elif im.format == 'PNG':
+                save_kwargs.update(optimize=True)
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail(self.size, Image.LANCZOS)
+
+            tmp_fpath = out_fpath.with_name(
+                f'.{out_fpath.name}.{os.getpid()}.{threading.get_ident()}')
+            try:
+                im.save(tmp_fpath, **save_kwargs)
+                if tmp_fpath.stat().st_size >= fpath.stat().st_size:
+                    return False
+                verbose_info(f'Optimized {fpath} '
+                             f'({fpath.stat().st_size // 1024} kB to '
+                             f'{tmp_fpath.stat().st_size // 1024} kB)')
+                os.replace(tmp_fpath, out_fpath)
+            finally:
+                tmp_fpath.unlink(missing_ok=True)
+        return True
+
+
+def get_image_optimizer(args):
+    if not args.optimize_images or args.dry_run:
+        return None
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        error('Optimizing images requires Pillow (python3-pil).')
+
+    defaults_fpath = getattr(args, 'defaults_fpath', None) \
+        or get_default_url('defaults_fpath', 'html', args.theme)
+    with open(defaults_fpath) as f:
+        variables = next(yaml.safe_load_all(f)).get('variables', {})
+    width = int(variables.get('width', 1920))
+    height = int(variables.get('height', 1080))
+    return ImageOptimizer(args.cache_dir / 'images', width, height)
+
+
+def get_default_cache_dpath():
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME')
+    if xdg_cache_home:
+        return Path(xdg_cache_home) / 'slidefactory'
+    return Path.home() / '.cache' / 'slidefactory'
+
+
+def get_cache_key(conversion, html_kwargs):
+    in_fpath, out_fpath, args = conversion
+    h = hashlib.sha256()
+
+    def update(*values):
+        for value in values:
+            h.update(repr(value).encode())
+            h.update(b'\0')
+
+    # Linked files in html refer to the shared assets relative to the output
+    assets_dpath = html_kwargs['assets_dpath']
+    if assets_dpath is not None:
+        assets_dpath = os.path.relpath(assets_dpath, out_fpath.parent)
+    update(VERSION, CHECKSUM, args.format, args.pdf_optimize, assets_dpath,
+           html_kwargs['image_optimizer'] is not None,
+           sorted(html_kwargs['pandoc_vars'].items()),
+           html_kwargs['pandoc_args'])
+    fpaths = [in_fpath,
+              html_kwargs['defaults_fpath'],
+              html_kwargs['template_fpath'],
+              *html_kwargs['filters'],
+              *sorted(p for p in args.theme.dpath.rglob('*') if p.is_file()),
+              ]
+    # Paths relative to the theme or the input directory so that moved
+    # or renamed checkouts still hit
+    theme_dpath = Path(os.path.abspath(args.theme.dpath))
+    for fpath in fpaths:
+        abs_fpath = Path(os.path.abspath(fpath))
+        if abs_fpath.is_relative_to(theme_dpath):
+            name = ('theme', abs_fpath.relative_to(theme_dpath).as_posix())
+        else:
+            name = os.path.relpath(abs_fpath, in_fpath.parent.absolute())
+        update(name, hash_file(fpath))
+    return h.hexdigest()
+
+
+def get_crc32(fpath):
+    crc = 0
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+class SlidesArchive:
+    """Zip archive of converted slides that is written as they finish
+
+    Already compressed formats (like pdf) are stored without compression.
+    An existing archive is updated incrementally: entries of unchanged files
+    (by size and checksum) are kept as they are, and replaced entries leave
+    unused space behind, which is reclaimed by rewriting the archive when
+    it takes more than half of the file. Changes are made to a staged copy
+    (a reflink where supported) that replaces the archive when closed.
+    """
+
+    def __init__(self, zip_fpath, root_dpath):
+        self.zip_fpath = zip_fpath
+        self.root_dpath = root_dpath
+        self.zip = None
+        self.staged_fpath = zip_fpath.with_name(f'.{zip_fpath.name}.tmp')
+        self.entries = {}
+        self.added = set()
+        self.written = False
+        self.removed = False
+        try:
+            with zipfile.ZipFile(zip_fpath) as zf:
+                self.entries = {zinfo.filename: zinfo
+                                for zinfo in zf.infolist()}
+        except (OSError, zipfile.BadZipFile):
+            pass
+
+    def open(self):
+        """Open the staged copy for writing"""
+        if self.zip is None:
+            self.staged_fpath.unlink(missing_ok=True)
+            if self.entries:
+                publish_file(self.zip_fpath, self.staged_fpath,
+                             link_mode='reflink')
+                self.zip = zipfile.ZipFile(self.staged_fpath, 'a')
+            else:
+                self.zip = zipfile.ZipFile(self.staged_fpath, 'w')
+        return self.zip
+
+    def add(self, fpath):
+        arcname = fpath.relative_to(self.root_dpath).as_posix()
+        self.added.add(arcname)
+        zinfo = zipfile.ZipInfo.from_file(fpath, arcname)
+        old_zinfo = self.entries.get(arcname)
+        if old_zinfo is not None:
+            # Reading is cheap compared to writing the entry again
+            if old_zinfo.file_size == zinfo.file_size \
+               and not old_zinfo.comment \
+               and old_zinfo.CRC == get_crc32(fpath):
+                return
+            self.remove(arcname)
+
+        if fpath.suffix.lower() in COMPRESSED_SUFFIXES:
+            zinfo.compress_type = zipfile.ZIP_STORED
+        else:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+        verbose_info(f'Add {arcname} to {self.zip_fpath}')
+        with open(fpath, 'rb') as src, self.open().open(zinfo, 'w') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        self.entries[arcname] = zinfo
+        self.written = True
+
+    def remove(self, arcname):
+        zf = self.open()
+        zf.filelist.remove(zf.NameToInfo.pop(arcname))
+        del self.entries[arcname]
+        self.removed = True
+
+    def close(self):
+        """Finish the archive; returns True if it was changed"""
+        try:
+            # Add files that were not converted in this run
+            # and drop entries of files that no longer exist
+            for fpath in sorted(self.root_dpath.rglob('*')):
+                arcname = fpath.relative_to(self.root_dpath).as_posix()
+                if fpath.is_file() and arcname not in self.added:
+                    self.add(fpath)
+            for arcname in list(self.entries):
+                if arcname not in self.added:
+                    self.remove(arcname)
+
+            if self.zip is None and self.zip_fpath.exists():
+                return False
+            # The central directory is rewritten only if entries were written
+            self.open().close()
+            if self.removed and (not self.written
+                                 or self.unused_fraction() > 0.5):
+                self.compact()
+            os.replace(self.staged_fpath, self.zip_fpath)
+            return True
+        finally:
+            if self.zip is not None:
+                self.zip.close()
+            self.staged_fpath.unlink(missing_ok=True)
+
+    def abort(self):
+        """Discard the changes"""
+        if self.zip is not None:
+            self.zip.close()
+            self.zip = None
+        self.staged_fpath.unlink(missing_ok=True)
+
+    def unused_fraction(self):
+        size = self.staged_fpath.stat().st_size
+        with zipfile.ZipFile(self.staged_fpath) as zf:
+            # Local headers, data, and the central directory
+            used = sum(30 + len(zinfo.filename.encode()) + len(zinfo.extra)
+                       + zinfo.compress_size for zinfo in zf.infolist())
+            used += size - zf.start_dir
+        return 1 - used / size
+
+    def compact(self):
+        verbose_info(f'Rewrite {self.zip_fpath}')
+        names = set(self.entries)
+        tmp_fpath = self.staged_fpath.with_suffix('.compact')
+        try:
+            with zipfile.ZipFile(self.staged_fpath) as src, \
+                 zipfile.ZipFile(tmp_fpath, 'w') as dst:
+                for zinfo in src.infolist():
+                    if zinfo.filename not in names:
+                        continue
+                    with src.open(zinfo) as fsrc, \
+                         dst.open(zinfo, 'w') as fdst:
+                        shutil.copyfileobj(fsrc, fdst, 1 << 20)
+            os.replace(tmp_fpath, self.staged_fpath)
+        finally:
+            tmp_fpath.unlink(missing_ok=True)
+
+
+class BuildManifest:
+    """Outputs of a pages build and the inputs they were built from
+
+    The manifest is stored in the cache directory, outside the published
+    site (see get_manifest_fpath), so that `pages --update` can skip
+    up-to-date outputs of the output directory dpath and remove stale ones.
+    Outputs are keyed by their path relative to the output directory and
+    record the cache key of the conversion, the hashes of the linked
+    files, and the files published for them.
+    """
+
+    # Manifest in the output directory, as written by earlier versions
+    OLD_NAME = '.slidefactory-manifest.json'
+    VERSION = 1
+
+    def __init__(self, dpath, fpath, *, assets_dpath=None,
+                 fallback_fpaths=()):
+        self.dpath = dpath
+        self.fpath = fpath
+        self.assets_dpath = assets_dpath
+        self.lock = threading.Lock()
+        self.old = dict(outputs={}, hashes={})
+        self.outputs = {}
+        self.hashes = {}
+        # The previous build is read from the first of fallback_fpaths
+        # that exists if there is no manifest at fpath
+        for fpath in [fpath, *fallback_fpaths]:
+            try:
+                with open(fpath) as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self.old = data
+                break
+            except (OSError, ValueError):
+                pass
+
+    def lookup(self, out_fpath, key, in_fpath):
+        """Return the linked files if out_fpath is up to date"""
+        entry = self.old['outputs'].get(self.relpath(out_fpath))
+        if entry is None or entry['key'] != key or not out_fpath.exists():
+            return None
+        for fname, digest in entry['externals'].items():
+            fpath = in_fpath.parent / fname
+            if not fpath.exists() or hash_file(fpath) != digest:
+                return None
+        for rel_fpath in entry['published'] + entry.get('bundled', []):
+            if not (self.dpath / rel_fpath).exists():
+                return None
+        return list(entry['externals'])
+
+    def record(self, out_fpath, key, in_fpath, externals, *, bundled=None):
+        """Record out_fpath as built
+
+        The bundled files (see AssetBundler) of the previous build are kept
+        unless given.
+        """
+        if bundled is None:
+            entry = self.old['outputs'].get(self.relpath(out_fpath), {})
+            bundled = entry.get('bundled', [])
+        else:
+            bundled = [self.relpath(fpath) for fpath in bundled]
+        externals = {fname: hash_file(in_fpath.parent / fname)
+                     for fname in externals or []}
+        published = []
+        if out_fpath.suffix == '.html' \
+           and in_fpath.parent.resolve() != out_fpath.parent.resolve():
+            for fname, digest in externals.items():
+                if self.assets_dpath is None:
+                    fpath = out_fpath.parent / fname
+                else:
+                    fpath = self.assets_dpath / \
+                        get_asset_name(Path(fname), digest)
+                published.append(self.relpath(fpath))
+        with self.lock:
+            self.outputs[self.relpath(out_fpath)] = dict(
+                key=key, externals=externals, published=published,
+                bundled=bundled)
+
+    def relpath(self, fpath):
+        return os.path.relpath(fpath, self.dpath)
+
+    def merge(self, fpath):
+        """Take the completed outputs recorded in the manifest at fpath"""
+        try:
+            with open(fpath) as f:
+                data = json.load(f)
+            if data.get('version') != self.VERSION:
+                raise ValueError('unsupported version')
+            outputs = data['outputs']
+        except (OSError, ValueError, KeyError) as exc:
+            raise BuildError(f'Cannot read manifest {fpath}: {exc}')
+        with self.lock:
+            self.outputs.update({rel_fpath: entry for rel_fpath, entry
+                                 in outputs.items()
+                                 if entry['key'] is not None})
+
+    def is_recorded(self, out_fpath):
+        return self.relpath(out_fpath) in self.outputs
+
+    def is_current(self, name, digest):
+        return self.old['hashes'].get(name) == digest
+
+    def set_hash(self, name, digest):
+        self.hashes[name] = digest
+
+    def stale_fpaths(self):
+        """Return the files of the previous build not produced by this one"""
+        def files(outputs):
+            fpaths = set(outputs)
+            for entry in outputs.values():
+                fpaths.update(entry['published'])
+                fpaths.update(entry.get('bundled', []))
+            return fpaths
+
+        return sorted(self.dpath / rel_fpath for rel_fpath
+                      in files(self.old['outputs']) - files(self.outputs))
+
+    def save(self, *, complete=True):
+        """Store the manifest
+
+        Unless the build is complete, the outputs of the previous build
+        that were not converted are kept, marked to be converted again.
+        """
+        outputs = {}
+        if not complete:
+            outputs = {rel_fpath: dict(entry, key=None) for rel_fpath, entry
+                       in self.old['outputs'].items()}
+        outputs.update(self.outputs)
+        data = dict(version=self.VERSION, outputs=outputs,
+                    hashes=self.hashes)
+        self.fpath.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=self.fpath.parent,
+                                         prefix='.tmp-', delete=False) as f:
+            json.dump(data, f)
+        os.replace(f.name, self.fpath)
+
+
+def get_manifest_fpath(args):
+    """Return the path of the manifest of the output directory of args"""
+    digest = hashlib.sha256(str(args.output.resolve()).encode()).hexdigest()
+    return args.cache_dir / 'manifests' / f'{digest[:32]}.json'
+
+
+def get_shard_manifest_name(index, count):
+    # The shards may run on hosts that do not share the cache directory,
+    # so their manifests are kept in the output directory until merged
+    return f'.slidefactory-manifest.shard-{index}-of-{count}.json'
+
+
+def select_shard(conversions, index, count):
+    """Return the conversions of shard index (from 1) of count
+
+    Presentations are assigned by a hash of their path, so that all
+    shards agree on the assignment and adding or removing presentations
+    does not move the others to another shard.
+    """
+    def shard_of(conversion):
+        digest = hashlib.sha256(str(conversion.in_fpath).encode()).digest()
+        return int.from_bytes(digest[:8], 'big') % count + 1
+
+    return [c for c in conversions if shard_of(c) == index]
+
+
+def hash_tree(dpath):
+    h = hashlib.sha256()
+    for fpath in sorted(p for p in dpath.rglob('*') if p.is_file()):
+        h.update(f'{fpath.relative_to(dpath)}\0{hash_file(fpath)}\0'
+                 .encode())
+    return h.hexdigest()
+
+
+def replace_tree(src_dpath, tgt_dpath):
+    """Replace tgt_dpath with a copy of src_dpath"""
+    staged_dpath = tgt_dpath.with_name(f'.{tgt_dpath.name}.tmp')
+    old_dpath = tgt_dpath.with_name(f'.{tgt_dpath.name}.old')
+    for dpath in [staged_dpath, old_dpath]:
+        shutil.rmtree(dpath, ignore_errors=True)
+    shutil.copytree(src_dpath, staged_dpath)
+    if tgt_dpath.exists():
+        os.rename(tgt_dpath, old_dpath)
+    os.rename(staged_dpath, tgt_dpath)
+    shutil.rmtree(old_dpath, ignore_errors=True)
+
+
+def create_index_page(fpath, title, info_content, html_content, pdf_content):
+    with fpath.open("w") as fd:
+        csc_ui_version = '2.1.11'
+        fd.write(f"""
+<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8" />
+  <title>{title}</title>
+  <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/@cscfi/csc-ui@{csc_ui_version}/dist/styles/css/theme.css" />
+</head>
+<body>
+<c-main>
+  <c-toolbar>
+    <c-csc-logo></c-csc-logo>
+    {title}
+  </c-toolbar>
+
+  <c-page>
+
+    <c-card>
+      <c-card-title>About</c-card-title>
+      <c-card-content>
+        <div>
+{info_content}
+        </div>
+      </c-card-content>
+    </c-card>
+
+    <br>
+
+    <c-card>
+      <c-card-title>Slides (HTML)</c-card-title>
+      <c-card-content>
+{html_content}
+      </c-card-content>
+    </c-card>
+
+    <br>
+
+    <c-card>
+      <c-card-title>Slides (PDF)</c-card-title>
+      <c-card-content>
+{pdf_content}
+      </c-card-content>
+    </c-card>
+
+  </c-page>
+</c-main>
+<script src="https://cdn.jsdelivr.net/npm/@cscfi/csc-ui@{csc_ui_version}/dist/csc-ui/csc-ui.esm.js" type="module"></script>
+""".strip("\n"))  # noqa: E501
+        fd.write("""
+<script>
+  const accordions = document.querySelectorAll("c-accordion");
+  accordions.forEach((accordion) => {
+    accordion.value = [];
+    accordion.multiple = true;
+  });
+</script>
+</body>
+</html>
+""".strip("\n"))  # noqa: E501
+
+
+def build_content(fpath, page_theme_fpath, args, conversions, *,
+                  line_fmt='{}'):
+    info(f'Process {fpath}')
+    metadata = read_about(fpath)
+
+    title = metadata["title"]
+    content = ""
+
+    if "modules" in metadata:
+        content += '<c-accordion>\n'
+        for module in metadata["modules"]:
+            mod_fpath = fpath.parent / module / fpath.name
+            mod_title, mod_content = \
+                build_content(mod_fpath, page_theme_fpath, args, conversions,
+                              line_fmt='<p>{}</p>')
+            content += f'<c-accordion-item heading="{mod_title}" value="{module}">\n'  # noqa: E501
+            content += mod_content
+            content += '</c-accordion-item>\n'
+        content += '</c-accordion>\n'
+    else:
+        assert "slidesdir" in metadata
+        slides_dpath = fpath.parent / metadata["slidesdir"]
+        for md_fpath in sorted(slides_dpath.glob("*.md")):
+            meta = read_slides_metadata(md_fpath)
+            html_name = md_fpath.with_suffix(".html").name
+            html_fpath = 'html' / fpath.parent / html_name
+            slides_title = meta["title"]
+            m = re.search(r'^\d+', html_name)
+            prefix = '' if m is None else f'{int(m.group())}.'
+            content += line_fmt.format(f'<c-link href="{html_fpath}" target="_blank">{prefix} {slides_title}</c-link>')  # noqa: E501
+            content += '\n'
+
+            # Collect slides to be converted
+            formats = ['html']
+            if args.with_pdf:
+                formats += ['pdf']
+            for fmt in formats:
+                args_slides = copy.copy(args)
+                args_slides.input = [md_fpath]
+                args_slides.output = args.output / fmt / fpath.parent
+                args_slides.format = [fmt]
+                if fmt == 'html':
+                    theme_url = os.path.relpath(page_theme_fpath,
+                                                html_fpath.parent)
+                    args_slides.theme_url = theme_url
+                    if args.shared_assets:
+                        args_slides.assets_dpath = \
+                            args.output / 'html' / 'assets'
+                    if args.bundle_assets:
+                        # Use local resources for offline pages
+                        for key in ['revealjs_url', 'mathjax_url',
+                                    'fonts_url']:
+                            if getattr(args, key, None) is None:
+                                setattr(args_slides, key, get_default_url(
+                                    key, 'html-local', args.theme))
+                        args_slides.bundle_dpath = \
+                            args.output / 'html' / 'assets'
+                conversions += get_conversions(args_slides)
+
+    return title, content
+
+
+class MetadataIndex:
+    """Parsed metadata of presentations and about.yml files
+
+    Entries are keyed by path and stay valid while the modification time
+    and size of the file, or otherwise its hash, are unchanged. The index
+    is stored as JSON in the cache directory so that later builds do not
+    re-read and re-parse unchanged files.
+    """
+
+    VERSION = 1
+
+    def __init__(self, fpath=None):
+        self.fpath = fpath
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.modified = False
+        if fpath is not None:
+            try:
+                with open(fpath) as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self.entries = data['entries']
+            except (OSError, ValueError, KeyError, AttributeError):
+                pass
+
+    def get(self, fpath, parse):
+        key = str(Path(fpath).absolute())
+        st = os.stat(fpath)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry['parser'] == parse.__name__ \
+           and (entry['mtime_ns'], entry['size']) \
+           == (st.st_mtime_ns, st.st_size):
+            return copy.deepcopy(entry['data'])
+
+        digest = hash_file(fpath)
+        if entry is not None and entry['parser'] == parse.__name__ \
+           and entry['hash'] == digest:
+            data = entry['data']
+        else:
+            # Store as JSON would (e.g., dates as strings)
+            data = json.loads(json.dumps(parse(fpath), default=str))
+        with self.lock:
+            self.entries[key] = dict(parser=parse.__name__,
+                                     mtime_ns=st.st_mtime_ns,
+                                     size=st.st_size,
+                                     hash=digest,
+                                     data=data)
+            self.modified = True
+        return copy.deepcopy(data)
+
+    def save(self):
+        """Store the entries, keeping those of other builds"""
+        if self.fpath is None or not self.modified:
+            return
+        entries = MetadataIndex(self.fpath).entries
+        entries.update(self.entries)
+        # Forget the files that no longer exist
+        entries = {key: entry for key, entry in entries.items()
+                   if os.path.exists(key)}
+        # The index is only an optimization of later runs
+        try:
+            self.fpath.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                    'w', dir=self.fpath.parent, prefix='.tmp-',
+                    delete=False) as f:
+                json.dump(dict(version=self.VERSION, entries=entries), f)
+            os.replace(f.name, self.fpath)
+        except OSError as exc:
+            verbose_info(f'Could not store metadata index to '
+                         f'{self.fpath}: {exc}')
+
+# Metadata index of the running conversions (see conversion_context)
+metadata_index = None
+
+
+def read_metadata(fpath, parse):
+    with stage('metadata'):
+        if metadata_index is None:
+            return parse(fpath)
+        return metadata_index.get(fpath, parse)
+
+
+def read_slides_metadata(fpath):
+    return read_metadata(fpath, parse_slides_metadata)
+
+
+def read_about(fpath):
+    return read_metadata(fpath, parse_about)
+
+
+def parse_about(fpath):
+    with fpath.open() as fd:
+        return yaml.safe_load(fd)
+
+
+def parse_slides_metadata(fpath):
+    lines = []
+    with fpath.open() as fd:
+        for line in fd:
+            if line.strip() == "---":
+                break
+        for line in fd:
+            if line.strip() == "---":
+                break
+            lines.append(line)
+    data = "".join(lines)
+    if data == "":
+        raise BuildError(f"{fpath} missing metadata")
+    try:
+        data = yaml.safe_load(data)
+        if not isinstance(data, dict):
+            raise BuildError(f"{fpath} metadata is not a mapping")
+        for key, val in data.items():
+            # Clean value
+            if isinstance(val, str):
+                val = re.sub(r'<.*?>', ' ', val)
+                while '  ' in val:
+                    val = val.replace('  ', ' ')
+                data[key] = val
+        return data
+    except yaml.YAMLError as exc:
+        raise BuildError(f"{fpath} yaml parsing failed: {exc}") from exc
+
+
+Problem = namedtuple('Problem', ['path', 'kind', 'message'])
+
+# Files that a theme has to provide
+THEME_FILES = ('defaults.yaml', 'template.html', 'csc.css')
+
+# Markdown images and pandoc attributes (e.g., of slide backgrounds)
+MARKDOWN_IMAGE_RE = re.compile(r'!\[(?:[^\]]|\][^(])*\]\(\s*<?([^)\s>]+)>?')
+MARKDOWN_ATTRIBUTES_RE = re.compile(r'\{([^{}\n]*)\}')
+
+
+def find_markdown_links(text):
+    """Return the local files referenced in markdown text
+
+    The files are those of markdown images and the linking attributes
+    (see SourcesParser) of raw html and of pandoc attributes.
+    """
+    # Skip code
+    text = re.sub(r'^(```|~~~).*?^\1', '', text, flags=re.M | re.S)
+    text = re.sub(r'`[^`\n]*`', '', text)
+    links = {m.group(1) for m in MARKDOWN_IMAGE_RE.finditer(text)}
+    links.update(get_html_sources(text))
+    # Pandoc attributes are written as those of html
+    for m in MARKDOWN_ATTRIBUTES_RE.finditer(text):
+        links.update(get_html_sources(f'<span {m.group(1)}>'))
+    return sorted(link for link in links
+                  if not urlparse(link).scheme and not link.startswith('#'))
+
+
+def check_slides(fpath):
+    """Return the problems in the front matter and links of fpath"""
+    problems = []
+    try:
+        meta = parse_slides_metadata(fpath)
+        if 'title' not in meta:
+            problems.append(Problem(str(fpath), 'front-matter',
+                                    'title missing'))
+    except BuildError as exc:
+        problems.append(Problem(str(fpath), 'front-matter', str(exc)))
+    except (OSError, UnicodeDecodeError, yaml.YAMLError) as exc:
+        problems.append(Problem(str(fpath), 'front-matter',
+                                f'{fpath} yaml parsing failed: {exc}'))
+
+    try:
+        text = fpath.read_text()
+    except (OSError, UnicodeDecodeError):
+        return problems
+    for link in find_markdown_links(text):
+        if not (fpath.parent / link).exists():
+            problems.append(Problem(str(fpath), 'missing-file',
+                                    f'linked file missing: {link}'))
+    return problems
+
+
+def check_about(fpath, slides_fpaths):
+    """Return the problems in the about.yml tree of fpath
+
+    The presentations found are appended to slides_fpaths.
+    """
+    try:
+        metadata = parse_about(fpath)
+    except (OSError, UnicodeDecodeError, yaml.YAMLError) as exc:
+        return [Problem(str(fpath), 'about', str(exc))]
+    if not isinstance(metadata, dict):
+        return [Problem(str(fpath), 'about', 'not a mapping')]
+
+    problems = []
+    if 'title' not in metadata:
+        problems.append(Problem(str(fpath), 'about', 'title missing'))
+    if 'modules' in metadata:
+        for module in metadata['modules'] or []:
+            mod_fpath = fpath.parent / str(module) / fpath.name
+            if not mod_fpath.is_file():
+                problems.append(Problem(str(fpath), 'module',
+                                        f'module file missing: {mod_fpath}'))
+                continue
+            problems += check_about(mod_fpath, slides_fpaths)
+    elif 'slidesdir' in metadata:
+        slides_dpath = fpath.parent / str(metadata['slidesdir'])
+        if not slides_dpath.is_dir():
+            problems.append(Problem(str(fpath), 'slidesdir',
+                                    f'directory missing: {slides_dpath}'))
+        else:
+            md_fpaths = sorted(slides_dpath.glob('*.md'))
+            if not md_fpaths:
+                problems.append(Problem(str(fpath), 'slidesdir',
+                                        f'no presentations in '
+                                        f'{slides_dpath}'))
+            slides_fpaths += md_fpaths
+    else:
+        problems.append(Problem(str(fpath), 'about',
+                                'modules or slidesdir missing'))
+    return problems
+
+
+def check_theme(theme):
+    problems = []
+    for name in THEME_FILES:
+        if not (theme.dpath / name).is_file():
+            problems.append(Problem(str(theme.dpath), 'theme',
+                                    f'theme file missing: {name}'))
+    for css_fpath in sorted(theme.dpath.rglob('*.css')):
+        try:
+            text = css_fpath.read_text()
+        except (OSError, UnicodeDecodeError) as exc:
+            problems.append(Problem(str(css_fpath), 'theme',
+                                    f'cannot read: {exc}'))
+            continue
+        for m in re.finditer(r'url\(\s*[\'"]?([^\'")]+)[\'"]?\s*\)', text):
+            link = m.group(1)
+            if urlparse(link).scheme or link.startswith(('#', '/')):
+                continue
+            if not (css_fpath.parent / link.split('?')[0]).exists():
+                problems.append(Problem(str(css_fpath), 'theme',
+                                        f'linked file missing: {link}'))
+    return problems
+
+
+def check_inputs(fpaths, *, theme, filters=[], jobs=None):
+    """Return the problems of about.yml files and presentations
+
+    Nothing is converted, so that this is fast enough to run before
+    a build.
+    """
+    problems = check_theme(theme)
+    for fpath in filters:
+        if not Path(fpath).is_file():
+            problems.append(Problem(str(fpath), 'filter', 'filter missing'))
+
+    slides_fpaths = []
+    for fpath in fpaths:
+        if not fpath.is_file():
+            problems.append(Problem(str(fpath), 'input', 'file missing'))
+        elif fpath.suffix == '.md':
+            slides_fpaths.append(fpath)
+        else:
+            problems += check_about(fpath, slides_fpaths)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for slides_problems in executor.map(check_slides,
+                                            dict.fromkeys(slides_fpaths)):
+            problems += slides_problems
+    return problems
+
+
+def report_problems(problems, *, json_fpath=None):
+    for p in problems:
+        print(f'{p.path}: {p.kind}: {p.message}',
+              file=sys.stderr, flush=True)
+    if json_fpath is not None:
+        with open(json_fpath, 'w') as f:
+            json.dump(dict(problems=[p._asdict() for p in problems]), f,
+                      indent=2)
+            f.write('\n')
+
+
+PlanEdge = namedtuple('PlanEdge', ['rule', 'outputs', 'inputs', 'implicit',
+                                   'command', 'description'])
+
+
+def get_about_fpaths(fpath):
+    """Return fpath and the about.yml files of its modules"""
+    fpaths = [fpath]
+    for module in read_about(fpath).get('modules', []):
+        fpaths += get_about_fpaths(fpath.parent / module / fpath.name)
+    return fpaths
+
+
+def get_slides_command(conversion, prefix):
+    """Return the slides command that creates the output of conversion"""
+    in_fpath, out_fpath, args = conversion
+    theme = args.theme.dpath.absolute() if args.theme.is_custom \
+        else args.theme.name
+    command = [*prefix, 'slides', '-q', '-j', '1', '-f', args.format,
+               '-o', str(out_fpath.parent), '-t', str(theme)]
+    command += [f'--filters={fpath}' for fpath in args.filters]
+    for flag in ['no_math', 'prerender_math', 'optimize_images',
+                 'bundle_assets', 'no_cache', 'pdf_page_cache']:
+        if getattr(args, flag):
+            command.append(f'--{flag.replace("_", "-")}')
+    for option in ['filter_mode', 'pandoc_args', 'link_mode', 'cache_dir',
+                   'cache_size', 'pdf_backend', 'browsers', 'pdf_timeout',
+                   'pdf_shard_size', 'pdf_optimize']:
+        value = getattr(args, option)
+        if value not in [None, '']:
+            command.append(f'--{option.replace("_", "-")}={value}')
+    if args.memory_budget is not None:
+        command.append(f'--memory-budget={args.memory_budget // 1024**2}')
+    for key in URL_KEYS:
+        value = getattr(args, key)
+        if value != get_default_url(key, args.format, args.theme):
+            command.append(f'--{key}={value}')
+    for option, key in [('--assets-dir', 'assets_dpath'),
+                        ('--bundle-dir', 'bundle_dpath')]:
+        value = getattr(args, key, None)
+        if value is not None:
+            command.append(f'{option}={value}')
+    command.append(str(in_fpath))
+    return command
+
+
+def get_plan(args):
+    """Return the edges that build the pages of args
+
+    Each presentation and format is made by its own slides command, and
+    the index, theme, and zip file by pages --index-only. Paths are
+    relative to the current directory, where the edges are to be run.
+    """
+    if args.command:
+        prefix = shlex.split(args.command)
+    else:
+        prefix = [sys.executable, str(Path(__file__).resolve())]
+    page_theme_fpath = Path('html') / 'theme' / args.theme.name / 'csc.css'
+    conversions = []
+    args_pages = copy.copy(args)
+    args_pages.dry_run = True  # Do not create the output directories
+    build_content(args.input, page_theme_fpath, args_pages, conversions)
+
+    # Files used by every conversion
+    common_fpaths = sorted(fpath for fpath in args.theme.dpath.rglob('*')
+                           if fpath.is_file())
+    common_fpaths += [Path(fpath) for fpath in args.filters]
+    common_fpaths.append(Path(__file__).resolve())
+
+    edges = []
+    for conversion in conversions:
+        in_fpath, out_fpath, args_slides = conversion
+        with stage('metadata'):
+            links = find_markdown_links(in_fpath.read_text())
+        link_fpaths = [in_fpath.parent / link for link in links
+                       if (in_fpath.parent / link).is_file()]
+        edges.append(PlanEdge(
+            'slides', [out_fpath], [in_fpath], link_fpaths + common_fpaths,
+            get_slides_command(conversion, prefix),
+            f'{args_slides.format.upper()} {out_fpath}'))
+
+    theme = args.theme.dpath.absolute() if args.theme.is_custom \
+        else args.theme.name
+    command = [*prefix, 'pages', '-q', '--update', '--index-only',
+               '-t', str(theme), f'--info_content={args.info_content}']
+    if args.with_pdf:
+        command.append('--with-pdf')
+    if args.shared_assets:
+        command.append('--shared-assets')
+    command += [str(args.input), str(args.output)]
+    outputs = [args.output / 'index.html']
+    if args.with_pdf:
+        outputs.append(args.output / 'slides.zip')
+    # Titles of the index are read from the presentations
+    implicit = get_about_fpaths(args.input) + \
+        sorted({c.in_fpath for c in conversions}) + common_fpaths
+    edges.append(PlanEdge(
+        'index', outputs, [c.out_fpath for c in conversions], implicit,
+        command, f'INDEX {outputs[0]}'))
+    return edges
+
+
+def ninja_escape(path):
+    return re.sub(r'([$ :])', r'$\1', str(path))
+
+
+def write_ninja(edges, fpath, *, pdf_jobs=None):
+    lines = [f'# Generated by slidefactory {VERSION} plan',
+             'ninja_required_version = 1.3', '']
+    if pdf_jobs is not None:
+        lines += ['pool pdf', f'  depth = {pdf_jobs}', '']
+    for rule in sorted({edge.rule for edge in edges}):
+        lines += [f'rule {rule}', '  command = $cmd',
+                  '  description = $desc', '  restat = 1', '']
+    for edge in edges:
+        outputs = ' '.join(map(ninja_escape, edge.outputs))
+        inputs = ' '.join(map(ninja_escape, edge.inputs))
+        implicit = ' '.join(map(ninja_escape, edge.implicit))
+        lines.append(f'build {outputs}: {edge.rule} {inputs} | {implicit}')
+        lines.append(f'  cmd = {shlex.join(edge.command)}'
+                     .replace('$', '$$'))
+        lines.append(f'  desc = {edge.description}'.replace('$', '$$'))
+        if pdf_jobs is not None and edge.outputs[0].suffix == '.pdf':
+            lines.append('  pool = pdf')
+        lines.append('')
+    fpath.write_text('\n'.join(lines))
+
+
+def make_escape(path):
+    return re.sub(r'([ :#])', r'\\\1', str(path)).replace('$', '$$')
+
+
+def write_makefile(edges, fpath):
+    # The zip file is made together with the index
+    lines = [f'# Generated by slidefactory {VERSION} plan', '',
+             '.PHONY: all',
+             'all: ' + ' '.join(make_escape(edge.outputs[0])
+                                for edge in edges if edge.rule == 'index'),
+             '']
+    for edge in edges:
+        prerequisites = ' '.join(map(make_escape,
+                                     edge.inputs + edge.implicit))
+        lines.append(f'{make_escape(edge.outputs[0])}: {prerequisites}')
+        lines.append(f'\t@echo {shlex.quote(edge.description)}'
+                     .replace('$', '$$'))
+        lines.append(f'\t{shlex.join(edge.command)}'.replace('$', '$$'))
+        lines.append('')
+    fpath.write_text('\n'.join(lines))
+
+
+def write_plan_json(edges, fpath):
+    data = dict(version=1, edges=[
+        dict(rule=edge.rule,
+             outputs=list(map(str, edge.outputs)),
+             inputs=list(map(str, edge.inputs)),
+             implicit=list(map(str, edge.implicit)),
+             command=edge.command,
+             description=edge.description)
+        for edge in edges])
+    with open(fpath, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+
+
+class Inotify:
+    """Wait for changes in directories using inotify"""
+
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+            | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dpaths = set()
+
+    def watch(self, dpath):
+        dpath = Path(dpath).resolve()
+        if dpath in self.dpaths or not dpath.is_dir():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dpath),
+                                         self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch {dpath}')
+        self.dpaths.add(dpath)
+
+    def wait(self, timeout=None):
+        """Wait for events and return True if there were any"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        # Events only wake us up; changes are found by comparing snapshots
+        try:
+            while os.read(self.fd, 1 << 16):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+
+class PollingWatcher:
+    """Fallback for Inotify that wakes up periodically"""
+
+    def __init__(self, interval=1):
+        self.interval = interval
+
+    def watch(self, dpath):
+        pass
+
+    def wait(self, timeout=None):
+        time.sleep(self.interval if timeout is None else timeout)
+        return True
+
+
+def get_watcher():
+    try:
+        return Inotify()
+    except (OSError, AttributeError, TypeError) as exc:
+        verbose_info(f'inotify not available ({exc}), polling for changes')
+        return PollingWatcher()
+
+
+def get_dependencies(conversion, externals):
+    in_fpath, out_fpath, args = conversion
+    fpaths = [in_fpath,
+              Path(args.defaults_fpath),
+              Path(args.template_fpath),
+              *map(Path, args.filters),
+              *(p for p in args.theme.dpath.rglob('*') if p.is_file()),
+              *(in_fpath.parent / fname for fname in externals or []),
+              ]
+    return fpaths
+
+
+def take_snapshot(fpaths):
+    snapshot = {}
+    for fpath in fpaths:
+        try:
+            st = fpath.stat()
+            snapshot[fpath] = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            snapshot[fpath] = None
+    return snapshot
+
+
+RELOAD_PATH = '/__slidefactory_reload'
+RELOAD_SCRIPT = f"""
+<script>
+  new EventSource('{RELOAD_PATH}').onmessage = () => location.reload();
+</script>
+"""
+
+
+class ReloadRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serve files and reload html pages after rebuilds
+
+    Html pages are served with a script that listens to server-sent events
+    from RELOAD_PATH and reloads the page when the server signals a rebuild.
+    """
+
+    def log_message(self, format, *args):
+        verbose_info(f'{self.address_string()} {format % args}')
+
+    def do_GET(self):
+        if self.path == RELOAD_PATH:
+            self.send_events()
+            return
+
+        fpath = Path(self.translate_path(self.path))
+        if fpath.suffix != '.html' or not fpath.is_file():
+            super().do_GET()
+            return
+
+        content = fpath.read_bytes()
+        i = content.rfind(b'</body>')
+        if i < 0:
+            i = len(content)
+        content = content[:i] + RELOAD_SCRIPT.encode() + content[i:]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_events(self):
+        server = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        with server.reload_condition:
+            generation = server.generation
+        try:
+            while True:
+                with server.reload_condition:
+                    server.reload_condition.wait_for(
+                        lambda: server.generation != generation, timeout=15)
+                    reload = server.generation != generation
+                    generation = server.generation
+                self.wfile.write(b'data: reload\n\n' if reload
+                                 else b': keepalive\n\n')
+                self.wfile.flush()
+        except OSError:
+            pass
+
+
+class ReloadServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, dpath):
+        super().__init__(address,
+                         functools.partial(ReloadRequestHandler,
+                                           directory=str(dpath)))
+        self.generation = 0
+        self.reload_condition = threading.Condition()
+
+    def reload(self):
+        with self.reload_condition:
+            self.generation += 1
+            self.reload_condition.notify_all()
+
+
+def get_default_socket_fpath():
+    socket_fpath = os.environ.get('SLIDEFACTORY_SOCKET')
+    if socket_fpath:
+        return Path(socket_fpath)
+    runtime_dpath = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return Path(runtime_dpath) / f'slidefactory-{os.getuid()}.sock'
+
+
+class Job:
+    """Job received by the build server"""
+
+    def __init__(self, job_id, argv, cwd, conn):
+        self.id = job_id
+        self.argv = argv
+        self.cwd = cwd
+        self.conn = conn
+        self.pid = None
+        self.fd = None
+        self.log = None
+        self.log_fpath = None
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def describe(self):
+        return dict(job=self.id, argv=self.argv, cwd=self.cwd,
+                    log=self.log_fpath and str(self.log_fpath))
+
+
+def run_job(argv, cwd, fd):
+    """Run main in a forked child with the output written to fd
+
+    Does not return; the child exits with the exit code of the command.
+    """
+    code = 1
+    try:
+        os.setsid()
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        # Do not keep the sockets of the server and other jobs open
+        os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+        sys.stdout.reconfigure(line_buffering=True)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.chdir(cwd)
+        main(argv)
+        code = 0
+    except SystemExit as exc:
+        if exc.code is None or isinstance(exc.code, int):
+            code = exc.code or 0
+        else:
+            print(exc.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+class BuildServer:
+    """Run slidefactory jobs received over a Unix domain socket
+
+    Each job runs in a process forked from the server so that it starts
+    with the modules and filters already loaded. State created by a job,
+    such as its browsers, does not persist to later jobs; jobs share only
+    the cache. A client sends a JSON line
+    with the command-line arguments and the working directory, and receives
+    JSON lines with the output of the job and finally its exit code.
+    Closing the connection cancels the job.
+    """
 
-            run_args = [
-                'gs',
-                '-q',
-                '-dNOPAUSE',
-                '-dBATCH',
-                '-dSAFER',
-                '-sDEVICE=pdfwrite',
-                '-dCompatibilityLevel=1.4',
-                '-dPDFSETTINGS=/printer',
-                '-dDownsampleColorImages=true',
-                '-dColorImageResolution=300',
-                '-dDownsampleGrayImages=true',
-                '-dGrayImageResolution=300',
-                '-dDownsampleMonoImages=true',
-                '-dMonoImageResolution=300',
-                '-dColorConversionStrategy=/LeaveColorUnchanged',
-                '-dPreserveAnnots=true',
-                '-dDetectDuplicateImages=true',
-                f'-sOutputFile={pdf_fpath}',
-                f'{tmp_pdf_fpath}',
-                f'{pdfmark_fpath}',
-                ]
-            run(run_args)
+    COMMANDS = ('slides', 'pages')
 
+    def __init__(self, socket_fpath, *, max_jobs, log_dpath):
+        self.socket_fpath = socket_fpath
+        self.max_jobs = max_jobs
+        self.log_dpath = log_dpath
+        self.selector = selectors.DefaultSelector()
+        self.buffers = {}
+        self.jobs = {}
+        self.queue = deque()
+        self.running = {}
+        self.next_id = 1
 
-def create_index_page(fpath, title, info_content, html_content, pdf_content):
-    info(f'Create {fpath}')
-    with fpath.open("w") as fd:
-        csc_ui_version = '2.1.11'
-        fd.write(f"""
-<!DOCTYPE html>
-<html>
-<head>
-  <meta charset="utf-8" />
-  <title>{title}</title>
-  <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/@cscfi/csc-ui@{csc_ui_version}/dist/styles/css/theme.css" />
-</head>
-<body>
-<c-main>
-  <c-toolbar>
-    <c-csc-logo></c-csc-logo>
-    {title}
-  </c-toolbar>
+    def serve_forever(self):
+        if self.socket_fpath.exists():
+            # Remove the socket of a server that is no longer running
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(str(self.socket_fpath))
+            except OSError:
+                self.socket_fpath.unlink()
+            else:
+                raise BuildError(f'error: a server is already listening on '
+                                 f'{self.socket_fpath}')
+            finally:
+                probe.close()
 
-  <c-page>
+        self.log_dpath.mkdir(parents=True, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Create the socket accessible only by the user, as jobs can run
+        # arbitrary code (e.g., filters)
+        umask = os.umask(0o077)
+        try:
+            self.sock.bind(str(self.socket_fpath))
+        finally:
+            os.umask(umask)
+        self.sock.listen()
+        self.selector.register(self.sock, selectors.EVENT_READ,
+                               self._accept)
+        info(f'Listening on {self.socket_fpath}')
+        try:
+            while True:
+                for key, _ in self.selector.select():
+                    key.data(key.fileobj)
+        finally:
+            for job in self.running.values():
+                os.killpg(job.pid, signal.SIGTERM)
+            for job in self.running.values():
+                os.waitpid(job.pid, 0)
+            self.sock.close()
+            self.socket_fpath.unlink()
 
-    <c-card>
-      <c-card-title>About</c-card-title>
-      <c-card-content>
-        <div>
-{info_content}
-        </div>
-      </c-card-content>
-    </c-card>
+    def _accept(self, sock):
+        conn, _ = sock.accept()
+        self.buffers[conn] = b''
+        self.selector.register(conn, selectors.EVENT_READ, self._receive)
 
-    <br>
+    def _receive(self, conn):
+        try:
+            data = conn.recv(1 << 16)
+        except OSError:
+            data = b''
+        if not data:
+            self._disconnect(conn)
+            return
+        if conn in self.jobs:
+            # Nothing more is expected from the client
+            return
+        self.buffers[conn] += data
+        if b'\n' not in self.buffers[conn]:
+            return
 
-    <c-card>
-      <c-card-title>Slides (HTML)</c-card-title>
-      <c-card-content>
-{html_content}
-      </c-card-content>
-    </c-card>
+        line = self.buffers.pop(conn).split(b'\n', 1)[0]
+        try:
+            request = json.loads(line)
+            argv = [str(a) for a in request.get('argv', [])]
+            cwd = str(request.get('cwd', ''))
+        except (ValueError, AttributeError, TypeError):
+            self._reply(conn, dict(output='error: invalid request\n',
+                                   exit=2))
+            self._close(conn)
+            return
 
-    <br>
+        if request.get('status'):
+            self._reply(conn, dict(
+                running=[job.describe() for job in self.running.values()],
+                queued=[job.describe() for job in self.queue]))
+            self._close(conn)
+            return
 
-    <c-card>
-      <c-card-title>Slides (PDF)</c-card-title>
-      <c-card-content>
-{pdf_content}
-      </c-card-content>
-    </c-card>
+        if not argv or argv[0] not in self.COMMANDS:
+            self._reply(conn, dict(
+                output=f'error: the server runs only '
+                       f'{" and ".join(self.COMMANDS)} commands\n',
+                exit=2))
+            self._close(conn)
+            return
 
-  </c-page>
-</c-main>
-<script src="https://cdn.jsdelivr.net/npm/@cscfi/csc-ui@{csc_ui_version}/dist/csc-ui/csc-ui.esm.js" type="module"></script>
-""".strip("\n"))  # noqa: E501
-        fd.write("""
-<script>
-  const accordions = document.querySelectorAll("c-accordion");
-  accordions.forEach((accordion) => {
-    accordion.value = [];
-    accordion.multiple = true;
-  });
-</script>
-</body>
-</html>
-""".strip("\n"))  # noqa: E501
+        job = Job(self.next_id, argv, cwd, conn)
+        self.next_id += 1
+        self.jobs[conn] = job
+        self.queue.append(job)
+        info(f'Job {job.id}: {shlex.join(argv)} (in {cwd})')
+        self._start_jobs()
+        if job in self.queue:
+            self._reply(conn, dict(job=job.id, state='queued',
+                                   position=self.queue.index(job) + 1))
 
+    def _reply(self, conn, msg):
+        try:
+            conn.sendall(json.dumps(msg).encode() + b'\n')
+        except OSError:
+            self._disconnect(conn)
 
-def build_content(fpath, page_theme_fpath, args, *, line_fmt='{}'):
-    info(f'Process {fpath}')
-    with fpath.open() as fd:
-        metadata = yaml.safe_load(fd.read())
+    def _close(self, conn):
+        self.buffers.pop(conn, None)
+        self.jobs.pop(conn, None)
+        self.selector.unregister(conn)
+        conn.close()
 
-    title = metadata["title"]
-    content = ""
+    def _disconnect(self, conn):
+        """Cancel the job of a client that went away"""
+        job = self.jobs.get(conn)
+        self._close(conn)
+        if job is None:
+            return
+        job.conn = None
+        if job in self.queue:
+            info(f'Job {job.id} cancelled')
+            self.queue.remove(job)
+        elif job.pid is not None:
+            info(f'Job {job.id} cancelled, terminating')
+            try:
+                os.killpg(job.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
 
-    if "modules" in metadata:
-        content += '<c-accordion>\n'
-        for module in metadata["modules"]:
-            mod_fpath = fpath.parent / module / fpath.name
-            mod_title, mod_content = \
-                build_content(mod_fpath, page_theme_fpath, args,
-                              line_fmt='<p>{}</p>')
-            content += f'<c-accordion-item heading="{mod_title}" value="{module}">\n'  # noqa: E501
-            content += mod_content
-            content += '</c-accordion-item>\n'
-        content += '</c-accordion>\n'
-    else:
-        assert "slidesdir" in metadata
-        slides_dpath = fpath.parent / metadata["slidesdir"]
-        for md_fpath in sorted(slides_dpath.glob("*.md")):
-            meta = read_slides_metadata(md_fpath)
-            html_name = md_fpath.with_suffix(".html").name
-            html_fpath = 'html' / fpath.parent / html_name
-            slides_title = meta["title"]
-            m = re.search(r'^\d+', html_name)
-            prefix = '' if m is None else f'{int(m.group())}.'
-            content += line_fmt.format(f'<c-link href="{html_fpath}" target="_blank">{prefix} {slides_title}</c-link>')  # noqa: E501
-            content += '\n'
+    def _start_jobs(self):
+        while self.queue and len(self.running) < self.max_jobs:
+            self._start(self.queue.popleft())
 
-            # Convert slides
-            formats = ['html']
-            if args.with_pdf:
-                formats += ['pdf']
-            for fmt in formats:
-                args_slides = copy.copy(args)
-                args_slides.input = [md_fpath]
-                args_slides.output = args.output / fmt / fpath.parent
-                args_slides.format = fmt
-                if fmt == 'html':
-                    theme_url = os.path.relpath(page_theme_fpath,
-                                                html_fpath.parent)
-                    args_slides.theme_url = theme_url
-                main_slides(args_slides)
+    def _start(self, job):
+        read_fd, write_fd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            run_job(job.argv, job.cwd, write_fd)
+        os.close(write_fd)
 
-    return title, content
+        job.pid = pid
+        job.fd = read_fd
+        job.log_fpath = self.log_dpath / f'job-{job.id}.log'
+        job.log = open(job.log_fpath, 'wb')
+        self.running[read_fd] = job
+        self.selector.register(read_fd, selectors.EVENT_READ, self._output)
+        if job.conn is not None:
+            self._reply(job.conn, dict(job=job.id, state='running',
+                                       log=str(job.log_fpath)))
 
+    def _output(self, fd):
+        job = self.running[fd]
+        data = os.read(fd, 1 << 16)
+        if data:
+            job.log.write(data)
+            job.log.flush()
+            if job.conn is not None:
+                self._reply(job.conn,
+                            dict(output=job.decoder.decode(data)))
+            return
 
-def read_slides_metadata(fpath):
-    with fpath.open() as fd:
-        for line in fd:
-            if line.strip() == "---":
-                break
-        data = ""
-        for line in fd:
-            if line.strip() == "---":
-                break
-            data += line
-        if data == "":
-            raise RuntimeError(f"{fpath} missing metadata")
-        try:
-            data = yaml.safe_load(data)
-            for key, val in data.items():
-                # Clean value
-                if isinstance(val, str):
-                    val = re.sub(r'<.*?>', ' ', val)
-                    while '  ' in val:
-                        val = val.replace('  ', ' ')
-                    data[key] = val
-            return data
-        except yaml.parser.ParserError as exc:
-            raise RuntimeError(f"{fpath} yaml parsing failed") from exc
-
-
-def main():
+        self.selector.unregister(fd)
+        os.close(fd)
+        del self.running[fd]
+        job.log.close()
+        _, status = os.waitpid(job.pid, 0)
+        code = os.waitstatus_to_exitcode(status)
+        info(f'Job {job.id} finished with exit code {code}')
+        if job.conn is not None:
+            self._reply(job.conn, dict(exit=code))
+            if job.conn is not None:
+                self._close(job.conn)
+        self._start_jobs()
+
+
+def main(argv=None):
     # Common args
     pparser_common = argparse.ArgumentParser(add_help=False)
     pparser_common.add_argument(
@@ -457,13 +4241,109 @@ def main():
         '--filters', action='append', default=[],
         metavar='filter.py',
         help='pandoc filter scripts (multiple allowed)')
+    pparser_conversion.add_argument(
+        '--filter-mode', default='pandoc', choices=['pandoc', 'inprocess'],
+        help='run each filter as a separate process started by pandoc, '
+             'or apply pandocfilters-based python filters within '
+             'slidefactory on a single json document '
+             '(default: %(default)s; available: %(choices)s)')
     pparser_conversion.add_argument(
         '--no-math', action='store_true',
         help='disable math rendering')
+    pparser_conversion.add_argument(
+        '--prerender-math', action='store_true',
+        help='typeset math to svg in advance with the local MathJax '
+             '(or the one given with --mathjax_url), caching each unique '
+             'expression, so that MathJax does not run when the slides '
+             'are shown or printed')
     pparser_conversion.add_argument(
         '--pandoc-args', nargs='?',
         default='', const='',
         help='additional arguments passed to pandoc')
+    pparser_conversion.add_argument(
+        '-j', '--jobs', metavar='N', type=positive_int,
+        default=os.cpu_count(),
+        help='number of presentations converted in parallel; with the '
+             'pipeline scheduler, the number of processes of each tool '
+             '(default: number of CPUs)')
+    pparser_conversion.add_argument(
+        '--memory-budget', metavar='MB', type=memory_budget, default='auto',
+        help='memory for chromium and gs processes; they are started only '
+             'when their peak memory use in earlier runs fits in the budget '
+             'and in the available memory; auto uses the available memory '
+             'and 0 turns this off (default: %(default)s)')
+    pparser_conversion.add_argument(
+        '--scheduler', default='threads', choices=['threads', 'pipeline'],
+        help='threads converts each presentation from start to end in '
+             'its own thread; pipeline keeps more presentations in flight '
+             'and limits the processes of each tool separately, so that '
+             'pandoc and gs run while chromium prints '
+             '(default: %(default)s; available: %(choices)s)')
+    pparser_conversion.add_argument(
+        '--stage-jobs', metavar='TOOL=N', type=stage_limit,
+        action='append', default=[],
+        help='with the pipeline scheduler, the maximum number of '
+             'processes of a tool (pandoc, chromium, gs), e.g., '
+             'chromium=2 (default: --jobs); can be repeated')
+    pparser_conversion.add_argument(
+        '--optimize-images', action='store_true',
+        help='downscale and re-encode raster images larger than the slide '
+             'size for html and pdf output (requires Pillow)')
+    pparser_conversion.add_argument(
+        '--link-mode', default='auto',
+        choices=['auto', 'copy', 'hardlink', 'reflink'],
+        help='how linked files are placed in the output directory; '
+             'auto uses reflinks where supported and copies otherwise '
+             '(default: %(default)s; available: %(choices)s)')
+    pparser_conversion.add_argument(
+        '--bundle-assets', action='store_true',
+        help='copy the local resources (reveal.js, MathJax, fonts, theme) '
+             'used by html outputs under content-addressed names to an '
+             'assets directory beside them')
+    pparser_conversion.add_argument(
+        '--no-cache', action='store_true',
+        help='do not use the cache of converted presentations')
+    pparser_conversion.add_argument(
+        '--cache-dir', metavar='DIR', type=Path,
+        default=get_default_cache_dpath(),
+        help='cache directory (default: %(default)s)')
+    pparser_conversion.add_argument(
+        '--cache-size', metavar='MB', type=positive_int, default=1024,
+        help='maximum size of the cache in megabytes (default: %(default)s)')
+    pparser_conversion.add_argument(
+        '--pdf-backend', default='subprocess',
+        choices=['subprocess', 'devtools'],
+        help='how chromium prints pdfs: a new process for each presentation '
+             'or long-lived browsers controlled over the DevTools protocol '
+             '(default: %(default)s; available: %(choices)s)')
+    pparser_conversion.add_argument(
+        '--browsers', metavar='N', type=positive_int,
+        help='number of long-lived browsers with the devtools backend '
+             '(default: number of jobs, at most 4)')
+    pparser_conversion.add_argument(
+        '--pdf-timeout', metavar='SECONDS', type=positive_int, default=300,
+        help='maximum time for loading and printing a pdf; with the '
+             'devtools backend, printing starts as soon as the presentation '
+             'signals that it is ready (default: %(default)s)')
+    pparser_conversion.add_argument(
+        '--pdf-shard-size', metavar='PAGES', type=positive_int,
+        help='with the devtools backend, print presentations in ranges of '
+             'PAGES pages in parallel browsers and merge the parts')
+    pparser_conversion.add_argument(
+        '--pdf-page-cache', action='store_true',
+        help='with the devtools backend, keep printed pdf pages in the '
+             'cache and print only the pages that changed')
+    pparser_conversion.add_argument(
+        '--pdf-optimize', default='auto',
+        choices=['auto', 'none', 'metadata', 'full'],
+        help='post-processing of printed pdfs: none, only write metadata, '
+             'or recompress with ghostscript; auto recompresses only '
+             'presentations with raster images '
+             '(default: %(default)s; available: %(choices)s)')
+    pparser_conversion.add_argument(
+        '--profile', metavar='FILE', type=Path,
+        help='write the time and resource usage of the build stages '
+             'as Chrome trace events to FILE and print a summary')
 
     # Main argparser
     parser = argparse.ArgumentParser(
@@ -486,13 +4366,21 @@ def main():
         help=('output directory (by default uses '
               'the same directory as the input files)'))
     parser_slides.add_argument(
-        '-f', '--format', metavar='FORMAT', default='pdf',
-        choices=['pdf', 'html', 'html-local', 'html-embedded'],
-        help='output format (default: %(default)s; available: %(choices)s)')
+        '-f', '--format', metavar='FORMAT', default='pdf', type=format_list,
+        help=('output format or comma-separated formats, e.g. html,pdf '
+              f'(default: %(default)s; available: {", ".join(FORMATS)})'))
     group = parser_slides.add_argument_group(
         'advanced options for overriding paths and urls')
     for key in URL_KEYS:
         group.add_argument(f'--{key}', help=f'override {key}')
+    group.add_argument(
+        '--assets-dir', metavar='DIR', type=Path, dest='assets_dpath',
+        help='place linked files in a content-addressed directory DIR '
+             'shared by several outputs')
+    group.add_argument(
+        '--bundle-dir', metavar='DIR', type=Path, dest='bundle_dpath',
+        help='directory for the files of --bundle-assets '
+             '(default: assets beside the output)')
 
     # Main argparser - pages sub-command
     parser_pages = subparsers.add_parser(
@@ -513,6 +4401,152 @@ def main():
     parser_pages.add_argument(
         '--with-pdf', action='store_true',
         help='include pdf')
+    parser_pages.add_argument(
+        '--update', action='store_true',
+        help='update an existing output directory, converting only '
+             'the presentations that changed since the previous build')
+    parser_pages.add_argument(
+        '--shard', metavar='I/N', type=shard_spec,
+        help='convert only the I-th of N parts of the presentations into '
+             'the output directory (e.g., in an array job on a shared '
+             'filesystem); combine the parts with --merge-shards N')
+    parser_pages.add_argument(
+        '--merge-shards', metavar='N', type=positive_int,
+        help='create the index page, theme, and zip file from the '
+             'outputs of --shard I/N builds without converting')
+    parser_pages.add_argument(
+        '--index-only', action='store_true',
+        help='create only the index page, theme, and zip file from the '
+             'existing outputs (e.g., in the build of the plan sub-command)')
+    parser_pages.add_argument(
+        '--check', action='store_true',
+        help='check the inputs (see the check sub-command) and stop '
+             'before converting anything if there are problems')
+    parser_pages.add_argument(
+        '--shared-assets', action='store_true',
+        help='place linked files once in a content-addressed '
+             'html/assets directory shared by all slides')
+
+    # Main argparser - plan sub-command
+    parser_plan = subparsers.add_parser(
+        'plan',
+        parents=[pparser_common, pparser_conversion],
+        help='write the build of pages for ninja or make')
+    parser_plan.set_defaults(main=main_plan)
+    parser_plan.add_argument(
+        'input', metavar='about.yml', type=Path,
+        help='metadata file')
+    parser_plan.add_argument(
+        'output', metavar='DIR', type=Path,
+        help='output directory')
+    parser_plan.add_argument(
+        '--info_content',
+        default='This page is generated with slidefactory.',
+        help='information shown on the page')
+    parser_plan.add_argument(
+        '--with-pdf', action='store_true',
+        help='include pdf')
+    parser_plan.add_argument(
+        '--shared-assets', action='store_true',
+        help='place linked files once in a content-addressed '
+             'html/assets directory shared by all slides')
+    parser_plan.add_argument(
+        '--ninja', metavar='FILE', type=Path, default=Path('build.ninja'),
+        help='ninja file to write (default: %(default)s)')
+    parser_plan.add_argument(
+        '--makefile', metavar='FILE', type=Path,
+        help='write also a Makefile')
+    parser_plan.add_argument(
+        '--json', metavar='FILE', type=Path,
+        help='write also the build as JSON')
+    parser_plan.add_argument(
+        '--command', metavar='CMD',
+        help='command that runs slidefactory in the build, e.g., '
+             './slidefactory_VERSION.sif (default: this script)')
+
+    # Main argparser - watch sub-command
+    parser_watch = subparsers.add_parser(
+        'watch',
+        parents=[pparser_common, pparser_conversion],
+        help='convert slides on changes and reload them in browser')
+    parser_watch.set_defaults(main=main_watch)
+    parser_watch.add_argument(
+        'input', metavar='input.md', nargs='+', type=Path,
+        help='presentation file(s)')
+    parser_watch.add_argument(
+        '-o', '--output', metavar='DIR', type=Path,
+        help=('output directory (by default uses '
+              'the same directory as the input files)'))
+    parser_watch.add_argument(
+        '-f', '--format', metavar='FORMAT', default='html', type=format_list,
+        help=('output format or comma-separated formats, e.g. html,pdf '
+              f'(default: %(default)s; available: {", ".join(FORMATS)})'))
+    parser_watch.add_argument(
+        '--port', metavar='PORT', type=int, default=8000,
+        help='port of the local http server (default: %(default)s)')
+    parser_watch.add_argument(
+        '--no-serve', action='store_true',
+        help='only convert, do not serve the output')
+    parser_watch.add_argument(
+        '--debounce', metavar='SECONDS', type=float, default=0.3,
+        help='time to wait for further changes before converting '
+             '(default: %(default)s)')
+    group = parser_watch.add_argument_group(
+        'advanced options for overriding paths and urls')
+    for key in URL_KEYS:
+        group.add_argument(f'--{key}', help=f'override {key}')
+
+    # Main argparser - check sub-command
+    parser_check = subparsers.add_parser(
+        'check',
+        parents=[pparser_common],
+        help='check about.yml trees and presentations without converting')
+    parser_check.set_defaults(main=main_check)
+    parser_check.add_argument(
+        'input', metavar='about.yml|input.md', nargs='+', type=Path,
+        help='metadata files or presentation files')
+    parser_check.add_argument(
+        '-t', '--theme', metavar='THEME', type=find_theme,
+        default='csc-plain',
+        help='presentation theme name or path (default: %(default)s)')
+    parser_check.add_argument(
+        '--filters', action='append', default=[],
+        metavar='filter.py',
+        help='pandoc filter scripts (multiple allowed)')
+    parser_check.add_argument(
+        '-j', '--jobs', metavar='N', type=positive_int,
+        default=os.cpu_count(),
+        help='number of presentations checked in parallel '
+             '(default: number of CPUs)')
+    parser_check.add_argument(
+        '--json', metavar='FILE', type=Path,
+        help='write the problems also as JSON to FILE '
+             '(e.g., /dev/stdout with --quiet)')
+
+    # Main argparser - serve sub-command
+    parser_serve = subparsers.add_parser(
+        'serve',
+        parents=[pparser_common],
+        help='run slides and pages commands sent by slidefactory_client.py')
+    parser_serve.set_defaults(main=main_serve)
+    parser_serve.add_argument(
+        '--socket', metavar='PATH', type=Path,
+        default=get_default_socket_fpath(),
+        help='unix domain socket to listen on; the client uses '
+             '$SLIDEFACTORY_SOCKET (default: %(default)s)')
+    parser_serve.add_argument(
+        '--max-jobs', metavar='N', type=positive_int, default=2,
+        help='maximum number of jobs running at the same time; each job '
+             'uses its own --jobs for parallel conversions '
+             '(default: %(default)s)')
+    parser_serve.add_argument(
+        '--log-dir', metavar='DIR', type=Path, default=None,
+        help='directory for the output of each job '
+             '(default: logs in the cache directory)')
+    parser_serve.add_argument(
+        '--preload-filters', metavar='filter.py', nargs='*', default=[],
+        help='pandocfilters-based filters to load at startup '
+             'for --filter-mode inprocess')
 
     # Main argparser - install sub-command
     parser_install = subparsers.add_parser(
@@ -524,7 +4558,7 @@ def main():
         'path', metavar='path', type=Path,
         help='install path')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     global info
     info = functools.partial(info_template, quiet=args.quiet)
@@ -535,51 +4569,123 @@ def main():
     global run
     run = functools.partial(run_template, dry_run=args.dry_run)
 
+    profiler = Profiler() if getattr(args, 'profile', None) else None
+
+    global stage
+    stage = functools.partial(stage_template, profiler=profiler)
+
     info(f'Slidefactory {VERSION}')
     verbose_info(f'  checksum:  {CHECKSUM}')
     verbose_info(f'  reference: {REF_CHECKSUM}')
-    args.main(args)
+    try:
+        args.main(args)
+    except BuildError as exc:
+        error(str(exc))
+    finally:
+        if profiler is not None:
+            profiler.write(args.profile)
+            info(profiler.summary())
+            info(f'Wrote profile to {args.profile}')
 
     if args.dry_run:
         info("This was DRY RUN. No changes made.")
 
 
+@contextmanager
+def conversion_context(args):
+    """Set up the resources shared by the conversions of args"""
+    args.cache = get_build_cache(args)
+    args.image_optimizer = get_image_optimizer(args)
+    stage_limits = dict(args.stage_jobs)
+    global pipeline
+    if args.scheduler == 'pipeline':
+        pipeline = Pipeline(args.jobs, stage_limits)
+    global metadata_index
+    index_fpath = None
+    if not args.no_cache and not args.dry_run:
+        index_fpath = args.cache_dir / 'metadata.json'
+    metadata_index = MetadataIndex(index_fpath)
+    global governor
+    if args.memory_budget != 0 and not args.dry_run:
+        governor = MemoryGovernor(args.cache_dir / 'memory.json',
+                                  budget=args.memory_budget)
+    for name in ['pdf_shard_size', 'pdf_page_cache']:
+        if getattr(args, name) and args.pdf_backend != 'devtools':
+            error(f'--{name.replace("_", "-")} requires '
+                  f'--pdf-backend devtools')
+    args.bundler = None
+    if args.bundle_assets and not args.dry_run:
+        args.bundler = AssetBundler([SLIDEFACTORY_ROOT, args.theme.dpath],
+                                    link_mode=args.link_mode)
+    args.browser_pool = None
+    if args.pdf_backend == 'devtools':
+        browsers = args.browsers or stage_limits.get('chromium') \
+            or min(args.jobs, 4)
+        args.browser_pool = BrowserPool(browsers, timeout=args.pdf_timeout)
+    args.math_renderer = None
+    if args.prerender_math and not args.no_math and not args.dry_run:
+        mathjax_url = getattr(args, 'mathjax_url', None) \
+            or get_default_url('mathjax_url', 'html-local', args.theme)
+        args.math_renderer = MathRenderer(args.cache_dir / 'math',
+                                          mathjax_url,
+                                          browser_pool=args.browser_pool)
+    try:
+        yield
+    finally:
+        if args.math_renderer is not None:
+            args.math_renderer.close()
+        if args.browser_pool is not None:
+            args.browser_pool.close()
+        if pipeline is not None:
+            pipeline.close()
+            pipeline = None
+        if governor is not None:
+            if not args.no_cache:
+                governor.save()
+            governor = None
+        metadata_index.save()
+        metadata_index = None
+
+
 def main_slides(args):
-    if args.format == 'html-local' and IN_CONTAINER:
+    with conversion_context(args):
+        run_conversions(get_conversions(args), jobs=args.jobs)
+
+
+def get_conversions(args):
+    conversions = []
+    for fmt in args.format:
+        args_fmt = copy.copy(args)
+        args_fmt.format = fmt
+        conversions += get_format_conversions(args_fmt)
+    return conversions
+
+
+def get_format_conversions(args):
+    if args.format == 'html-local' and IN_CONTAINER \
+       and not args.bundle_assets:
         error('Install and use local slidefactory in order to '
               'create local offline htmls.\n\n'
               'In short, run slidefactory container with `--install PATH` '
-              'and follow the instructions (see README for details).'
+              'and follow the instructions (see README for details).\n'
+              'Alternatively, use `--bundle-assets` to copy the resources '
+              'beside the htmls.'
               )
 
-    include_math = not args.no_math
-
     # Set resource url defaults if not set
+    args = copy.copy(args)
     for key in URL_KEYS:
         if getattr(args, key, None) is None:
             default = get_default_url(key, args.format, args.theme)
             setattr(args, key, default)
 
     if args.verbose:
-        info("Using following resources (override with the given argument):")
+        info(f"Using following resources for {args.format} "
+             f"(override with the given argument):")
         for key in URL_KEYS:
             val = getattr(args, key)
             info(f"  --{key:16} {val}")
 
-    pandoc_vars = {
-        'theme-url': args.theme_url,
-        'revealjs-url': args.revealjs_url,
-        'mathjaxurl': args.mathjax_url,
-        'css': args.fonts_url,
-        }
-
-    if args.format in ['html-embedded'] and include_math:
-        url = args.mathjax_url
-        pandoc_vars.update({
-            'mathjaxurl': '',
-            'header-includes': f'<script src="{url}"></script>',
-            })
-
     # Suffix
     if args.format == 'pdf':
         suffix = '.pdf'
@@ -590,14 +4696,7 @@ def main_slides(args):
     else:
         suffix = '.html'
 
-    # Extra pandoc args
-    pandoc_args = args.pandoc_args.split()
-    if include_math:
-        pandoc_args += ['--mathjax']
-    if args.format in ['html-embedded']:
-        pandoc_args += ['--embed-resources']
-
-    # Convert files
+    conversions = []
     for in_fpath in args.input:
         if args.output:
             out_fpath = args.output / in_fpath.with_suffix(suffix).name
@@ -605,47 +4704,390 @@ def main_slides(args):
                 out_fpath.parent.mkdir(parents=True, exist_ok=True)
         else:
             out_fpath = in_fpath.with_suffix(suffix)
+        conversions.append(Conversion(in_fpath, out_fpath, args))
+    return conversions
+
+
+def group_conversions(conversions):
+    """Group the conversions of a presentation that can share a render
+
+    The html based formats except html-embedded differ only in resource
+    urls, so that pandoc needs to convert the presentation only once.
+    """
+    groups = {}
+    for conversion in conversions:
+        in_fpath, out_fpath, args = conversion
+        if args.format == 'html-embedded' or args.dry_run:
+            key = out_fpath
+        else:
+            key = (in_fpath.resolve(), args.defaults_fpath,
+                   args.template_fpath, tuple(args.filters),
+                   args.filter_mode, args.pandoc_args, args.no_math,
+                   args.prerender_math)
+        groups.setdefault(key, []).append(conversion)
+    return list(groups.values())
+
+
+def convert_group(conversions):
+    """Convert the conversions of a group one after another
+
+    Returns the linked files or the BuildError of each conversion.
+    """
+    render = SharedRender() if len(conversions) > 1 else None
+    results = []
+    for conversion in conversions:
+        try:
+            results.append(convert(conversion, render=render))
+        except BuildError as exc:
+            results.append(exc)
+    return results
+
+
+def run_conversions(conversions, *, jobs, on_done=None):
+    """Run conversions in parallel and report failures per presentation
+
+    on_done is called in this thread for each successful conversion.
+    """
+    failed = []
+    if pipeline is not None:
+        # Keep enough presentations in flight to have work for all stages
+        jobs = pipeline.decks_in_flight
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(convert_group, group): group
+                   for group in group_conversions(conversions)}
+        for future in concurrent.futures.as_completed(futures):
+            for conversion, result in zip(futures[future], future.result()):
+                if isinstance(result, BuildError):
+                    failed.append(conversion)
+                    print(f'\nConversion of {conversion.in_fpath} '
+                          f'to {conversion.out_fpath} failed:\n'
+                          f'{inspect.cleandoc(str(result))}\n',
+                          file=sys.stderr, flush=True)
+                elif on_done is not None:
+                    on_done(conversion)
+
+    if failed:
+        failed.sort(key=conversions.index)
+        raise BuildError(
+            f'{len(failed)} of {len(conversions)} conversions failed:\n'
+            + '\n'.join(f'  {c.out_fpath}' for c in failed))
+
+
+def convert(conversion, *, render=None):
+    """Convert a presentation and return the linked files
+
+    The pandoc render is shared with the other formats if render is given.
+    """
+    with stage('convert', deck=conversion.out_fpath):
+        in_fpath, out_fpath, args = conversion
+        if not in_fpath.is_file():
+            raise BuildError(f'error: input file {in_fpath} not found')
+        include_math = not args.no_math
+
+        pandoc_vars = {
+            'theme-url': args.theme_url,
+            'revealjs-url': args.revealjs_url,
+            'mathjaxurl': args.mathjax_url,
+            'css': args.fonts_url,
+            }
+
+        if args.math_renderer is not None and include_math:
+            # Math is typeset in advance, so leave MathJax out
+            pandoc_vars['mathjax'] = ''
+        elif args.format in ['html-embedded'] and include_math:
+            url = args.mathjax_url
+            pandoc_vars.update({
+                'mathjaxurl': '',
+                'header-includes': f'<script src="{url}"></script>',
+                })
+
+        # Extra pandoc args
+        pandoc_args = args.pandoc_args.split()
+        if include_math:
+            pandoc_args += ['--mathjax']
+        if args.format in ['html-embedded']:
+            pandoc_args += ['--embed-resources']
 
-        info(f'Convert {in_fpath} to {out_fpath}')
         html_kwargs = dict(
             defaults_fpath=args.defaults_fpath,
             template_fpath=args.template_fpath,
             pandoc_vars=pandoc_vars,
             pandoc_args=pandoc_args,
             filters=args.filters,
+            filter_mode=args.filter_mode,
+            link_mode=args.link_mode,
+            assets_dpath=getattr(args, 'assets_dpath', None),
+            image_optimizer=args.image_optimizer,
+            math_renderer=args.math_renderer if include_math else None,
             dry_run=args.dry_run,
         )
 
-        if args.format == 'pdf':
-            # Use temporary html output for pdf
-            with tempfile.NamedTemporaryFile(
-                     dir=in_fpath.parent,
-                     prefix=f'{in_fpath.stem}-',
-                     suffix='.html',
-                 ) as tmpfile:
-                html_fpath = Path(tmpfile.name)
-                create_html(in_fpath, html_fpath, **html_kwargs)
-                meta = read_slides_metadata(in_fpath)
-
-                # Use event name as subject if no separate subject defined
-                if 'subject' not in meta and 'event' in meta:
-                    meta['subject'] = meta['event']
-
-                create_pdf(html_fpath, out_fpath, meta=meta, dry_run=args.dry_run)
-        else:
-            create_html(in_fpath, out_fpath, **html_kwargs)
+        cache = getattr(args, 'cache', None)
+        manifest = getattr(args, 'manifest', None)
+        key = None
+        if cache is not None or manifest is not None:
+            key = get_cache_key(conversion, html_kwargs)
+
+        if manifest is not None:
+            externals = manifest.lookup(out_fpath, key, in_fpath)
+            if externals is not None:
+                info(f'Skip {out_fpath} (up to date)')
+                manifest.record(out_fpath, key, in_fpath, externals)
+                return externals
+
+        # Write to a staged file that replaces the output when complete
+        staged_fpath = out_fpath.with_name(
+            f'.{out_fpath.stem}.tmp{out_fpath.suffix}')
+        if args.dry_run:
+            staged_fpath = out_fpath
+        try:
+            externals = convert_staged(
+                conversion, staged_fpath, html_kwargs,
+                key=key if cache is not None else None, render=render)
+            bundled = []
+            if args.bundler is not None and args.format != 'pdf':
+                assets_dpath = getattr(args, 'bundle_dpath', None) \
+                    or out_fpath.parent / 'assets'
+                with stage('bundle'):
+                    bundled = args.bundler.bundle(staged_fpath, assets_dpath)
+            if not args.dry_run:
+                os.replace(staged_fpath, out_fpath)
+        finally:
+            if not args.dry_run:
+                staged_fpath.unlink(missing_ok=True)
+
+        if manifest is not None and not args.dry_run:
+            manifest.record(out_fpath, key, in_fpath, externals,
+                            bundled=bundled)
+        return externals
+
+
+def convert_staged(conversion, staged_fpath, html_kwargs, *, key=None,
+                   render=None):
+    """Convert to staged_fpath and return the linked files
+
+    The cache is used if key is given.
+    """
+    in_fpath, out_fpath, args = conversion
+    create = create_html if render is None else render.create_html
+    cache = args.cache if key is not None else None
+    if cache is not None:
+        with stage('cache'):
+            cached = cache.lookup(key, in_fpath.parent)
+        if cached is not None:
+            cached_fpath, externals = cached
+            try:
+                shutil.copyfile(cached_fpath, staged_fpath)
+            except OSError as exc:
+                # E.g., evicted by another build; convert instead
+                info(f'Warning: could not read {cached_fpath} from the '
+                     f'cache: {exc}')
+                cached = None
+        if cached is not None:
+            info(f'Convert {in_fpath} to {out_fpath} (cached)')
+            if args.format != 'pdf':
+                copy_html_externals(
+                    in_fpath, staged_fpath, externals,
+                    link_mode=html_kwargs['link_mode'],
+                    assets_dpath=html_kwargs['assets_dpath'],
+                    image_optimizer=html_kwargs['image_optimizer'])
+            return externals
+
+    info(f'Convert {in_fpath} to {out_fpath}')
+    if args.format == 'pdf':
+        # Use temporary html output for pdf
+        with tempfile.NamedTemporaryFile(
+                 dir=in_fpath.parent,
+                 prefix=f'{in_fpath.stem}-',
+                 suffix='.html',
+             ) as tmpfile:
+            html_fpath = Path(tmpfile.name)
+            externals = create(in_fpath, html_fpath, **html_kwargs)
+            meta = read_slides_metadata(in_fpath)
+
+            # Print with optimized images
+            if args.image_optimizer is not None and externals:
+                urls = {}
+                for fname in externals:
+                    fpath = args.image_optimizer(in_fpath.parent / fname)
+                    fpath = urlquote(str(fpath.absolute()))
+                    urls[fname] = f'file://{fpath}'
+                rewrite_html_sources(html_fpath, urls)
+
+            # Use event name as subject if no separate subject defined
+            if 'subject' not in meta and 'event' in meta:
+                meta['subject'] = meta['event']
+
+            page_cache = None
+            if args.pdf_page_cache and args.cache is not None:
+                page_cache = PageCache(args.cache, hash_tree(args.theme.dpath),
+                                       in_fpath.parent, externals or [])
+
+            optimize = get_pdf_optimize(args.pdf_optimize, html_fpath,
+                                        externals)
+            create_pdf(html_fpath, staged_fpath, meta=meta,
+                       browser_pool=args.browser_pool,
+                       timeout=args.pdf_timeout,
+                       shard_size=args.pdf_shard_size,
+                       page_cache=page_cache,
+                       optimize=optimize,
+                       dry_run=args.dry_run)
+    else:
+        externals = create(in_fpath, staged_fpath, **html_kwargs)
+
+    if cache is not None:
+        with stage('cache'):
+            cache.store(key, staged_fpath, externals, in_fpath.parent)
+    return externals
+
+
+def main_check(args):
+    problems = check_inputs(args.input, theme=args.theme,
+                            filters=args.filters, jobs=args.jobs)
+    report_problems(problems, json_fpath=args.json)
+    if problems:
+        raise BuildError(f'{len(problems)} problems found')
+    info('No problems found')
 
 
 def main_pages(args):
-    if args.output.exists():
-        error(f'Output path {args.output} exists. Exiting.')
+    assemble = args.merge_shards is not None or args.index_only
+    if sum([args.shard is not None, args.merge_shards is not None,
+            args.index_only]) > 1:
+        error('Use only one of --shard, --merge-shards, and --index-only. '
+              'Exiting.')
+    if assemble and not args.output.is_dir():
+        error(f'Output path {args.output} does not exist. Exiting.')
+    # Shards build into the same output directory
+    if args.output.exists() and not args.update and args.shard is None \
+       and not assemble:
+        error(f'Output path {args.output} exists. '
+              f'Use --update to update it. Exiting.')
+
+    if args.check:
+        with stage('check'):
+            problems = check_inputs([args.input], theme=args.theme,
+                                    filters=args.filters, jobs=args.jobs)
+        if problems:
+            report_problems(problems)
+            raise BuildError(f'{len(problems)} problems found, '
+                             f'nothing converted')
+
+    # Outputs replace earlier ones only when complete,
+    # so that an interrupted build leaves a consistent site
+    manifest = None
+    if not args.dry_run:
+        args.output.mkdir(parents=True, exist_ok=True)
+        assets_dpath = None
+        if args.shared_assets:
+            assets_dpath = args.output / 'html' / 'assets'
+        manifest_fpath = get_manifest_fpath(args)
+        fallback_fpaths = [args.output / BuildManifest.OLD_NAME]
+        if args.shard is not None:
+            # The shard manifests are removed when merged
+            fallback_fpaths.insert(0, manifest_fpath)
+            manifest_fpath = \
+                args.output / get_shard_manifest_name(*args.shard)
+        manifest = BuildManifest(args.output, manifest_fpath,
+                                 assets_dpath=assets_dpath,
+                                 fallback_fpaths=fallback_fpaths)
+    args.manifest = manifest
 
+    # The theme, zip file, and index are created by the merge of shards
     page_theme_fpath = Path('html') / 'theme' / args.theme.name / 'csc.css'
     output_theme_dpath = args.output / page_theme_fpath.parent
-    info(f'Copy theme to {output_theme_dpath}')
-    shutil.copytree(args.theme.dpath, output_theme_dpath)
+    theme_hash = hash_tree(args.theme.dpath)
+    if args.shard is not None:
+        pass
+    elif manifest is None or not output_theme_dpath.is_dir() \
+       or not manifest.is_current('theme', theme_hash):
+        info(f'Copy theme to {output_theme_dpath}')
+        if not args.dry_run:
+            with stage('copy'):
+                replace_tree(args.theme.dpath, output_theme_dpath)
+
+    # Write the zip file while the pdfs are being converted
+    zip_fpath = args.output / 'slides.zip'
+    archive = None
+    if args.with_pdf and not args.dry_run and args.shard is None:
+        archive = SlidesArchive(zip_fpath, args.output / 'pdf')
+
+    def add_to_archive(conversion):
+        if archive is not None and conversion.args.format == 'pdf':
+            with stage('zip'):
+                archive.add(conversion.out_fpath)
+
+    conversions = []
+    try:
+        if assemble:
+            title, html_content = build_content(args.input, page_theme_fpath,
+                                                args, conversions)
+            missing = []
+            if manifest is None:
+                pass
+            elif args.merge_shards is not None:
+                count = args.merge_shards
+                for index in range(1, count + 1):
+                    manifest.merge(
+                        args.output / get_shard_manifest_name(index, count))
+                missing = [c for c in conversions
+                           if not manifest.is_recorded(c.out_fpath)]
+            else:
+                missing = [c for c in conversions if not c.out_fpath.exists()]
+            if missing:
+                raise BuildError(
+                    f'{len(missing)} outputs missing:\n'
+                    + '\n'.join(f'  {c.out_fpath}' for c in missing))
+            for conversion in conversions:
+                add_to_archive(conversion)
+            if manifest is not None:
+                manifest.set_hash('theme', theme_hash)
+        else:
+            with conversion_context(args):
+                title, html_content = build_content(args.input,
+                                                    page_theme_fpath,
+                                                    args, conversions)
+                if args.shard is not None:
+                    conversions = select_shard(conversions, *args.shard)
+                    info(f'Shard {args.shard[0]}/{args.shard[1]}: '
+                         f'{len(conversions)} conversions')
+                try:
+                    run_conversions(conversions, jobs=args.jobs,
+                                    on_done=add_to_archive)
+                finally:
+                    if manifest is not None:
+                        # Keep the record of the completed conversions
+                        manifest.set_hash('theme', theme_hash)
+                        manifest.save(complete=False)
+    except BaseException:
+        # Leave the previous zip file as it was
+        if archive is not None:
+            archive.abort()
+        raise
+
+    if args.shard is not None:
+        # Outputs of other shards are not removed here
+        if manifest is not None:
+            manifest.save()
+        return
+
+    # Remove the outputs of deleted presentations; with --index-only,
+    # the outputs are made and tracked by another build tool
+    stale_fpaths = []
+    if manifest is not None and not args.index_only:
+        stale_fpaths = manifest.stale_fpaths()
+    for fpath in stale_fpaths:
+        info(f'Remove {fpath}')
+        fpath.unlink(missing_ok=True)
+        for dpath in fpath.parents:
+            if dpath == args.output or any(dpath.iterdir()):
+                break
+            dpath.rmdir()
 
-    title, html_content = build_content(args.input, page_theme_fpath, args)
+    if archive is not None:
+        with stage('zip'):
+            if archive.close():
+                info(f'Create {zip_fpath}')
 
     if args.with_pdf:
         pdf_content = re.sub(r'href="html/(.*?).html"',
@@ -654,11 +5096,6 @@ def main_pages(args):
         pdf_content += '</c-card-content>\n'
         pdf_content += '<c-card-content>\n'
 
-        zip_fpath = args.output / 'slides.zip'
-        info(f'Create {zip_fpath}')
-        shutil.make_archive(zip_fpath.with_suffix(''),
-                            'zip',
-                            args.output / 'pdf')
         pdf_content += f'<c-link href="{zip_fpath.name}">Download a zip file containing all slides.</c-link>\n'  # noqa: E501
     else:
         pdf_content = "Not generated."
@@ -669,8 +5106,149 @@ def main_pages(args):
                           args.info_content)
 
     index_fpath = args.output / 'index.html'
-    create_index_page(index_fpath, title,
-                      info_content, html_content, pdf_content)
+    index_hash = hashlib.sha256(
+        repr((VERSION, CHECKSUM, title, info_content, html_content,
+              pdf_content)).encode()).hexdigest()
+    if manifest is None or not index_fpath.exists() \
+       or not manifest.is_current('index', index_hash):
+        info(f'Create {index_fpath}')
+        if not args.dry_run:
+            with stage('index'):
+                staged_fpath = \
+                    index_fpath.with_name(f'.{index_fpath.name}.tmp')
+                create_index_page(staged_fpath, title,
+                                  info_content, html_content, pdf_content)
+                os.replace(staged_fpath, index_fpath)
+    if manifest is not None:
+        manifest.set_hash('index', index_hash)
+        manifest.save()
+        if args.merge_shards is not None:
+            for fpath in args.output.glob(get_shard_manifest_name('*', '*')):
+                fpath.unlink()
+        (args.output / BuildManifest.OLD_NAME).unlink(missing_ok=True)
+
+
+def main_plan(args):
+    edges = get_plan(args)
+    info(f'Planned {len(edges) - 1} conversions')
+    pdf_jobs = dict(args.stage_jobs).get('chromium')
+    writers = [
+        (args.ninja, functools.partial(write_ninja, pdf_jobs=pdf_jobs)),
+        (args.makefile, write_makefile),
+        (args.json, write_plan_json),
+        ]
+    for fpath, write in writers:
+        if fpath is None:
+            continue
+        info(f'Write {fpath}')
+        if not args.dry_run:
+            write(edges, fpath)
+
+
+def main_watch(args):
+    with conversion_context(args):
+        conversions = get_conversions(args)
+        watcher = get_watcher()
+
+        def rebuild(conversions):
+            # Changes made while converting are found by comparing to the
+            # files as they were before
+            before = {c.out_fpath: take_snapshot(dependencies.get(
+                          c.out_fpath, [])) for c in conversions}
+            groups = group_conversions(conversions)
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=args.jobs) as executor:
+                results = list(executor.map(convert_group, groups))
+            for conversion, result in zip(
+                    [c for group in groups for c in group],
+                    [r for group in results for r in group]):
+                key = conversion.out_fpath
+                if isinstance(result, BuildError):
+                    print(f'\nConversion of {conversion.in_fpath} '
+                          f'to {conversion.out_fpath} failed:\n'
+                          f'{inspect.cleandoc(str(result))}\n',
+                          file=sys.stderr, flush=True)
+                    result = externals.get(key)
+                externals[key] = result
+                dependencies[key] = get_dependencies(conversion, result)
+                snapshot = take_snapshot(dependencies[key])
+                snapshot.update((fpath, state) for fpath, state
+                                in before[key].items() if fpath in snapshot)
+                snapshots[key] = snapshot
+                for fpath in dependencies[key]:
+                    watcher.watch(fpath.parent)
+
+        # Keyed by output path
+        externals = {}
+        dependencies = {}
+        snapshots = {}
+        rebuild(conversions)
+
+        server = None
+        if not args.no_serve:
+            out_dpaths = [str(c.out_fpath.parent.absolute())
+                          for c in conversions]
+            serve_dpath = Path(os.path.commonpath(out_dpaths))
+            server = ReloadServer(('localhost', args.port), serve_dpath)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            info(f'Serving {serve_dpath} at '
+                 f'http://localhost:{server.server_port}/')
+            for conversion in conversions:
+                rel_fpath = conversion.out_fpath.absolute() \
+                    .relative_to(serve_dpath)
+                info(f'  http://localhost:{server.server_port}/'
+                     f'{urlquote(str(rel_fpath))}')
+
+        info('Watching for changes (press Ctrl+C to stop)')
+        try:
+            while True:
+                watcher.wait()
+                changed = [c for c in conversions
+                           if take_snapshot(dependencies[c.out_fpath])
+                           != snapshots[c.out_fpath]]
+                if not changed:
+                    continue
+
+                # Coalesce rapid saves by waiting for the files to settle
+                while True:
+                    before = [take_snapshot(dependencies[c.out_fpath])
+                              for c in changed]
+                    time.sleep(args.debounce)
+                    while watcher.wait(0):
+                        pass
+                    after = [take_snapshot(dependencies[c.out_fpath])
+                             for c in changed]
+                    if before == after:
+                        break
+
+                rebuild(changed)
+                if server is not None:
+                    server.reload()
+        except KeyboardInterrupt:
+            info('Stop watching')
+        finally:
+            if server is not None:
+                server.shutdown()
+
+
+def main_serve(args):
+    # Load what the jobs would otherwise load on each run
+    for fpath in args.preload_filters:
+        verbose_info(f'Load filter {fpath}')
+        load_filter(fpath)
+    for module in ['pandocfilters', 'PIL.Image']:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+    log_dpath = args.log_dir or get_default_cache_dpath() / 'logs'
+    server = BuildServer(args.socket.absolute(), max_jobs=args.max_jobs,
+                         log_dpath=log_dpath)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        info('Stopped')
 
 
 def main_install(args):
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# ------------------------------------------------------------------------- #
+# Function: Send a slides or pages command to `slidefactory.py serve`.      #
+#           Only the standard library is imported to keep startup fast.     #
+# Usage: python slidefactory_client.py slides talk.md                       #
+# Help:  python slidefactory_client.py --help                               #
+# ------------------------------------------------------------------------- #
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+from pathlib import Path
+
+
+def get_default_socket_fpath():
+    socket_fpath = os.environ.get('SLIDEFACTORY_SOCKET')
+    if socket_fpath:
+        return Path(socket_fpath)
+    runtime_dpath = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return Path(runtime_dpath) / f'slidefactory-{os.getuid()}.sock'
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a slidefactory command in a running "
+                    "`slidefactory.py serve` process.",
+        )
+    parser.add_argument(
+        '--socket', metavar='PATH', type=Path,
+        default=get_default_socket_fpath(),
+        help='socket of the server (default: %(default)s)')
+    parser.add_argument(
+        '--status', action='store_true',
+        help='show the running and queued jobs')
+    parser.add_argument(
+        'argv', nargs=argparse.REMAINDER,
+        help='slidefactory command and its arguments, '
+             'e.g., slides --format html talk.md')
+    args = parser.parse_args()
+    if not args.status and not args.argv:
+        parser.error('a command is required')
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(args.socket))
+    except OSError as exc:
+        sys.exit(f'error: cannot connect to {args.socket}: {exc.strerror}\n'
+                 f'Start the server with `slidefactory.py serve`.')
+
+    request = dict(status=True) if args.status \
+        else dict(argv=args.argv, cwd=os.getcwd())
+    sock.sendall(json.dumps(request).encode() + b'\n')
+
+    code = 1
+    try:
+        with sock.makefile('r', encoding='utf-8') as f:
+            for line in f:
+                msg = json.loads(line)
+                if args.status:
+                    print(json.dumps(msg, indent=2))
+                    code = 0
+                if 'output' in msg:
+                    sys.stdout.write(msg['output'])
+                    sys.stdout.flush()
+                if msg.get('state') == 'queued':
+                    print(f'Job {msg["job"]} queued '
+                          f'(position {msg["position"]})',
+                          file=sys.stderr, flush=True)
+                if 'exit' in msg:
+                    code = msg['exit']
+    except KeyboardInterrupt:
+        # Closing the connection cancels the job
+        code = 130
+    finally:
+        sock.close()
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
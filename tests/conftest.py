@@ -0,0 +1,89 @@
+import functools
+import os
+import subprocess
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+import benchmark  # noqa: E402
+import slidefactory  # noqa: E402
+
+SLIDEFACTORY = ROOT / 'slidefactory.py'
+
+
+@pytest.fixture
+def sf(monkeypatch):
+    """The slidefactory module with the globals set up by main()"""
+    monkeypatch.setattr(slidefactory, 'info', lambda msg: None,
+                        raising=False)
+    monkeypatch.setattr(slidefactory, 'verbose_info', lambda msg: None,
+                        raising=False)
+    monkeypatch.setattr(slidefactory, 'run',
+                        functools.partial(slidefactory.run_template,
+                                          dry_run=False),
+                        raising=False)
+    monkeypatch.setattr(slidefactory, 'stage',
+                        functools.partial(slidefactory.stage_template,
+                                          profiler=None),
+                        raising=False)
+    return slidefactory
+
+
+@pytest.fixture
+def env(tmp_path):
+    """Environment with the stand-in tools of the benchmarks"""
+    bin_dpath = tmp_path / 'bin'
+    benchmark.create_fake_tools(bin_dpath)
+    env = dict(os.environ)
+    env['PATH'] = f'{bin_dpath}{os.pathsep}{env["PATH"]}'
+    env['XDG_CACHE_HOME'] = str(tmp_path / 'cache')
+    return env
+
+
+@pytest.fixture
+def course(tmp_path):
+    dpath = tmp_path / 'course'
+    dpath.mkdir()
+    benchmark.create_course(dpath, modules=2, decks=3, slides=3, images=1,
+                            math=False, image_size=8)
+    return dpath
+
+
+@pytest.fixture
+def run_sf(env, course):
+    """Run slidefactory in the course directory"""
+    def run_sf(*args, check=True):
+        p = subprocess.run(
+            [sys.executable, str(SLIDEFACTORY), *map(str, args)],
+            cwd=course, env=env, capture_output=True, text=True)
+        if check and p.returncode != 0:
+            raise AssertionError(f'slidefactory {args} failed:\n'
+                                 f'{p.stdout}\n{p.stderr}')
+        return p
+    return run_sf
+
+
+def list_tree(dpath):
+    """Return the files under dpath and their contents"""
+    return {fpath.relative_to(dpath).as_posix(): fpath.read_bytes()
+            for fpath in sorted(dpath.rglob('*')) if fpath.is_file()}
+
+
+def published(dpath):
+    """Return the published files (not the build records) and contents
+
+    The contents of slides.zip are compared instead of its bytes, which
+    depend on the modification times of the files.
+    """
+    files = {name: data for name, data in list_tree(dpath).items()
+             if not Path(name).name.startswith('.')}
+    with zipfile.ZipFile(dpath / 'slides.zip') as zf:
+        files['slides.zip'] = {name: zf.read(name)
+                               for name in sorted(zf.namelist())}
+    return files
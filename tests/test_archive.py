@@ -0,0 +1,94 @@
+import zipfile
+
+import pytest
+
+
+@pytest.fixture
+def root_dpath(tmp_path):
+    dpath = tmp_path / 'site'
+    (dpath / 'html').mkdir(parents=True)
+    (dpath / 'pdf').mkdir()
+    (dpath / 'html' / 'a.html').write_text('<p>a</p>' * 100)
+    (dpath / 'html' / 'b.html').write_text('<p>b</p>' * 100)
+    (dpath / 'pdf' / 'a.pdf').write_bytes(b'%PDF-1.4\n' + bytes(1000))
+    return dpath
+
+
+def build(sf, zip_fpath, root_dpath):
+    archive = sf.SlidesArchive(zip_fpath, root_dpath)
+    return archive.close()
+
+
+def read(zip_fpath):
+    with zipfile.ZipFile(zip_fpath) as zf:
+        assert zf.testzip() is None
+        return {zinfo.filename: (zinfo.comment, zinfo.compress_type,
+                                 zf.read(zinfo))
+                for zinfo in zf.infolist()}
+
+
+def test_create(sf, tmp_path, root_dpath):
+    zip_fpath = tmp_path / 'slides.zip'
+    assert build(sf, zip_fpath, root_dpath)
+    entries = read(zip_fpath)
+    assert sorted(entries) == ['html/a.html', 'html/b.html', 'pdf/a.pdf']
+    assert entries['pdf/a.pdf'][1] == zipfile.ZIP_STORED
+    assert entries['html/a.html'][1] == zipfile.ZIP_DEFLATED
+    assert all(comment == b'' for comment, _, _ in entries.values())
+    assert not list(tmp_path.glob('.slides.zip.tmp*'))
+
+
+def test_unchanged(sf, tmp_path, root_dpath):
+    zip_fpath = tmp_path / 'slides.zip'
+    build(sf, zip_fpath, root_dpath)
+    data = zip_fpath.read_bytes()
+    assert not build(sf, zip_fpath, root_dpath)
+    assert zip_fpath.read_bytes() == data
+
+
+def test_update(sf, tmp_path, root_dpath):
+    zip_fpath = tmp_path / 'slides.zip'
+    build(sf, zip_fpath, root_dpath)
+
+    (root_dpath / 'html' / 'a.html').write_text('<p>changed</p>')
+    (root_dpath / 'html' / 'b.html').unlink()
+    (root_dpath / 'html' / 'c.html').write_text('<p>c</p>')
+    assert build(sf, zip_fpath, root_dpath)
+
+    entries = read(zip_fpath)
+    assert sorted(entries) == ['html/a.html', 'html/c.html', 'pdf/a.pdf']
+    assert entries['html/a.html'][2] == b'<p>changed</p>'
+    assert entries['html/c.html'][2] == b'<p>c</p>'
+
+
+def test_update_same_size(sf, tmp_path, root_dpath):
+    # Changes that keep the size are found by the checksum
+    zip_fpath = tmp_path / 'slides.zip'
+    build(sf, zip_fpath, root_dpath)
+    (root_dpath / 'html' / 'a.html').write_text('<p>A</p>' * 100)
+    assert build(sf, zip_fpath, root_dpath)
+    assert read(zip_fpath)['html/a.html'][2] == b'<p>A</p>' * 100
+
+
+def test_remove_only(sf, tmp_path, root_dpath):
+    zip_fpath = tmp_path / 'slides.zip'
+    build(sf, zip_fpath, root_dpath)
+    (root_dpath / 'pdf' / 'a.pdf').unlink()
+    assert build(sf, zip_fpath, root_dpath)
+    assert sorted(read(zip_fpath)) == ['html/a.html', 'html/b.html']
+    # The space of the removed entry is reclaimed
+    assert zip_fpath.stat().st_size < 1000
+
+
+def test_abort(sf, tmp_path, root_dpath):
+    zip_fpath = tmp_path / 'slides.zip'
+    build(sf, zip_fpath, root_dpath)
+    data = zip_fpath.read_bytes()
+
+    (root_dpath / 'html' / 'a.html').write_text('<p>changed</p>')
+    archive = sf.SlidesArchive(zip_fpath, root_dpath)
+    archive.add(root_dpath / 'html' / 'a.html')
+    assert archive.staged_fpath.exists()
+    archive.abort()
+    assert not archive.staged_fpath.exists()
+    assert zip_fpath.read_bytes() == data
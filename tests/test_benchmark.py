@@ -0,0 +1,38 @@
+import json
+import subprocess
+import sys
+
+import benchmark
+from conftest import ROOT
+
+
+def test_read_profile(tmp_path):
+    events = [
+        dict(name='pandoc', dur=2e6, args=dict(cpu_s=1.5, max_rss_mb=10)),
+        dict(name='pandoc', dur=1e6, args=dict(cpu_s=0.5, max_rss_mb=20)),
+        # Printing with the devtools backend records no resource usage
+        dict(name='chromium', dur=3e6, args=dict(cpu_s=None,
+                                                 max_rss_mb=None)),
+        ]
+    fpath = tmp_path / 'profile.json'
+    fpath.write_text(json.dumps(dict(traceEvents=events)))
+    assert benchmark.read_profile(fpath) == dict(
+        pandoc=dict(count=2, wall=3, cpu=2, max_rss_mb=20),
+        chromium=dict(count=1, wall=3, cpu=None, max_rss_mb=None))
+
+
+def test_benchmark(tmp_path):
+    out_fpath = tmp_path / 'results.json'
+    subprocess.run([sys.executable, str(ROOT / 'benchmarks' / 'benchmark.py'),
+                    '--fake-tools', '--modules', '1', '--decks', '2',
+                    '--slides', '3', '--images', '1', '--image-size', '8',
+                    '--repeat', '1', '--scenarios', 'pages,pages-devtools',
+                    '-o', str(out_fpath)],
+                   check=True, capture_output=True)
+    with open(out_fpath) as f:
+        scenarios = json.load(f)['scenarios']
+    assert set(scenarios) == {'pages', 'pages-devtools'}
+    stages = scenarios['pages-devtools']['stages']
+    assert stages['chromium']['count'] == 2
+    assert stages['chromium']['cpu'] is None
+    assert scenarios['pages']['stages']['chromium']['cpu'] is not None
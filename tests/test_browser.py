@@ -0,0 +1,126 @@
+import concurrent.futures
+import sys
+
+import pytest
+
+SLIDES = '<section>1</section><section>2</section><section>3</section>'
+
+# Stand-ins for a chromium that fails: exits at start, gets killed when
+# asked for something (e.g., by the out-of-memory killer) or hangs
+FAILING_CHROMIUM = {
+    'exits': 'sys.exit(1)',
+    'killed': 'os.read(3, 1)\nos.kill(os.getpid(), signal.SIGKILL)',
+    'hangs': 'time.sleep(30)',
+    }
+
+
+@pytest.fixture
+def pool(sf, env, monkeypatch):
+    monkeypatch.setenv('PATH', env['PATH'])
+    pool = sf.BrowserPool(2, timeout=30)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture
+def url(tmp_path):
+    html_fpath = tmp_path / 'slides.html'
+    html_fpath.write_text(f'<html><body>{SLIDES}</body></html>')
+    return f'{html_fpath.as_uri()}?print-pdf'
+
+
+def failing_chromium(env, tmp_path, monkeypatch, failure):
+    bin_dpath = tmp_path / 'failing-bin'
+    bin_dpath.mkdir()
+    fpath = bin_dpath / 'chromium'
+    fpath.write_text(f'#!{sys.executable}\nimport os, signal, sys, time\n'
+                     f'{FAILING_CHROMIUM[failure]}\n')
+    fpath.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dpath}:{env["PATH"]}')
+
+
+def page_count(sf, fpath):
+    return len(sf.PdfReader(fpath).pages())
+
+
+def test_print_pdf(sf, pool, url, tmp_path):
+    with pool.acquire() as browser:
+        timings = browser.print_pdf(url, tmp_path / 'all.pdf')
+        browser.print_pdf(url, tmp_path / 'some.pdf', page_ranges='2-3')
+    assert 'load' in timings
+    assert page_count(sf, tmp_path / 'all.pdf') == 3
+    assert page_count(sf, tmp_path / 'some.pdf') == 2
+
+
+def test_open_page(sf, pool, url):
+    with pool.acquire() as browser:
+        with browser.open_page(url) as (session_id, _):
+            assert browser.evaluate(sf.PAGE_COUNT_EXPRESSION,
+                                    session_id=session_id) == 3
+
+
+def test_pool_reuses_browsers(sf, pool, url, tmp_path):
+    def print_pdf(i):
+        with pool.acquire() as browser:
+            browser.print_pdf(url, tmp_path / f'{i}.pdf')
+            return browser
+
+    futures = [pool.submit(print_pdf, i) for i in range(6)]
+    browsers = {future.result() for future in futures}
+    # Not more browsers than the size of the pool, each started once
+    assert len(browsers) <= 2
+    assert len(pool.browsers) == len(browsers)
+    for i in range(6):
+        assert page_count(sf, tmp_path / f'{i}.pdf') == 3
+
+
+def test_pool_replaces_dead_browser(sf, pool, url, tmp_path):
+    with pool.acquire() as browser:
+        browser.process.kill()
+        browser.process.wait()
+        with pytest.raises(sf.BuildError):
+            browser.print_pdf(url, tmp_path / 'dead.pdf')
+    with pool.acquire() as other:
+        assert other is not browser
+        other.print_pdf(url, tmp_path / 'slides.pdf')
+    assert page_count(sf, tmp_path / 'slides.pdf') == 3
+
+
+def test_close(sf, pool):
+    with pool.acquire() as browser:
+        pass
+    pool.close()
+    assert browser.process.returncode is not None
+    assert pool.browsers == []
+    with pytest.raises(sf.BuildError, match='chromium is not running'):
+        browser.send('Target.createBrowserContext')
+
+
+@pytest.mark.parametrize('failure, message', [
+    ('exits', 'chromium exited unexpectedly'),
+    ('killed', 'system ran out of memory'),
+    ('hangs', 'timed out waiting for Target.createBrowserContext'),
+    ])
+def test_failing_chromium(sf, env, url, tmp_path, monkeypatch, failure,
+                          message):
+    failing_chromium(env, tmp_path, monkeypatch, failure)
+    pool = sf.BrowserPool(1, timeout=2)
+    try:
+        with pytest.raises(sf.BuildError, match=message):
+            with pool.acquire() as browser:
+                browser.print_pdf(url, tmp_path / 'slides.pdf')
+    finally:
+        pool.close()
+    assert not (tmp_path / 'slides.pdf').exists()
+
+
+def test_concurrent_sends(sf, pool, url):
+    # Responses are matched to their requests over the shared pipe
+    with pool.acquire() as browser:
+        with browser.open_page(url) as (session_id, _):
+            with concurrent.futures.ThreadPoolExecutor(8) as executor:
+                counts = list(executor.map(
+                    lambda _: browser.evaluate(sf.PAGE_COUNT_EXPRESSION,
+                                               session_id=session_id),
+                    range(32)))
+    assert counts == [3] * 32
@@ -0,0 +1,112 @@
+import re
+from urllib.parse import unquote
+
+import pytest
+
+CSS = '''@import "extra.css";
+.title { background: url("img/title.svg"); }
+@font-face { src: url('fonts/sans font.woff2?v=1#x') format("woff2"); }
+.a { background: url(data:image/png;base64,AAAA); }
+.b { background: url(https://example.com/b.png); }
+.c { background: url(img/missing.svg); }
+'''
+
+
+@pytest.fixture
+def root_dpath(tmp_path):
+    """Resources as they are in the installation and the theme"""
+    dpath = tmp_path / 'root'
+    files = {
+        'theme/csc.css': CSS,
+        'theme/extra.css': '.x { background: url(img/title.svg); }\n',
+        'theme/img/title.svg': '<svg/>',
+        'theme/img/unused.svg': '<svg/>',
+        'theme/fonts/sans font.woff2': 'woff2',
+        'mathjax/tex-chtml-full.js': 'mathjax',
+        'mathjax/output/chtml/fonts/woff-v2/MathJax_Main.woff': 'woff',
+        }
+    for name, content in files.items():
+        (dpath / name).parent.mkdir(parents=True, exist_ok=True)
+        (dpath / name).write_text(content)
+    return dpath
+
+
+def write_html(fpath, root_dpath, tmp_path):
+    outside_fpath = tmp_path / 'outside.png'
+    outside_fpath.write_bytes(b'png')
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    fpath.write_text(
+        f'<link rel="stylesheet" href="{(root_dpath / "theme" / "csc.css").as_uri()}">\n'  # noqa: E501
+        f'<script src="file://{root_dpath}/mathjax/tex-chtml-full.js">'
+        f'</script>\n'
+        f'<img src="{outside_fpath.as_uri()}">\n'
+        f'<img src="file://{root_dpath}/theme/img/missing.svg">\n'
+        f'<script src="https://cdn.jsdelivr.net/reveal.js"></script>\n')
+
+
+def links(html_fpath):
+    return re.findall(r'(?:src|href)="([^"]*)"', html_fpath.read_text())
+
+
+def test_bundle(sf, root_dpath, tmp_path):
+    html_fpath = tmp_path / 'out' / 'slides.html'
+    write_html(html_fpath, root_dpath, tmp_path)
+    assets_dpath = tmp_path / 'out' / 'assets'
+    bundler = sf.AssetBundler([root_dpath])
+    bundled = bundler.bundle(html_fpath, assets_dpath)
+
+    css, js, outside, missing, remote = links(html_fpath)
+    # Files outside the roots, missing files, and remote urls are kept
+    assert outside == (tmp_path / 'outside.png').as_uri()
+    assert missing.endswith('/theme/img/missing.svg')
+    assert remote.startswith('https://')
+    assert re.fullmatch(r'assets/[0-9a-f]{32}\.css', css)
+    assert re.fullmatch(r'assets/[0-9a-f]{32}/tex-chtml-full\.js', js)
+
+    # Scripts get the files that they load relative to themselves
+    js_fpath = html_fpath.parent / js
+    assert js_fpath.read_text() == 'mathjax'
+    assert (js_fpath.parent / 'output' / 'chtml' / 'fonts' / 'woff-v2'
+            / 'MathJax_Main.woff').read_text() == 'woff'
+
+    # Urls in stylesheets point to the bundled files
+    content = (html_fpath.parent / css).read_text()
+    imported, title, font = re.findall(r'(?:url\(|@import )["\']?([^"\')]+)',
+                                       content)[:3]
+    assert (assets_dpath / imported).read_text() == \
+        f'.x {{ background: url({title}); }}\n'
+    assert (assets_dpath / title).read_text() == '<svg/>'
+    font_name, suffix = re.fullmatch(r'([^?#]*)(.*)', font).groups()
+    assert suffix == '?v=1#x'
+    assert (assets_dpath / unquote(font_name)).read_text() == 'woff2'
+    for url in ['data:image/png;base64,AAAA', 'https://example.com/b.png',
+                'img/missing.svg']:
+        assert f'url({url})' in content
+
+    # Only the used files are bundled
+    assert sorted(bundled) == sorted(p for p in assets_dpath.rglob('*')
+                                     if p.is_file())
+    assert len(bundled) == 6
+    assert not list(assets_dpath.rglob('.*'))
+
+
+def test_content_addressed(sf, root_dpath, tmp_path):
+    bundler = sf.AssetBundler([root_dpath])
+    assets_dpath = tmp_path / 'out' / 'assets'
+
+    def bundle(name):
+        html_fpath = tmp_path / 'out' / name / 'slides.html'
+        write_html(html_fpath, root_dpath, tmp_path)
+        bundled = bundler.bundle(html_fpath, assets_dpath)
+        return [link.removeprefix('../') for link in links(html_fpath)[:2]], \
+            bundled
+
+    first, bundled = bundle('a')
+    # Bundling again gives the same names
+    assert bundle('b') == (first, bundled)
+
+    # A changed file used by a stylesheet changes the stylesheet's name
+    (root_dpath / 'theme' / 'img' / 'title.svg').write_text('<svg></svg>')
+    changed, _ = bundle('c')
+    assert changed[0] != first[0]
+    assert changed[1] == first[1]
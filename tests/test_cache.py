@@ -0,0 +1,167 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def cache(sf, tmp_path):
+    return sf.BuildCache(tmp_path / 'cache', max_size=1 << 20)
+
+
+@pytest.fixture
+def input_dpath(tmp_path):
+    dpath = tmp_path / 'slides'
+    dpath.mkdir()
+    (dpath / 'slides.md').write_text('# Slides\n\n![](img/a.png)\n')
+    (dpath / 'img').mkdir()
+    (dpath / 'img' / 'a.png').write_bytes(b'png')
+    return dpath
+
+
+def store(cache, key, tmp_path, data=b'<html>'):
+    fpath = tmp_path / 'out.html'
+    fpath.write_bytes(data)
+    cache.store(key, fpath, {'img/a.png'}, tmp_path / 'slides')
+
+
+def test_lookup(cache, input_dpath, tmp_path):
+    assert cache.lookup('ab12', input_dpath) is None
+    store(cache, 'ab12', tmp_path)
+    out_fpath, externals = cache.lookup('ab12', input_dpath)
+    assert out_fpath.read_bytes() == b'<html>'
+    assert externals == {'img/a.png'}
+    assert cache.lookup('ab13', input_dpath) is None
+
+
+def test_lookup_changed_external(cache, input_dpath, tmp_path):
+    store(cache, 'ab12', tmp_path)
+    (input_dpath / 'img' / 'a.png').write_bytes(b'changed')
+    assert cache.lookup('ab12', input_dpath) is None
+    (input_dpath / 'img' / 'a.png').unlink()
+    assert cache.lookup('ab12', input_dpath) is None
+
+
+def test_lookup_corrupt_entry(cache, input_dpath, tmp_path):
+    store(cache, 'ab12', tmp_path)
+    (cache.dpath / 'ab' / 'ab12.json').write_text('{')
+    assert cache.lookup('ab12', input_dpath) is None
+
+
+def test_store_unwritable(sf, input_dpath, tmp_path, monkeypatch):
+    messages = []
+    monkeypatch.setattr(sf, 'info', messages.append)
+    # A file in place of the cache directory
+    (tmp_path / 'cache').write_text('')
+    cache = sf.BuildCache(tmp_path / 'cache', max_size=1 << 20)
+    store(cache, 'ab12', tmp_path)
+    assert cache.lookup('ab12', input_dpath) is None
+    assert len(messages) == 1
+    assert messages[0].startswith('Warning: could not store')
+
+
+def test_evict(sf, input_dpath, tmp_path):
+    cache = sf.BuildCache(tmp_path / 'cache', max_size=1500)
+    store(cache, 'ab12', tmp_path, bytes(1000))
+    # Make the first entry the least recently used
+    os.utime(cache.dpath / 'ab' / 'ab12.json', (0, 0))
+    store(cache, 'cd34', tmp_path, bytes(1000))
+    assert cache.lookup('ab12', input_dpath) is None
+    assert cache.lookup('cd34', input_dpath) is not None
+
+
+@pytest.fixture
+def key_inputs(tmp_path, input_dpath):
+    theme_dpath = tmp_path / 'theme'
+    theme_dpath.mkdir()
+    (theme_dpath / 'theme.css').write_text('body {}')
+    for name in ['defaults.yaml', 'template.html', 'filter.py']:
+        (tmp_path / name).write_text(name)
+    args = SimpleNamespace(format='html', pdf_optimize='auto',
+                           theme=SimpleNamespace(dpath=theme_dpath))
+    html_kwargs = dict(assets_dpath=None, image_optimizer=None,
+                       pandoc_vars={}, pandoc_args=[],
+                       defaults_fpath=tmp_path / 'defaults.yaml',
+                       template_fpath=tmp_path / 'template.html',
+                       filters=[tmp_path / 'filter.py'])
+    return input_dpath / 'slides.md', tmp_path / 'out' / 'slides.html', \
+        args, html_kwargs
+
+
+def test_cache_key(sf, key_inputs, tmp_path):
+    in_fpath, out_fpath, args, html_kwargs = key_inputs
+
+    def key():
+        return sf.get_cache_key(sf.Conversion(in_fpath, out_fpath, args),
+                                html_kwargs)
+
+    keys = [key()]
+    assert key() == keys[-1]
+
+    in_fpath.write_text('# Changed\n')
+    keys.append(key())
+    (args.theme.dpath / 'theme.css').write_text('body { color: red }')
+    keys.append(key())
+    (tmp_path / 'filter.py').write_text('changed')
+    keys.append(key())
+    args.format = 'pdf'
+    keys.append(key())
+    html_kwargs['pandoc_vars'] = dict(lang='fi')
+    keys.append(key())
+    html_kwargs['assets_dpath'] = tmp_path / 'out' / 'assets'
+    keys.append(key())
+    # Assets in another directory relative to the output
+    html_kwargs['assets_dpath'] = tmp_path / 'assets'
+    keys.append(key())
+    assert len(set(keys)) == len(keys)
+
+    # Only the relative assets path matters
+    out_fpath = tmp_path / 'other' / 'out' / 'slides.html'
+    html_kwargs['assets_dpath'] = tmp_path / 'other' / 'out' / 'assets'
+    assert key() == keys[-2]
+
+
+def test_evict_running_size(sf, input_dpath, tmp_path, monkeypatch):
+    cache = sf.BuildCache(tmp_path / 'cache', max_size=2500)
+    scans = []
+    scan = cache._scan
+    monkeypatch.setattr(cache, '_scan', lambda: scans.append(1) or scan())
+    store(cache, 'ab12', tmp_path, bytes(1000))
+    os.utime(cache.dpath / 'ab' / 'ab12.json', (0, 0))
+    # Replacing an entry does not count twice
+    store(cache, 'cd34', tmp_path, bytes(1000))
+    store(cache, 'cd34', tmp_path, bytes(1000))
+    assert len(scans) == 1
+    assert (cache.dpath / 'ab' / 'ab12.json').exists()
+    store(cache, 'ef56', tmp_path, bytes(1000))
+    assert len(scans) == 2
+    assert cache.lookup('ab12', input_dpath) is None
+    assert cache.lookup('cd34', input_dpath) is not None
+
+
+def test_cache_key_moved(sf, key_inputs, tmp_path):
+    in_fpath, out_fpath, args, html_kwargs = key_inputs
+    key = sf.get_cache_key(sf.Conversion(in_fpath, out_fpath, args),
+                           html_kwargs)
+    # The whole checkout moved elsewhere
+    moved_dpath = tmp_path / 'moved'
+    moved_dpath.mkdir()
+    for path in list(tmp_path.iterdir()):
+        if path != moved_dpath:
+            path.rename(moved_dpath / path.name)
+
+    def moved(fpath):
+        return moved_dpath / fpath.relative_to(tmp_path)
+
+    args.theme.dpath = moved(args.theme.dpath)
+    html_kwargs = dict(html_kwargs,
+                       defaults_fpath=moved(html_kwargs['defaults_fpath']),
+                       template_fpath=moved(html_kwargs['template_fpath']),
+                       filters=[moved(p) for p in html_kwargs['filters']])
+    conversion = sf.Conversion(moved(in_fpath), moved(out_fpath), args)
+    assert sf.get_cache_key(conversion, html_kwargs) == key
+
+    # Renaming the input changes the key
+    in_fpath = moved(in_fpath).rename(moved_dpath / 'slides' / 'other.md')
+    conversion = sf.Conversion(in_fpath, moved(out_fpath), args)
+    assert sf.get_cache_key(conversion, html_kwargs) != key
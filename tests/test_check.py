@@ -0,0 +1,109 @@
+import json
+import shutil
+
+import pytest
+
+from conftest import ROOT
+
+SLIDES = '''---
+title: Links
+---
+
+# Images
+
+![An image](img/image-1.png) ![Missing](img/missing.png)
+<img src="img/raw.png" alt="raw html"> ![Remote](https://example.com/a.png)
+
+# Background {data-background-image="img/background.png"}
+
+# Color {data-background-color="#ffffff" data-background="black"}
+
+# Other color {data-background="rgba(0, 0, 0, .5)"}
+
+# Shorthand {data-background="img/shorthand.png"}
+
+`![In code](img/code.png)`
+
+```html
+<img src="img/code.png">
+```
+
+Math with braces: $\\frac{a}{b}$
+'''
+
+
+@pytest.fixture
+def slides_dpath(course):
+    return course / 'module-01' / 'slides'
+
+
+def check(run_sf, tmp_path, *args):
+    p = run_sf('check', '--json', tmp_path / 'problems.json', *args,
+               check=False)
+    with open(tmp_path / 'problems.json') as f:
+        problems = json.load(f)['problems']
+    return p, sorted((problem['kind'], problem['message'])
+                     for problem in problems)
+
+
+def test_no_problems(run_sf, tmp_path):
+    p, problems = check(run_sf, tmp_path, 'about.yml')
+    assert p.returncode == 0
+    assert problems == []
+
+
+def test_links(run_sf, tmp_path, slides_dpath):
+    (slides_dpath / '01-deck.md').write_text(SLIDES)
+    p, problems = check(run_sf, tmp_path, 'about.yml')
+    assert p.returncode != 0
+    assert problems == [
+        ('missing-file', 'linked file missing: img/background.png'),
+        ('missing-file', 'linked file missing: img/missing.png'),
+        ('missing-file', 'linked file missing: img/raw.png'),
+        ('missing-file', 'linked file missing: img/shorthand.png'),
+        ]
+
+
+@pytest.mark.parametrize('front_matter, message', [
+    ('---\nevent: x\n---\n', 'title missing'),
+    ('---\n- a list\n---\n', 'metadata is not a mapping'),
+    ('---\ntitle: [unclosed\n---\n', 'yaml parsing failed'),
+    ('# No front matter\n', 'missing metadata'),
+    ])
+def test_front_matter(run_sf, tmp_path, slides_dpath, front_matter,
+                      message):
+    (slides_dpath / '01-deck.md').write_text(front_matter)
+    _, problems = check(run_sf, tmp_path, 'about.yml')
+    (kind, problem), = problems
+    assert kind == 'front-matter'
+    assert message in problem
+
+
+def test_about(run_sf, tmp_path, course):
+    with open(course / 'about.yml', 'a') as f:
+        f.write('  - module-09\n')
+    shutil.rmtree(course / 'module-02' / 'slides')
+    _, problems = check(run_sf, tmp_path, 'about.yml')
+    assert [kind for kind, _ in problems] == ['module', 'slidesdir']
+
+
+def test_theme(run_sf, tmp_path):
+    theme_dpath = tmp_path / 'theme'
+    shutil.copytree(ROOT / 'theme' / 'csc-plain', theme_dpath)
+    with open(theme_dpath / 'csc.css', 'a') as f:
+        f.write('.x { background: url("missing.png"); }\n')
+    (theme_dpath / 'latin1.css').write_bytes('/* \xe9 */\n'.encode('latin1'))
+    _, problems = check(run_sf, tmp_path, '-t', theme_dpath, 'about.yml')
+    assert [kind for kind, _ in problems] == ['theme'] * 2
+    messages = [message for _, message in problems]
+    assert 'linked file missing: missing.png' in messages
+    assert any(message.startswith('cannot read:') for message in messages)
+
+
+def test_pages_check(run_sf, tmp_path, slides_dpath):
+    (slides_dpath / '01-deck.md').write_text(SLIDES)
+    p = run_sf('pages', '--check', 'about.yml', tmp_path / 'out',
+               check=False)
+    assert p.returncode != 0
+    assert 'nothing converted' in p.stderr
+    assert not (tmp_path / 'out' / 'index.html').exists()
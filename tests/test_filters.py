@@ -0,0 +1,112 @@
+import json
+import sys
+import threading
+
+import pytest
+
+pandocfilters = pytest.importorskip('pandocfilters')
+
+# Filters in the styles used with slidefactory: with the entry points
+# imported from pandocfilters or called on the module, and a filter
+# that does not use pandocfilters
+FILTERS = {
+    'upper.py': '''
+from pandocfilters import toJSONFilter, Str
+
+
+def upper(key, value, format, meta):
+    if key == 'Str':
+        return Str(value.upper())
+
+
+if __name__ == '__main__':
+    toJSONFilter(upper)
+''',
+    'version.py': '''
+import os
+
+import pandocfilters as pf
+
+VERSION = os.environ['PANDOC_VERSION']
+
+
+def version(key, value, format, meta):
+    if key == 'Header':
+        level, attr, inlines = value
+        return pf.Header(level, attr, [pf.Str(f'{inlines[0]["c"]} '
+                                              f'({format} {VERSION})')])
+
+
+pf.toJSONFilters([version])
+''',
+    'options': f'''#!{sys.executable}
+import json, os, sys
+
+doc = json.load(sys.stdin)
+options = json.loads(os.environ['PANDOC_READER_OPTIONS'])
+doc['blocks'].append({{'t': 'Para', 'c': [
+    {{'t': 'Str', 'c': f'standalone={{options["standalone"]}}'}},
+    {{'t': 'Str', 'c': os.environ['PANDOC_VERSION']}}]}})
+json.dump(doc, sys.stdout)
+''',
+    }
+
+
+@pytest.fixture
+def filters(tmp_path):
+    fpaths = []
+    for name, script in FILTERS.items():
+        fpath = tmp_path / 'filters' / name
+        fpath.parent.mkdir(exist_ok=True)
+        fpath.write_text(script)
+        fpath.chmod(0o755)
+        fpaths.append(fpath)
+    return fpaths
+
+
+def test_inprocess_matches_pandoc(run_sf, course, filters, tmp_path):
+    md_fpath = course / 'module-01' / 'slides' / '01-deck.md'
+    outputs = {}
+    for mode in ['pandoc', 'inprocess']:
+        out_dpath = tmp_path / mode
+        run_sf('slides', '--no-cache', '--filter-mode', mode,
+               *[f'--filters={fpath}' for fpath in filters],
+               '-f', 'html', '-o', out_dpath, md_fpath)
+        outputs[mode] = (out_dpath / '01-deck.html').read_text()
+    assert outputs['inprocess'] == outputs['pandoc']
+    assert 'SLIDE 1 (revealjs 3.1.3)' in outputs['pandoc']
+    assert 'standalone=True 3.1.3' in outputs['pandoc']
+
+
+def test_load_filter(sf, filters, env, monkeypatch):
+    monkeypatch.setenv('PATH', env['PATH'])
+    # Set for the filters while loading
+    monkeypatch.delenv('PANDOC_VERSION', raising=False)
+    entry_points = (pandocfilters.toJSONFilter, pandocfilters.toJSONFilters)
+    results = []
+
+    def load(fpath):
+        results.append(sf.load_filter(fpath))
+
+    threads = [threading.Thread(target=load, args=(fpath,))
+               for fpath in filters[:2]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(len(actions) for actions in results) == [1, 1]
+    # The module is left as it is
+    assert (pandocfilters.toJSONFilter,
+            pandocfilters.toJSONFilters) == entry_points
+    assert sf.load_filter(filters[2]) is None
+
+
+def test_filter_env(sf, env, monkeypatch, tmp_path):
+    monkeypatch.setenv('PATH', env['PATH'])
+    defaults_fpath = tmp_path / 'defaults.yaml'
+    defaults_fpath.write_text('standalone: true\ncolumns: 72\n')
+    filter_env = sf.get_filter_env(defaults_fpath)
+    assert filter_env['PANDOC_VERSION'] == '3.1.3'
+    options = json.loads(filter_env['PANDOC_READER_OPTIONS'])
+    assert (options['standalone'], options['columns'], options['tab-stop']) \
+        == (True, 72, 4)
@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+
+
+@pytest.fixture
+def optimizer(sf, tmp_path):
+    return sf.ImageOptimizer(tmp_path / 'cache' / 'images', 320, 180)
+
+
+def write_image(fpath, size, format, **kwargs):
+    # Noise does not compress away, unlike a plain color
+    im = Image.effect_noise(size, 64).convert('RGB')
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    im.save(fpath, format=format, optimize=True, **kwargs)
+    return fpath
+
+
+def test_downscale(optimizer, tmp_path):
+    fpath = write_image(tmp_path / 'img' / 'large.png', (1280, 1280), 'PNG')
+    data = fpath.read_bytes()
+    out_fpath = optimizer(fpath)
+    assert out_fpath.is_relative_to(optimizer.dpath)
+    assert out_fpath.suffix == '.png'
+    with Image.open(out_fpath) as im:
+        assert (im.format, im.size) == ('PNG', (180, 180))
+    assert fpath.read_bytes() == data
+    # Cached by content
+    assert optimizer(fpath) == out_fpath
+    copy_fpath = tmp_path / 'copy.PNG'
+    copy_fpath.write_bytes(data)
+    assert optimizer(copy_fpath) == out_fpath
+
+
+def test_exif_orientation(optimizer, tmp_path):
+    exif = Image.Exif()
+    # Rotated by 90 degrees
+    exif[0x0112] = 6
+    fpath = write_image(tmp_path / 'photo.jpg', (1600, 800), 'JPEG',
+                        exif=exif)
+    with Image.open(optimizer(fpath)) as im:
+        assert (im.format, im.size) == ('JPEG', (90, 180))
+
+
+@pytest.mark.parametrize('name, size, format', [
+    # Not smaller when encoded again
+    ('small.png', (32, 32), 'PNG'),
+    ('animated.gif', (640, 640), 'GIF'),
+    ('corrupt.png', None, None),
+    ('vector.svg', None, None),
+    ])
+def test_used_as_is(optimizer, tmp_path, monkeypatch, name, size, format):
+    fpath = tmp_path / name
+    if format == 'GIF':
+        frames = [Image.effect_noise(size, 64).convert('P')
+                  for _ in range(2)]
+        frames[0].save(fpath, save_all=True, append_images=frames[1:])
+    elif format is not None:
+        write_image(fpath, size, format)
+    else:
+        fpath.write_bytes(b'not an image')
+    assert optimizer(fpath) == fpath
+
+    # Not tried again
+    monkeypatch.setattr(optimizer, 'optimize', None)
+    assert optimizer(fpath) == fpath
+
+
+def test_concurrent(optimizer, tmp_path, monkeypatch):
+    fpath = write_image(tmp_path / 'large.png', (1280, 720), 'PNG')
+    calls = []
+    optimize = optimizer.optimize
+
+    def counting_optimize(*args):
+        calls.append(args)
+        return optimize(*args)
+
+    monkeypatch.setattr(optimizer, 'optimize', counting_optimize)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+                   optimizer(fpath)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(set(results)) == 1
+    assert not list(optimizer.dpath.rglob('.*'))
+
+
+def test_slides(run_sf, course, tmp_path):
+    img_fpath = course / 'module-01' / 'slides' / 'img' / 'image-1.png'
+    write_image(img_fpath, (2560, 1440), 'PNG')
+    run_sf('slides', '--optimize-images', '-f', 'html', '-o',
+           tmp_path / 'out', course / 'module-01' / 'slides' / '01-deck.md')
+    out_fpath = tmp_path / 'out' / 'img' / 'image-1.png'
+    # Fit to the slide size of the theme
+    with Image.open(out_fpath) as im:
+        assert im.size == (1920, 1080)
+    assert out_fpath.stat().st_size < img_fpath.stat().st_size
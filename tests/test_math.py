@@ -0,0 +1,92 @@
+import html
+
+import pytest
+
+HTML = '''<html><head>
+</head><body>
+<span class="math inline">\\(a &lt; b\\)</span>
+<span class="math display">\\[a &lt; b\\]</span>
+<span class="math inline">\\(a &lt; b\\)</span>
+<span class="math inline">\\(x^2\\)</span>
+</body></html>
+'''
+
+
+@pytest.fixture
+def typeset(sf, monkeypatch):
+    """Record the expressions typeset in the browser"""
+    calls = []
+
+    def typeset(self, items):
+        calls.append(items)
+        return [f'<svg>{html.escape(tex)} {display}</svg>'
+                for tex, display in items], f'<style>{self.url}</style>'
+
+    monkeypatch.setattr(sf.MathRenderer, 'typeset', typeset)
+    return calls
+
+
+def renderer(sf, tmp_path, url='file:///mathjax/es5/tex-chtml-full.js'):
+    return sf.MathRenderer(tmp_path / 'cache' / 'math', url,
+                           browser_pool=object())
+
+
+def render(renderer, tmp_path, content=HTML, name='slides.html'):
+    html_fpath = tmp_path / name
+    html_fpath.write_text(content)
+    renderer.render(html_fpath)
+    return html_fpath.read_text()
+
+
+def test_render(sf, typeset, tmp_path):
+    content = render(renderer(sf, tmp_path), tmp_path)
+    # Each unique expression is typeset once, by display mode
+    assert typeset == [[('a < b', False), ('a < b', True), ('x^2', False)]]
+    assert content.count('<span class="math inline"><svg>a &lt; b False'
+                         '</svg></span>') == 2
+    assert '<span class="math display"><svg>a &lt; b True</svg>' in content
+    assert '\\(' not in content and '\\[' not in content
+    # With the stylesheet of the svg output
+    assert '<style>file:///mathjax/es5/tex-svg-full.js</style>\n</head>' \
+        in content
+
+
+def test_cached_across_decks(sf, typeset, tmp_path):
+    first = render(renderer(sf, tmp_path), tmp_path, name='a.html')
+    # Another build typesets only the new expressions
+    second = render(renderer(sf, tmp_path), tmp_path,
+                    HTML.replace('x^2', 'y^2'), name='b.html')
+    assert typeset[1:] == [[('y^2', False)]]
+    assert second == first.replace('x^2', 'y^2')
+    assert not list((tmp_path / 'cache').rglob('.tmp-*'))
+
+    # Typeset again with another MathJax
+    render(renderer(sf, tmp_path, 'file:///mathjax-4/tex-chtml.js'),
+           tmp_path)
+    assert len(typeset[2]) == 3
+
+
+def test_no_math(sf, typeset, tmp_path):
+    content = '<html><head></head><body>$x$</body></html>'
+    assert render(renderer(sf, tmp_path), tmp_path, content) == content
+    assert typeset == []
+
+
+def test_prerender_math(run_sf, tmp_path, course):
+    md_fpaths = sorted((course / 'module-01' / 'slides').glob('*.md'))
+    for i, md_fpath in enumerate(md_fpaths[:2]):
+        md_fpath.write_text(md_fpath.read_text()
+                            + f'\n# Math\n\n$$E = mc^2$$ $$x_{i}$$\n')
+    out_dpath = tmp_path / 'out'
+    outputs = []
+    for md_fpath in md_fpaths[:2]:
+        p = run_sf('slides', '-v', '--no-cache', '--prerender-math',
+                   '-f', 'html', '-o', out_dpath, md_fpath)
+        outputs.append(p.stdout)
+    assert 'Typeset 2 of 2 expressions' in outputs[0]
+    # The shared expression is typeset once
+    assert 'Typeset 1 of 2 expressions' in outputs[1]
+    content = (out_dpath / md_fpaths[1].with_suffix('.html').name) \
+        .read_text()
+    assert '<svg data-tex="E = mc^2" data-display="true"></svg>' in content
+    assert '<svg data-tex="x_1" data-display="true"></svg>' in content
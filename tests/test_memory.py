@@ -0,0 +1,102 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+MB = 1024**2
+
+# A process killed with SIGKILL, e.g., by the out-of-memory killer
+KILLED = ['sh', '-c', 'kill -9 $$']
+
+
+@pytest.fixture(params=['threads', 'pipeline'])
+def scheduler(sf, monkeypatch, request):
+    if request.param == 'pipeline':
+        pipeline = sf.Pipeline(2)
+        monkeypatch.setattr(sf, 'pipeline', pipeline)
+        yield request.param
+        pipeline.close()
+    else:
+        monkeypatch.setattr(sf, 'pipeline', None)
+        yield request.param
+
+
+class JoiningTimer(threading.Timer):
+    """Timer whose thread has ended when cancel returns"""
+
+    def cancel(self):
+        super().cancel()
+        self.join()
+
+
+def test_killed_is_not_timeout(sf, scheduler, monkeypatch):
+    monkeypatch.setattr(threading, 'Timer', JoiningTimer)
+    with pytest.raises(sf.BuildError) as excinfo:
+        sf.run_template(KILLED, dry_run=False, timeout=30)
+    message = str(excinfo.value)
+    assert "'sh' was killed with SIGKILL" in message
+    assert 'timed out' not in message
+
+
+def test_killed_by_oom_killer(sf, scheduler, monkeypatch):
+    counter = itertools.count()
+    monkeypatch.setattr(sf, 'get_oom_kills', lambda: next(counter))
+    with pytest.raises(sf.BuildError, match='by the out-of-memory killer'):
+        sf.run_template(KILLED, dry_run=False, timeout=30)
+
+
+def test_timeout(sf, scheduler):
+    with pytest.raises(sf.BuildError) as excinfo:
+        sf.run_template(['sleep', '10'], dry_run=False, timeout=0.2)
+    assert "'sleep' timed out after 0.2 s" in str(excinfo.value)
+    assert 'killed' not in str(excinfo.value)
+
+
+@pytest.fixture
+def governor(sf, tmp_path, monkeypatch):
+    monkeypatch.setattr(sf, 'get_available_memory', lambda: None)
+    governor = sf.MemoryGovernor(tmp_path / 'memory.json', budget=300 * MB)
+    governor.peaks = dict(chromium=[200 * MB])
+    return governor
+
+
+def test_admit_waits_for_memory(governor):
+    events = []
+
+    def run(i):
+        with governor.admit('chromium'):
+            events.append(('start', i))
+            time.sleep(0.2)
+            events.append(('end', i))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Two processes do not fit in the budget
+    assert [name for name, _ in events] == ['start', 'end', 'start', 'end']
+
+
+def test_admit_learns_peaks(governor, tmp_path, sf):
+    with governor.admit('gs') as usage:
+        usage['max_rss'] = 50 * MB
+    with governor.admit('chromium') as usage:
+        usage['killed'] = True
+    assert governor.estimate('gs') == 50 * MB
+    assert governor.estimate('chromium') == 400 * MB
+
+    governor.save()
+    governor = sf.MemoryGovernor(tmp_path / 'memory.json', budget=0)
+    assert governor.estimate('gs') == 50 * MB
+
+
+def test_save_unwritable(sf, tmp_path):
+    # A file in place of the cache directory
+    (tmp_path / 'cache').write_text('')
+    governor = sf.MemoryGovernor(tmp_path / 'cache' / 'memory.json',
+                                 budget=300 * MB)
+    with governor.admit('gs') as usage:
+        usage['max_rss'] = 50 * MB
+    governor.save()
@@ -0,0 +1,50 @@
+import json
+
+
+def test_index_in_cache(run_sf, tmp_path, course):
+    out_dpath = tmp_path / 'out'
+    run_sf('pages', 'about.yml', out_dpath)
+    run_sf('slides', '-o', tmp_path / 'slides',
+           course / 'module-01' / 'slides' / '01-deck.md')
+    # Nothing but the site is written to the output directories
+    assert not list(out_dpath.glob('.slidefactory-metadata*'))
+    assert not list((tmp_path / 'slides').glob('.*'))
+    index_fpath = tmp_path / 'cache' / 'slidefactory' / 'metadata.json'
+    with open(index_fpath) as f:
+        entries = json.load(f)['entries']
+    assert str(course / 'about.yml') in entries
+    assert str(course / 'module-01' / 'slides' / '01-deck.md') in entries
+
+
+def test_index_no_cache(run_sf, tmp_path):
+    run_sf('pages', '--no-cache', 'about.yml', tmp_path / 'out')
+    assert not (tmp_path / 'cache' / 'slidefactory' / 'metadata.json') \
+        .exists()
+
+
+def test_save_keeps_other_entries(sf, tmp_path):
+    for name in ['a.yml', 'b.yml', 'c.yml']:
+        (tmp_path / name).write_text(f'title: {name}\n')
+    index_fpath = tmp_path / 'cache' / 'metadata.json'
+    for name in ['a.yml', 'b.yml']:
+        index = sf.MetadataIndex(index_fpath)
+        assert index.get(tmp_path / name, sf.parse_about) == \
+            dict(title=name)
+        index.save()
+    (tmp_path / 'a.yml').unlink()
+
+    index = sf.MetadataIndex(index_fpath)
+    index.get(tmp_path / 'c.yml', sf.parse_about)
+    index.save()
+    # Entries of files that no longer exist are dropped
+    assert sorted(sf.MetadataIndex(index_fpath).entries) == \
+        [str(tmp_path / 'b.yml'), str(tmp_path / 'c.yml')]
+
+
+def test_save_unwritable(sf, tmp_path):
+    (tmp_path / 'a.yml').write_text('title: a\n')
+    # A file in place of the cache directory
+    (tmp_path / 'cache').write_text('')
+    index = sf.MetadataIndex(tmp_path / 'cache' / 'metadata.json')
+    index.get(tmp_path / 'a.yml', sf.parse_about)
+    index.save()
@@ -0,0 +1,119 @@
+import zipfile
+
+import pytest
+
+from conftest import list_tree
+
+
+def converted(p):
+    """Return the outputs that were converted by the pages command"""
+    return sorted(line.split(' to ')[1].split('/out/')[1]
+                  for line in p.stdout.splitlines()
+                  if line.startswith('Convert '))
+
+
+def published(dpath):
+    """Return the published files (not the build records) and contents"""
+    return {name: data for name, data in list_tree(dpath).items()
+            if not name.startswith('.')}
+
+
+def mtimes(dpath):
+    return {fpath: fpath.stat().st_mtime_ns for fpath in dpath.rglob('[!.]*')
+            if fpath.is_file()}
+
+
+@pytest.fixture
+def out_dpath(run_sf, tmp_path):
+    dpath = tmp_path / 'out'
+    run_sf('pages', '--with-pdf', 'about.yml', dpath)
+    return dpath
+
+
+def test_update_unchanged(run_sf, out_dpath):
+    before = mtimes(out_dpath)
+    p = run_sf('pages', '--update', '--with-pdf', 'about.yml', out_dpath)
+    assert converted(p) == []
+    assert p.stdout.count('(up to date)') == 12
+    assert 'Remove ' not in p.stdout
+    # index.html and slides.zip are not rewritten either
+    assert mtimes(out_dpath) == before
+
+
+def test_update_modified(run_sf, course, out_dpath):
+    md_fpath = course / 'module-01' / 'slides' / '02-deck.md'
+    md_fpath.write_text(md_fpath.read_text() + '# Added slide\n')
+    p = run_sf('pages', '--update', '--with-pdf', 'about.yml', out_dpath)
+    assert converted(p) == ['html/module-01/02-deck.html',
+                            'pdf/module-01/02-deck.pdf']
+    html = (out_dpath / 'html' / 'module-01' / '02-deck.html').read_text()
+    assert 'Added slide' in html
+    with zipfile.ZipFile(out_dpath / 'slides.zip') as zf:
+        assert zf.read('module-01/02-deck.pdf') == \
+            (out_dpath / 'pdf' / 'module-01' / '02-deck.pdf').read_bytes()
+
+
+def test_update_linked_file(run_sf, course, out_dpath):
+    img_fpath = course / 'module-02' / 'slides' / 'img' / 'image-1.png'
+    img_fpath.write_bytes(img_fpath.read_bytes() + b'\0')
+    p = run_sf('pages', '--update', '--with-pdf', 'about.yml', out_dpath)
+    assert converted(p) == [f'{fmt}/module-02/{d:02d}-deck.{fmt}'
+                            for fmt in ['html', 'pdf'] for d in [1, 2, 3]]
+    assert (out_dpath / 'html' / 'module-02' / 'img' / 'image-1.png') \
+        .read_bytes() == img_fpath.read_bytes()
+
+
+def test_update_deleted(run_sf, course, out_dpath):
+    (course / 'module-01' / 'slides' / '03-deck.md').unlink()
+    p = run_sf('pages', '--update', '--with-pdf', 'about.yml', out_dpath)
+    assert converted(p) == []
+    assert not (out_dpath / 'html' / 'module-01' / '03-deck.html').exists()
+    assert not (out_dpath / 'pdf' / 'module-01' / '03-deck.pdf').exists()
+    assert 'module-01/03-deck' not in (out_dpath / 'index.html').read_text()
+    with zipfile.ZipFile(out_dpath / 'slides.zip') as zf:
+        names = zf.namelist()
+    assert 'module-01/03-deck.pdf' not in names
+    assert 'module-02/03-deck.pdf' in names
+
+
+def test_update_matches_full_build(run_sf, course, out_dpath, tmp_path):
+    md_fpath = course / 'module-02' / 'slides' / '01-deck.md'
+    md_fpath.write_text(md_fpath.read_text() + '# Added slide\n')
+    (course / 'module-01' / 'slides' / '01-deck.md').unlink()
+    run_sf('pages', '--update', '--with-pdf', 'about.yml', out_dpath)
+    run_sf('pages', '--no-cache', '--with-pdf', 'about.yml',
+           tmp_path / 'full')
+
+    updated = published(out_dpath)
+    full = published(tmp_path / 'full')
+    assert updated.keys() == full.keys()
+    for name in full:
+        if name != 'slides.zip':
+            assert updated[name] == full[name], name
+    with zipfile.ZipFile(out_dpath / 'slides.zip') as updated_zf, \
+         zipfile.ZipFile(tmp_path / 'full' / 'slides.zip') as full_zf:
+        assert sorted(updated_zf.namelist()) == sorted(full_zf.namelist())
+        for name in full_zf.namelist():
+            assert updated_zf.read(name) == full_zf.read(name), name
+
+
+def manifest_fpath(tmp_path):
+    fpath, = (tmp_path / 'cache' / 'slidefactory' / 'manifests').iterdir()
+    return fpath
+
+
+def test_update_corrupt_manifest(run_sf, out_dpath, tmp_path):
+    manifest_fpath(tmp_path).write_text('{')
+    p = run_sf('pages', '--update', '--with-pdf', 'about.yml', out_dpath)
+    assert len(converted(p)) == 12
+
+
+def test_manifest_not_published(run_sf, out_dpath, tmp_path):
+    assert not list(out_dpath.rglob('.*'))
+    # The manifest of earlier versions is read and removed from the site
+    fpath = manifest_fpath(tmp_path)
+    fpath.rename(out_dpath / '.slidefactory-manifest.json')
+    p = run_sf('pages', '--update', '--with-pdf', 'about.yml', out_dpath)
+    assert converted(p) == []
+    assert not list(out_dpath.rglob('.*'))
+    assert manifest_fpath(tmp_path) == fpath
@@ -0,0 +1,320 @@
+import re
+import subprocess
+
+import pytest
+
+# Presentation as written by the stand-in pandoc, printed with a page
+# per section by the stand-in chromium
+SLIDES = ''.join(f'<section><h1>Slide {i}</h1></section>\n'
+                 for i in range(1, 8))
+
+
+@pytest.fixture
+def browser_pool(sf, env, monkeypatch):
+    monkeypatch.setenv('PATH', env['PATH'])
+    browser_pool = sf.BrowserPool(3, timeout=30)
+    yield browser_pool
+    browser_pool.close()
+
+
+@pytest.fixture
+def url(tmp_path):
+    html_fpath = tmp_path / 'slides.html'
+    html_fpath.write_text(f'<html><body>\n{SLIDES}</body></html>\n')
+    return f'file://{html_fpath}?print-pdf'
+
+
+def read_pages(sf, fpath):
+    """Return the texts on the pages and the pages that links point to"""
+    reader = sf.PdfReader(fpath)
+    pages = reader.pages()
+    numbers = {ref: i for i, (ref, _) in enumerate(pages, 1)}
+    dests = reader.dests()
+    texts = []
+    links = []
+    for ref, page in pages:
+        _, stream = reader.get(page[b'Contents'])
+        texts.append(re.search(rb'\((.*)\)', stream).group(1).decode())
+        for annot in reader.resolve(page.get(b'Annots', [])):
+            dest = dests.get(('name', reader.resolve(annot)[b'Dest']))
+            links.append(numbers.get(reader.dest_page(dest)))
+    return texts, links
+
+
+@pytest.fixture
+def pdf_fpath(env, tmp_path):
+    """A pdf printed by the stand-in chromium"""
+    html_fpath = tmp_path / 'slides.html'
+    html_fpath.write_text('<section>1</section><section>2</section>')
+    pdf_fpath = tmp_path / 'slides.pdf'
+    subprocess.run(['chromium', '--headless',
+                    f'--print-to-pdf={pdf_fpath}', html_fpath.as_uri()],
+                   env=env, check=True)
+    return pdf_fpath
+
+
+def test_write_pdf_docinfo(sf, pdf_fpath):
+    original = pdf_fpath.read_bytes()
+    assert sf.write_pdf_docinfo(pdf_fpath, dict(Title='Äö slides',
+                                                Author='CSC'))
+
+    data = pdf_fpath.read_bytes()
+    assert data.startswith(original)
+    update = data[len(original):]
+    prev = int(re.search(rb'startxref\s+(\d+)', original).group(1))
+    size = int(re.search(rb'/Size (\d+)', original).group(1))
+    assert re.search(rb'/Size %d .*/Root 1 0 R .*/Info %d 0 R /Prev %d\b'
+                     % (size + 1, size, prev), update)
+
+    # The new cross-reference table points to the info object
+    xref = int(re.search(rb'startxref\n(\d+)\n%%EOF\n$', data).group(1))
+    assert data[xref:].startswith(b'xref\n')
+    offset = int(re.search(rb'%d 1\n(\d{10}) 00000 n' % size,
+                           data[xref:]).group(1))
+    assert data[offset:].startswith(b'%d 0 obj\n' % size)
+    assert sf.pdf_text_string('Äö slides') in data[offset:xref].decode()
+
+
+def test_write_pdf_docinfo_keeps_info(sf, pdf_fpath):
+    sf.write_pdf_docinfo(pdf_fpath, dict(Title='Slides'))
+    sf.write_pdf_docinfo(pdf_fpath, dict(Author='CSC'))
+    reader = sf.PdfReader(pdf_fpath)
+    # The entries written by chromium and earlier updates are kept
+    assert reader.resolve(reader.trailer[b'Info']) == {
+        b'Producer': b'(Skia/PDF)',
+        b'Title': sf.pdf_text_string('Slides').encode(),
+        b'Author': sf.pdf_text_string('CSC').encode()}
+
+
+def test_write_pdf_docinfo_read_back(sf, pdf_fpath):
+    pypdf = pytest.importorskip('pypdf')
+    sf.write_pdf_docinfo(pdf_fpath, dict(Title='Äö slides', Author='CSC'))
+    reader = pypdf.PdfReader(pdf_fpath, strict=True)
+    assert reader.metadata.title == 'Äö slides'
+    assert reader.metadata.author == 'CSC'
+    assert reader.metadata.producer == 'Skia/PDF'
+    assert len(reader.pages) == 2
+
+
+def test_write_pdf_docinfo_unsupported(sf, tmp_path):
+    # Cross-reference streams have no trailer dictionary
+    pdf_fpath = tmp_path / 'slides.pdf'
+    data = (b'%PDF-1.5\n1 0 obj\n<< /Type /XRef /Size 2 >>\nstream\n'
+            b'endstream\nendobj\nstartxref\n9\n%%EOF\n')
+    pdf_fpath.write_bytes(data)
+    assert not sf.write_pdf_docinfo(pdf_fpath, dict(Title='Slides'))
+    assert pdf_fpath.read_bytes() == data
+
+
+def print_parts(browser_pool, url, dpath, ranges):
+    fpaths = []
+    with browser_pool.acquire() as browser:
+        for i, page_ranges in enumerate(ranges):
+            fpaths.append(dpath / f'{i:04d}.pdf')
+            browser.print_pdf(url, fpaths[-1], timeout=30,
+                              page_ranges=page_ranges)
+    return fpaths
+
+
+@pytest.mark.parametrize('n_pages, ranges', [
+    (7, ['1-3', '4-6', '7-7']),
+    (6, ['1-3', '4-6']),
+    (3, ['']),
+    (1, ['']),
+    (0, ['']),
+    ])
+def test_shard_ranges(sf, n_pages, ranges):
+    assert sf.get_shard_ranges(n_pages, 3) == ranges
+
+
+def test_merge_pdfs(sf, browser_pool, url, tmp_path):
+    parts = print_parts(browser_pool, url, tmp_path, ['1-2', '3-5', '6-7'])
+    # The link to the first page is broken in the other parts
+    assert read_pages(sf, parts[1]) == (['Slide 3', 'Slide 4', 'Slide 5'],
+                                        [None] * 3)
+    sf.merge_pdfs(parts, tmp_path / 'merged.pdf')
+    # The links to the first page of the other parts are kept
+    assert read_pages(sf, tmp_path / 'merged.pdf') == (
+        [f'Slide {i}' for i in range(1, 8)], [1] * 7)
+    info = sf.PdfReader(tmp_path / 'merged.pdf').trailer[b'Info']
+    assert sf.PdfReader(tmp_path / 'merged.pdf').resolve(info) == {
+        b'Producer': b'(Skia/PDF)'}
+
+
+def test_merge_pdfs_valid(sf, browser_pool, url, tmp_path):
+    pypdf = pytest.importorskip('pypdf')
+    parts = print_parts(browser_pool, url, tmp_path, ['1-3', '4-7'])
+    sf.merge_pdfs(parts, tmp_path / 'merged.pdf')
+    reader = pypdf.PdfReader(tmp_path / 'merged.pdf', strict=True)
+    assert [page.extract_text() for page in reader.pages] == \
+        [f'Slide {i}' for i in range(1, 8)]
+    assert sorted(reader.named_destinations) == \
+        sorted(f'/slide-{i}' for i in range(1, 8))
+
+
+def test_merge_unsupported(sf, browser_pool, url, tmp_path):
+    fpath, = print_parts(browser_pool, url, tmp_path, [''])
+    # A cross-reference stream in place of the table
+    data = fpath.read_bytes()
+    fpath.write_bytes(re.sub(rb'startxref\n\d+', b'startxref\n9', data))
+    with pytest.raises(sf.PdfError):
+        sf.merge_pdfs([fpath], tmp_path / 'merged.pdf')
+
+
+def test_parse(sf):
+    value, end = sf.pdf_parse(
+        b'<< /A [1 0 R 2.5 (a (nested\\) string)) <4142>] /B /C >> x', 0)
+    assert value == {b'A': [sf.PdfRef(1, 0), b'2.5',
+                            b'(a (nested\\) string))', b'<4142>'],
+                     b'B': b'C'}
+    assert end == 55
+    assert sf.pdf_parse(sf.pdf_serialize(value), 0)[0] == value
+    assert sf.pdf_string_bytes(b'(a\\)\\101)') == b'a)A'
+    assert sf.pdf_string_bytes(b'<4142 4>') == b'AB@'
+
+
+@pytest.mark.parametrize('shard_size', [2, 3, 10])
+def test_print_pdf_shards(sf, browser_pool, url, tmp_path, monkeypatch,
+                          shard_size):
+    printed = []
+    print_page = sf.Browser.print_page
+
+    def record_print_page(self, session_id, fpath, *, page_ranges='',
+                          **kwargs):
+        printed.append(page_ranges)
+        return print_page(self, session_id, fpath, page_ranges=page_ranges,
+                          **kwargs)
+
+    monkeypatch.setattr(sf.Browser, 'print_page', record_print_page)
+    parts, _ = sf.print_pdf_shards(browser_pool, url, tmp_path, timeout=30,
+                                   shard_size=shard_size)
+    # Each part is printed once, in any order, and they are merged in order
+    ranges = sf.get_shard_ranges(7, shard_size)
+    assert sorted(printed) == sorted(ranges)
+    assert parts == [tmp_path / f'{i:04d}.pdf' for i in range(len(ranges))]
+    sf.merge_pdfs(parts, tmp_path / 'merged.pdf')
+    assert read_pages(sf, tmp_path / 'merged.pdf') == (
+        [f'Slide {i}' for i in range(1, 8)], [1] * 7)
+
+
+def test_create_pdf_shards(sf, browser_pool, url, tmp_path):
+    html_fpath = tmp_path / 'slides.html'
+    sf.create_pdf(html_fpath, tmp_path / 'slides.pdf',
+                  meta=dict(title='Slides'), browser_pool=browser_pool,
+                  timeout=30, optimize='metadata', shard_size=3)
+    assert read_pages(sf, tmp_path / 'slides.pdf') == (
+        [f'Slide {i}' for i in range(1, 8)], [1] * 7)
+    reader = sf.PdfReader(tmp_path / 'slides.pdf')
+    assert reader.resolve(reader.trailer[b'Info'])[b'Title'] == \
+        sf.pdf_text_string('Slides').encode()
+
+
+@pytest.mark.parametrize('numbers, ranges', [
+    ([], []),
+    ([3], [[3, 3]]),
+    ([1, 2, 3, 5, 7, 8], [[1, 3], [5, 5], [7, 8]]),
+    ])
+def test_page_ranges(sf, numbers, ranges):
+    assert sf.get_page_ranges(numbers) == ranges
+
+
+def test_split_pdf(sf, browser_pool, url, tmp_path):
+    fpath, = print_parts(browser_pool, url, tmp_path, [''])
+    (tmp_path / 'pages').mkdir()
+    assert sf.split_pdf(fpath, tmp_path / 'pages') == 7
+    # Each page keeps its destination, and the links resolve once merged
+    assert read_pages(sf, tmp_path / 'pages' / '0002.pdf') == (
+        ['Slide 2'], [None])
+    sf.merge_pdfs(sorted((tmp_path / 'pages').iterdir()),
+                  tmp_path / 'merged.pdf')
+    assert read_pages(sf, tmp_path / 'merged.pdf') == (
+        [f'Slide {i}' for i in range(1, 8)], [1] * 7)
+
+
+@pytest.fixture
+def page_cache(sf, tmp_path):
+    (tmp_path / 'img').mkdir()
+    for name in ['a.png', 'b c.png']:
+        (tmp_path / 'img' / name).write_bytes(name.encode())
+    cache = sf.BuildCache(tmp_path / 'cache', 1024**2)
+    return sf.PageCache(cache, 'theme', tmp_path,
+                        ['img/a.png', 'img/b c.png'])
+
+
+def test_page_cache_externals(page_cache, tmp_path):
+    (tmp_path / 'page.pdf').write_bytes(b'page')
+    key = page_cache.get_key('[]', '<section>')
+    # Only the images shown on the page are validated, also if their
+    # names are quoted in the html
+    page_cache.store(key, tmp_path / 'page.pdf',
+                     '<section><img data-src="img/b%20c.png"></section>')
+    (tmp_path / 'img' / 'a.png').write_bytes(b'changed')
+    assert page_cache.lookup(key).read_bytes() == b'page'
+    (tmp_path / 'img' / 'b c.png').write_bytes(b'changed')
+    assert page_cache.lookup(key) is None
+    assert page_cache.get_key('[]', '<section>') == key
+    assert page_cache.get_key('["print-pdf"]', '<section>') != key
+
+
+def print_cached(sf, browser_pool, url, dpath, page_cache, monkeypatch):
+    """Print with the page cache and return the printed page ranges"""
+    printed = []
+    print_page = sf.Browser.print_page
+
+    def record_print_page(self, session_id, fpath, *, page_ranges='',
+                          **kwargs):
+        printed.append(page_ranges)
+        return print_page(self, session_id, fpath, page_ranges=page_ranges,
+                          **kwargs)
+
+    dpath.mkdir()
+    with monkeypatch.context() as m:
+        m.setattr(sf.Browser, 'print_page', record_print_page)
+        parts, _ = sf.print_pdf_pages(browser_pool, url, dpath, timeout=30,
+                                      page_cache=page_cache)
+    sf.merge_pdfs(parts, dpath / 'merged.pdf')
+    assert read_pages(sf, dpath / 'merged.pdf') == (
+        [f'Slide {i}' for i in range(1, 8)], [1] * 7)
+    return printed
+
+
+def test_print_pdf_pages(sf, browser_pool, url, page_cache, tmp_path,
+                         monkeypatch):
+    def print_pages(name):
+        return print_cached(sf, browser_pool, url, tmp_path / name,
+                            page_cache, monkeypatch)
+
+    keys = []
+    get_key = page_cache.get_key
+    monkeypatch.setattr(page_cache, 'get_key', lambda *args: (
+        keys.append(get_key(*args)) or keys[-1]))
+    assert print_pages('first') == ['']
+    assert print_pages('cached') == []
+    html_fpath = tmp_path / 'slides.html'
+    html_fpath.write_text(html_fpath.read_text().replace(
+        '<h1>Slide 4</h1>', '<h1>Slide 4</h1><p>Fixed a typo</p>'))
+    assert print_pages('changed') == ['4-4']
+
+    # Pages whose cache entries go missing before they are copied
+    missing = {keys[i - 1] for i in [2, 3, 6]}
+    lookup = page_cache.lookup
+    monkeypatch.setattr(page_cache, 'lookup', lambda key: (
+        tmp_path / 'evicted.pdf' if key in missing else lookup(key)))
+    assert print_pages('evicted') == ['2-3', '6-6']
+
+
+@pytest.mark.parametrize('html, externals, optimize', [
+    ('<section><p>Text</p></section>', [], 'metadata'),
+    ('<section><img data-src="img/a.svg"></section>', ['img/a.svg'],
+     'metadata'),
+    ('<section><img data-src="img/a.PNG"></section>', ['img/a.PNG'], 'full'),
+    ('<section data-background-image="img/b.jpg"></section>', [], 'full'),
+    # Optimized images are printed from their copies
+    ('<section><img data-src="file:///cache/a.png"></section>', [], 'full'),
+    ('<section data-background-color="#fff"></section>', [], 'metadata'),
+    ])
+def test_pdf_optimize(sf, tmp_path, html, externals, optimize):
+    html_fpath = tmp_path / 'slides.html'
+    html_fpath.write_text(html)
+    assert sf.get_pdf_optimize('auto', html_fpath, externals) == optimize
+    assert sf.get_pdf_optimize('none', html_fpath, externals) == 'none'
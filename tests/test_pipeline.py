@@ -0,0 +1,111 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import pytest
+
+from conftest import published
+
+SLOW_TOOL = f'''#!{sys.executable}
+import sys, time
+with open(sys.argv[1], 'a') as f:
+    f.write(f'start {{time.monotonic()}}\\n')
+time.sleep(0.3)
+with open(sys.argv[1], 'a') as f:
+    f.write(f'end {{time.monotonic()}}\\n')
+'''
+
+
+@pytest.fixture
+def pipeline(sf, monkeypatch):
+    pipeline = sf.Pipeline(2, dict(slowtool=1))
+    monkeypatch.setattr(sf, 'pipeline', pipeline)
+    yield pipeline
+    pipeline.close()
+
+
+@pytest.fixture
+def slow_tool(tmp_path):
+    fpath = tmp_path / 'slowtool'
+    fpath.write_text(SLOW_TOOL)
+    fpath.chmod(0o755)
+    return fpath
+
+
+def run_in_threads(f, n):
+    threads = [threading.Thread(target=f) for _ in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_run(pipeline):
+    record = {}
+    returncode, stdout, stderr = pipeline.run(
+        [sys.executable, '-c',
+         'import sys, time\n'
+         'data = bytearray(64 * 1024**2)\n'
+         'start = time.process_time()\n'
+         'while time.process_time() - start < 0.3: pass\n'
+         'print("out"); print("err", file=sys.stderr); sys.exit(3)'],
+        record=record)
+    assert (returncode, stdout, stderr) == (3, b'out\n', b'err\n')
+    # Resource usage of the child, not of this process
+    assert record['cpu'] >= 0.2
+    assert 64 * 1024**2 <= record['max_rss'] < 1024**3
+
+
+def test_run_timeout(sf, pipeline):
+    start = time.monotonic()
+    with pytest.raises(sf.BuildError, match='timed out after 0.2 s'):
+        pipeline.run(['sleep', '10'], timeout=0.2)
+    assert time.monotonic() - start < 5
+
+
+def test_run_missing_tool(sf, pipeline, tmp_path):
+    with pytest.raises(sf.BuildError, match='failed'):
+        pipeline.run([tmp_path / 'missing'])
+
+
+@pytest.mark.parametrize('limit', [1, 2])
+def test_stage_limit(sf, pipeline, slow_tool, tmp_path, limit):
+    pipeline.limits['slowtool'] = limit
+    log_fpath = tmp_path / 'log'
+    run_in_threads(lambda: sf.run_template([slow_tool, log_fpath],
+                                           dry_run=False), 2)
+    events = sorted(line.split() for line in log_fpath.read_text()
+                    .splitlines())
+    # The second process starts only after the first one has ended
+    starts = sorted(float(t) for name, t in events if name == 'start')
+    ends = sorted(float(t) for name, t in events if name == 'end')
+    assert (starts[1] >= ends[0]) == (limit == 1)
+
+
+def test_slot_before_memory(sf, pipeline, slow_tool, tmp_path, monkeypatch):
+    # Memory is reserved only for processes that have a slot
+    admitted = []
+
+    @contextmanager
+    def admit(name):
+        admitted.append(time.monotonic())
+        yield {}
+
+    monkeypatch.setattr(sf, 'admit', admit)
+    log_fpath = tmp_path / 'log'
+    run_in_threads(lambda: sf.run_template([slow_tool, log_fpath],
+                                           dry_run=False), 2)
+    first_end = min(float(line.split()[1])
+                    for line in log_fpath.read_text().splitlines()
+                    if line.startswith('end'))
+    assert max(admitted) >= first_end
+
+
+def test_pages_pipeline(run_sf, tmp_path):
+    run_sf('pages', '-q', '--with-pdf', 'about.yml', tmp_path / 'threads')
+    run_sf('pages', '-q', '--with-pdf', '--no-cache', '--scheduler',
+           'pipeline', '--stage-jobs', 'chromium=1', '--profile',
+           tmp_path / 'profile.json', 'about.yml', tmp_path / 'pipeline')
+    assert published(tmp_path / 'pipeline') == \
+        published(tmp_path / 'threads')
@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from conftest import published
+
+
+@pytest.fixture
+def plan(run_sf, course):
+    run_sf('plan', '--with-pdf', '--ninja', 'build.ninja',
+           '--makefile', 'Makefile', '--json', 'plan.json',
+           'about.yml', 'build')
+    with open(course / 'plan.json') as f:
+        return json.load(f)
+
+
+def make(env, course, *args):
+    return subprocess.run(['make', *args], cwd=course, env=env,
+                          capture_output=True, text=True)
+
+
+def test_json(plan, course):
+    assert plan['version'] == 1
+    edges = plan['edges']
+    slides = [edge for edge in edges if edge['rule'] == 'slides']
+    index, = [edge for edge in edges if edge['rule'] == 'index']
+    # Html and pdf of each presentation
+    assert len(slides) == 2 * 6
+    assert sorted(Path(edge['outputs'][0]).suffix for edge in slides) == \
+        ['.html'] * 6 + ['.pdf'] * 6
+    assert index['outputs'] == ['build/index.html', 'build/slides.zip']
+    assert sorted(index['inputs']) == \
+        sorted(edge['outputs'][0] for edge in slides)
+    assert 'about.yml' in index['implicit']
+
+    edge, = [edge for edge in slides
+             if edge['outputs'] == ['build/html/module-01/01-deck.html']]
+    assert edge['inputs'] == ['module-01/slides/01-deck.md']
+    # Linked files, theme, and slidefactory itself
+    assert 'module-01/slides/img/image-1.png' in edge['implicit']
+    assert any(fpath.endswith('/csc.css') for fpath in edge['implicit'])
+    assert any(fpath.endswith('/slidefactory.py')
+               for fpath in edge['implicit'])
+    assert edge['command'][-1] == 'module-01/slides/01-deck.md'
+    assert edge['command'][2] == 'slides'
+
+
+def test_ninja(plan, course):
+    content = (course / 'build.ninja').read_text()
+    assert 'rule slides\n  command = $cmd\n' in content
+    assert 'rule index\n' in content
+    for edge in plan['edges']:
+        assert f'build {edge["outputs"][0]}' in content
+    assert content.count('\nbuild ') == len(plan['edges'])
+
+
+@pytest.mark.skipif(shutil.which('make') is None, reason='make not found')
+def test_make(plan, env, run_sf, course, tmp_path):
+    p = make(env, course, '-j', '4')
+    assert p.returncode == 0, p.stderr
+    assert make(env, course, '-q').returncode == 0
+
+    # Only the changed presentation and the index are made again
+    md_fpath = course / 'module-01' / 'slides' / '01-deck.md'
+    os.utime(md_fpath, (md_fpath.stat().st_atime,
+                        md_fpath.stat().st_mtime + 10))
+    p = make(env, course, '-n')
+    lines = [line for line in p.stdout.splitlines()
+             if not line.startswith('echo ')]
+    assert [line.split()[-1] for line in lines] == \
+        ['module-01/slides/01-deck.md'] * 2 + ['build']
+
+    # The same site as made by pages
+    run_sf('pages', '--with-pdf', 'about.yml', tmp_path / 'pages')
+    assert published(course / 'build') == published(tmp_path / 'pages')
+
+
+@pytest.mark.parametrize('path, ninja, make', [
+    ('a b/c:d.md', 'a$ b/c$:d.md', 'a\\ b/c\\:d.md'),
+    ('$x#1.md', '$$x#1.md', '$$x\\#1.md'),
+    ])
+def test_escape(sf, path, ninja, make):
+    assert sf.ninja_escape(Path(path)) == ninja
+    assert sf.make_escape(Path(path)) == make
+
+
+def test_write_escaped(sf, tmp_path):
+    edge = sf.PlanEdge('slides', [Path('out/a b.html')], [Path('a b.md')],
+                       [Path('img/$1.png')], ['echo', '$HOME', 'a b'],
+                       'HTML out/a b.html')
+    sf.write_ninja([edge], tmp_path / 'build.ninja', pdf_jobs=2)
+    content = (tmp_path / 'build.ninja').read_text()
+    assert 'build out/a$ b.html: slides a$ b.md | img/$$1.png\n' in content
+    assert "  cmd = echo '$$HOME' 'a b'\n" in content
+    assert 'pool pdf\n  depth = 2\n' in content
+    assert '  pool = pdf' not in content
@@ -0,0 +1,105 @@
+import functools
+import json
+import threading
+import time
+
+
+def test_stages(sf, tmp_path):
+    profiler = sf.Profiler()
+    stage = functools.partial(sf.stage_template, profiler=profiler)
+    # Both threads are running at once, so they are told apart
+    barrier = threading.Barrier(2)
+
+    def convert(deck):
+        with stage('convert', deck=deck):
+            with stage('pandoc') as record:
+                time.sleep(0.01)
+            # Usage of a subprocess recorded by the stage
+            record.update(cpu=None, max_rss=None)
+            with stage('chromium'):
+                pass
+        barrier.wait()
+
+    threads = [threading.Thread(target=convert, args=(f'{i}.md',))
+               for i in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with stage('index'):
+        pass
+    assert sf.current_deck.get() is None
+
+    fpath = tmp_path / 'profile.json'
+    profiler.write(fpath)
+    with open(fpath) as f:
+        trace = json.load(f)
+    events = trace['traceEvents']
+    assert sorted((e['name'], e['args']['deck']) for e in events) == [
+        ('chromium', '0.md'), ('chromium', '1.md'),
+        ('convert', '0.md'), ('convert', '1.md'),
+        ('index', None),
+        ('pandoc', '0.md'), ('pandoc', '1.md'),
+        ]
+    for e in events:
+        assert e['ph'] == 'X'
+        assert e['ts'] >= 0
+        if e['name'] == 'pandoc':
+            assert e['dur'] >= 1e4
+    # Stages of a deck are nested in its conversion on the same thread
+    by_deck = {}
+    for e in events:
+        by_deck.setdefault(e['args']['deck'], []).append(e)
+    for deck in ['0.md', '1.md']:
+        convert, = [e for e in by_deck[deck] if e['name'] == 'convert']
+        for e in by_deck[deck]:
+            assert e['tid'] == convert['tid']
+            assert convert['ts'] <= e['ts']
+            assert e['ts'] + e['dur'] <= convert['ts'] + convert['dur'] + 1
+    assert len({e['tid'] for e in events}) == 3
+
+    pandoc = [e['args'] for e in events if e['name'] == 'pandoc']
+    assert all(args['cpu_s'] is None and args['max_rss_mb'] is None
+               for args in pandoc)
+    chromium = [e['args'] for e in events if e['name'] == 'chromium']
+    assert all(args['cpu_s'] >= 0 and args['max_rss_mb'] > 0
+               for args in chromium)
+
+
+def test_summary(sf):
+    profiler = sf.Profiler()
+    for deck, wall in [('fast.md', 1), ('slow.md', 3)]:
+        with profiler.stage('convert', deck) as record:
+            pass
+        record.update(wall=wall, cpu=None, max_rss=2 * 1024**2)
+    lines = profiler.summary().splitlines()
+    assert lines[0].split()[0] == 'Stage'
+    assert lines[1].split() == ['convert', '2', '4.00', '-', '2.0']
+    assert lines[-2:] == ['      3.00 s  slow.md', '      1.00 s  fast.md']
+
+
+def test_no_profiler(sf):
+    with sf.stage_template('convert', profiler=None, deck='a.md') as record:
+        assert record == {}
+        assert sf.current_deck.get() == 'a.md'
+    assert sf.current_deck.get() is None
+
+
+def test_profile(run_sf, course, tmp_path):
+    md_fpath = course / 'module-01' / 'slides' / '01-deck.md'
+    fpath = tmp_path / 'profile.json'
+    p = run_sf('slides', '--no-cache', '--profile', fpath, '-f', 'html,pdf',
+               '-o', tmp_path / 'out', md_fpath)
+    assert f'Wrote profile to {fpath}' in p.stdout
+    assert 'Slowest conversions:' in p.stdout
+    with open(fpath) as f:
+        events = json.load(f)['traceEvents']
+    stages = {e['name']: e for e in events}
+    assert {'convert', 'pandoc', 'chromium'} <= set(stages)
+    # Stages are recorded by output
+    assert {e['args']['deck'] for e in events} == \
+        {str(tmp_path / 'out' / f'01-deck.{suffix}')
+         for suffix in ['html', 'pdf']}
+    # Resource usage of the pandoc process
+    assert stages['pandoc']['args']['cpu_s'] > 0
+    assert stages['pandoc']['args']['max_rss_mb'] > 0
@@ -0,0 +1,121 @@
+import errno
+import os
+import re
+import shutil
+
+import pytest
+
+
+@pytest.fixture
+def src_fpath(tmp_path):
+    fpath = tmp_path / 'src' / 'image.png'
+    fpath.parent.mkdir()
+    fpath.write_bytes(b'png')
+    return fpath
+
+
+def unsupported(*args):
+    raise OSError(errno.EOPNOTSUPP, 'not supported')
+
+
+def tmp_files(dpath):
+    return [p.name for p in dpath.iterdir() if p.name.startswith('.')]
+
+
+@pytest.mark.parametrize('link_mode', ['auto', 'copy', 'reflink'])
+def test_copy(sf, src_fpath, tmp_path, link_mode):
+    tgt_fpath = tmp_path / 'out' / 'img' / 'image.png'
+    sf.publish_file(src_fpath, tgt_fpath, link_mode=link_mode)
+    assert tgt_fpath.read_bytes() == b'png'
+    assert not os.path.samefile(src_fpath, tgt_fpath)
+    assert tgt_fpath.stat().st_mtime_ns == src_fpath.stat().st_mtime_ns
+    assert tmp_files(tgt_fpath.parent) == []
+
+
+def test_hardlink(sf, src_fpath, tmp_path):
+    tgt_fpath = tmp_path / 'out' / 'image.png'
+    sf.publish_file(src_fpath, tgt_fpath, link_mode='hardlink')
+    assert os.path.samefile(src_fpath, tgt_fpath)
+
+
+def test_hardlink_fallback(sf, src_fpath, tmp_path, monkeypatch):
+    # E.g., the output is on another filesystem
+    monkeypatch.setattr(sf.os, 'link', unsupported)
+    tgt_fpath = tmp_path / 'out' / 'image.png'
+    sf.publish_file(src_fpath, tgt_fpath, link_mode='hardlink')
+    assert tgt_fpath.read_bytes() == b'png'
+    assert not os.path.samefile(src_fpath, tgt_fpath)
+    assert tmp_files(tgt_fpath.parent) == []
+
+
+def test_reflink_fallback(sf, src_fpath, tmp_path, monkeypatch):
+    ioctls = []
+
+    def ioctl(*args):
+        ioctls.append(args[1])
+        unsupported()
+
+    monkeypatch.setattr(sf.fcntl, 'ioctl', ioctl)
+    tgt_fpath = tmp_path / 'out' / 'image.png'
+    sf.publish_file(src_fpath, tgt_fpath)
+    assert ioctls == [sf.FICLONE]
+    assert tgt_fpath.read_bytes() == b'png'
+    assert tmp_files(tgt_fpath.parent) == []
+
+
+def test_up_to_date(sf, src_fpath, tmp_path, monkeypatch):
+    tgt_fpath = tmp_path / 'out' / 'image.png'
+    sf.publish_file(src_fpath, tgt_fpath, link_mode='copy')
+    inode = tgt_fpath.stat().st_ino
+
+    # Unchanged, or only touched, files are not copied again
+    os.utime(src_fpath)
+    sf.publish_file(src_fpath, tgt_fpath, link_mode='copy')
+    assert tgt_fpath.stat().st_ino == inode
+
+    # Changed files of the same size are
+    src_fpath.write_bytes(b'gif')
+    sf.publish_file(src_fpath, tgt_fpath, link_mode='copy')
+    assert tgt_fpath.read_bytes() == b'gif'
+
+    # Hard links are up to date without comparing the contents
+    link_fpath = tmp_path / 'out' / 'link.png'
+    sf.publish_file(src_fpath, link_fpath, link_mode='hardlink')
+    monkeypatch.setattr(sf, 'hash_file', unsupported)
+    src_fpath.write_bytes(b'jpg')
+    sf.publish_file(src_fpath, link_fpath, link_mode='hardlink')
+    assert link_fpath.read_bytes() == b'jpg'
+
+
+def test_missing_source(sf, tmp_path):
+    tgt_fpath = tmp_path / 'out' / 'image.png'
+    with pytest.raises(FileNotFoundError):
+        sf.publish_file(tmp_path / 'missing.png', tgt_fpath,
+                        link_mode='copy')
+    assert list(tgt_fpath.parent.iterdir()) == []
+
+
+def test_shared_assets(run_sf, course, tmp_path):
+    # The same image in two presentations
+    slides_dpath = course / 'module-01' / 'slides'
+    shutil.copy(slides_dpath / 'img' / 'image-1.png',
+                slides_dpath / 'img' / 'copy.png')
+    md_fpath = slides_dpath / '02-deck.md'
+    md_fpath.write_text(md_fpath.read_text() + '\n![](img/copy.png)\n')
+
+    out_dpath = tmp_path / 'out'
+    run_sf('pages', '--shared-assets', '--link-mode', 'hardlink',
+           'about.yml', out_dpath)
+    html_dpath = out_dpath / 'html' / 'module-01'
+    urls = {}
+    for name in ['01-deck.html', '02-deck.html']:
+        urls[name] = re.findall(r'data-src="([^"]*)"',
+                                (html_dpath / name).read_text())
+    assert urls['02-deck.html'][-1] == urls['01-deck.html'][0]
+
+    asset_fpath = html_dpath / urls['01-deck.html'][0]
+    assert asset_fpath.resolve().parent == out_dpath / 'html' / 'assets'
+    # Linked to whichever presentation published it first
+    assert any(os.path.samefile(asset_fpath, slides_dpath / 'img' / name)
+               for name in ['image-1.png', 'copy.png'])
+    assert not (html_dpath / 'img').exists()
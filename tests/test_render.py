@@ -0,0 +1,107 @@
+import json
+
+import pytest
+
+URLS = {
+    'html': {'theme-url': 'https://cdn/csc.css', 'mathjaxurl': 'https://mj'},
+    'pdf': {'theme-url': 'file:///theme/csc.css', 'mathjaxurl': 'file:///mj'},
+    }
+
+
+@pytest.fixture
+def renders(sf, monkeypatch):
+    """Record the pandoc renders, written as the variables and a link"""
+    renders = []
+
+    def create_html(input_fpath, html_fpath, *, pandoc_vars, dry_run=False,
+                    **kwargs):
+        renders.append(pandoc_vars)
+        if input_fpath.read_text() == 'fail':
+            raise sf.BuildError('error: pandoc failed')
+        html_fpath.write_text(f'{json.dumps(pandoc_vars)}\n'
+                              f'<img data-src="img/a.png">')
+        return ['img/a.png']
+
+    monkeypatch.setattr(sf, 'create_html', create_html)
+    return renders
+
+
+@pytest.fixture
+def input_fpath(tmp_path):
+    fpath = tmp_path / 'slides' / 'slides.md'
+    (fpath.parent / 'img').mkdir(parents=True)
+    (fpath.parent / 'img' / 'a.png').write_bytes(b'png')
+    fpath.write_text('# Slides')
+    return fpath
+
+
+def render(shared, input_fpath, out_dpath, suffix, **pandoc_vars):
+    html_fpath = out_dpath / f'slides.{suffix}.html'
+    html_fpath.parent.mkdir(exist_ok=True)
+    externals = shared.create_html(input_fpath, html_fpath,
+                                   pandoc_vars=pandoc_vars,
+                                   defaults_fpath='defaults.yaml')
+    return json.loads(html_fpath.read_text().splitlines()[0]), externals
+
+
+def test_shared(sf, renders, input_fpath, tmp_path):
+    shared = sf.SharedRender()
+    outputs = {suffix: render(shared, input_fpath, tmp_path / 'out', suffix,
+                              title='Slides', **URLS[suffix])
+               for suffix in ['html', 'pdf']}
+    # Rendered once with placeholders filled in for each format
+    assert len(renders) == 1
+    assert renders[0]['title'] == 'Slides'
+    assert all(shared.token in renders[0][key] for key in URLS['html'])
+    for suffix, (pandoc_vars, externals) in outputs.items():
+        assert pandoc_vars == dict(title='Slides', **URLS[suffix])
+        assert externals == ['img/a.png']
+    assert (tmp_path / 'out' / 'img' / 'a.png').read_bytes() == b'png'
+
+
+@pytest.mark.parametrize('pandoc_vars', [
+    dict(title='Other', **URLS['pdf']),
+    dict(title='Slides', **{'theme-url': 'file:///theme/csc.css'}),
+    ])
+def test_not_shared(sf, renders, input_fpath, tmp_path, pandoc_vars):
+    shared = sf.SharedRender()
+    render(shared, input_fpath, tmp_path, 'html', title='Slides',
+           **URLS['html'])
+    assert render(shared, input_fpath, tmp_path, 'pdf',
+                  **pandoc_vars)[0] == pandoc_vars
+    assert len(renders) == 2
+    # The variables are passed to pandoc as they are
+    assert renders[1] == pandoc_vars
+
+
+def test_dry_run(sf, renders, input_fpath, tmp_path):
+    shared = sf.SharedRender()
+    shared.create_html(input_fpath, tmp_path / 'slides.html',
+                       pandoc_vars=URLS['html'], dry_run=True)
+    assert renders == [URLS['html']]
+    assert shared.html is None
+
+
+def test_failure(sf, renders, input_fpath, tmp_path):
+    input_fpath.write_text('fail')
+    shared = sf.SharedRender()
+    for suffix in ['html', 'pdf']:
+        with pytest.raises(sf.BuildError, match='pandoc failed'):
+            render(shared, input_fpath, tmp_path, suffix, **URLS[suffix])
+    # Not rendered again for the other format
+    assert len(renders) == 1
+    # Temporary files are removed
+    assert sorted(p.name for p in input_fpath.parent.iterdir()) == \
+        ['img', 'slides.md']
+
+
+def test_formats(run_sf, course, tmp_path):
+    md_fpath = course / 'module-01' / 'slides' / '01-deck.md'
+    profile_fpath = tmp_path / 'profile.json'
+    run_sf('slides', '--no-cache', '--profile', profile_fpath,
+           '-f', 'html,html-local,pdf', '-o', tmp_path / 'out', md_fpath)
+    with open(profile_fpath) as f:
+        events = json.load(f)['traceEvents']
+    assert [e['name'] for e in events].count('pandoc') == 1
+    for name in ['01-deck.html', '01-deck.local.html', '01-deck.pdf']:
+        assert (tmp_path / 'out' / name).is_file()
@@ -0,0 +1,127 @@
+import json
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import ROOT, SLIDEFACTORY
+
+SLOW_FILTER = f'''#!{sys.executable}
+import sys, time
+time.sleep(1)
+sys.stdout.write(sys.stdin.read())
+'''
+
+
+@pytest.fixture
+def server(env, course, tmp_path):
+    socket_fpath = tmp_path / 'server.sock'
+    p = subprocess.Popen([sys.executable, str(SLIDEFACTORY), 'serve',
+                          '--socket', str(socket_fpath), '--max-jobs', '1',
+                          '--log-dir', str(tmp_path / 'logs')],
+                         cwd=course, env=env, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + 30
+    while not socket_fpath.exists():
+        assert p.poll() is None, p.stderr.read().decode()
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    yield socket_fpath
+    p.terminate()
+    p.wait()
+
+
+def connect(socket_fpath, request):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(str(socket_fpath))
+    data = request if isinstance(request, bytes) \
+        else json.dumps(request).encode() + b'\n'
+    sock.sendall(data)
+    return sock
+
+
+def receive(sock, *, until=None):
+    """Return the messages up to the one with key until (or the end)"""
+    messages = []
+    f = sock.makefile('r', encoding='utf-8')
+    for line in f:
+        messages.append(json.loads(line))
+        if until is not None and until in messages[-1]:
+            break
+    return messages
+
+
+def slides_request(course, *args):
+    md_fpath = course / 'module-01' / 'slides' / '01-deck.md'
+    return dict(argv=['slides', '--no-cache', '-f', 'html', *map(str, args),
+                      str(md_fpath)],
+                cwd=str(course))
+
+
+@pytest.mark.parametrize('request_data, error', [
+    (b'not json\n', 'invalid request'),
+    (dict(argv=['install', 'dir'], cwd='/'), 'runs only slides and pages'),
+    ])
+def test_rejected(server, request_data, error):
+    messages = receive(connect(server, request_data))
+    assert messages[-1]['exit'] == 2
+    assert error in messages[0]['output']
+
+
+def test_job(server, course, tmp_path):
+    out_dpath = tmp_path / 'out'
+    messages = receive(connect(server, slides_request(course, '-o',
+                                                      out_dpath)))
+    assert messages[0]['state'] == 'running'
+    assert messages[-1] == dict(exit=0)
+    output = ''.join(msg.get('output', '') for msg in messages)
+    assert 'Convert' in output
+    assert (out_dpath / '01-deck.html').exists()
+    with open(messages[0]['log']) as f:
+        assert f.read() == output
+
+
+def test_failing_job(server, course):
+    messages = receive(connect(server, dict(argv=['slides', 'missing.md'],
+                                            cwd=str(course))))
+    assert messages[-1]['exit'] != 0
+
+
+def test_queue_and_cancel(server, course, tmp_path):
+    filter_fpath = tmp_path / 'slow-filter'
+    filter_fpath.write_text(SLOW_FILTER)
+    filter_fpath.chmod(0o755)
+    first = connect(server, slides_request(
+        course, f'--filters={filter_fpath}', '-o', tmp_path / 'first'))
+    assert receive(first, until='state')[-1]['state'] == 'running'
+    second = connect(server, slides_request(course, '-o',
+                                            tmp_path / 'second'))
+    assert receive(second, until='state')[-1] == dict(
+        job=2, state='queued', position=1)
+
+    status, = receive(connect(server, dict(status=True)))
+    assert [job['job'] for job in status['running']] == [1]
+    assert [job['job'] for job in status['queued']] == [2]
+
+    # Closing the connection cancels the queued job
+    second.close()
+    assert receive(first)[-1] == dict(exit=0)
+    status, = receive(connect(server, dict(status=True)))
+    assert status == dict(running=[], queued=[])
+    assert not (tmp_path / 'second').exists()
+
+
+def test_client(server, course, env, tmp_path):
+    md_fpath = course / 'module-01' / 'slides' / '01-deck.md'
+    p = subprocess.run([sys.executable, str(ROOT / 'slidefactory_client.py'),
+                        '--socket', str(server), 'slides', '--no-cache',
+                        '-f', 'html', '-o', str(tmp_path / 'out'),
+                        str(md_fpath)],
+                       cwd=course, env=env, capture_output=True, text=True)
+    assert p.returncode == 0, p.stderr
+    assert 'Convert' in p.stdout
+    p = subprocess.run([sys.executable, str(ROOT / 'slidefactory_client.py'),
+                        '--socket', str(server), 'slides', 'missing.md'],
+                       cwd=course, env=env, capture_output=True, text=True)
+    assert p.returncode != 0
@@ -0,0 +1,55 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from conftest import SLIDEFACTORY, published
+
+
+def test_select_shard(sf):
+    conversions = [sf.Conversion(Path(f'mod{m}/slides/{d:02d}.md'), None,
+                                 None)
+                   for m in range(3) for d in range(20)]
+    shards = [sf.select_shard(conversions, i, 4) for i in range(1, 5)]
+    assert sorted(c for shard in shards for c in shard) == sorted(conversions)
+    assert all(shards)
+
+    # Adding presentations does not move the others
+    more = conversions + [sf.Conversion(Path(f'mod9/slides/{d:02d}.md'),
+                                        None, None) for d in range(5)]
+    for i, shard in enumerate(shards, 1):
+        assert set(shard) <= set(sf.select_shard(more, i, 4))
+
+
+def test_sharded_pages_match_unsharded(run_sf, env, course, tmp_path):
+    run_sf('pages', '-q', '--with-pdf', 'about.yml', tmp_path / 'full')
+
+    # Shards run at the same time into the same directory
+    out_dpath = tmp_path / 'sharded'
+    processes = [
+        subprocess.Popen([sys.executable, str(SLIDEFACTORY), 'pages', '-q',
+                          '--with-pdf', '--shard', f'{i}/3', 'about.yml',
+                          str(out_dpath)],
+                         cwd=course, env=env, stderr=subprocess.PIPE)
+        for i in range(1, 4)]
+    for p in processes:
+        _, stderr = p.communicate()
+        assert p.returncode == 0, stderr.decode()
+    assert not (out_dpath / 'index.html').exists()
+    assert len(list(out_dpath.glob('.slidefactory-manifest.shard-*'))) == 3
+
+    run_sf('pages', '-q', '--with-pdf', '--merge-shards', '3', 'about.yml',
+           out_dpath)
+    assert published(out_dpath) == published(tmp_path / 'full')
+    assert not list(out_dpath.glob('.*'))
+    assert len(list((tmp_path / 'cache' / 'slidefactory' / 'manifests')
+                    .iterdir())) == 2
+
+
+def test_merge_fails_on_missing_shard(run_sf, tmp_path):
+    out_dpath = tmp_path / 'sharded'
+    run_sf('pages', '-q', '--shard', '1/2', 'about.yml', out_dpath)
+    p = run_sf('pages', '-q', '--merge-shards', '2', 'about.yml', out_dpath,
+               check=False)
+    assert p.returncode != 0
+    assert 'shard-2-of-2' in p.stderr
+    assert not (out_dpath / 'index.html').exists()
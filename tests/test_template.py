@@ -0,0 +1,81 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+
+from conftest import ROOT
+
+# Stand-ins for the browser, reveal.js, and the MathJax versions; the
+# times are in milliseconds since the start of the script
+HARNESS = '''
+const window = globalThis;
+window.location = { search: '?print-pdf' };
+const document = { fonts: { ready: Promise.resolve() } };
+const events = [];
+const log = (name) => events.push([name, Math.round(performance.now())]);
+const after = (ms, f) => setTimeout(f, ms);
+const options = %(options)s;
+
+const listeners = {};
+const Reveal = {
+  on: (name, f) => { listeners[name] = f; },
+  hasPlugin: (id) => id === 'math' && options.math !== 'none',
+};
+const revealInitialized = new Promise((resolve) => after(100, () => {
+  log('reveal ready');
+  resolve();
+  after(10, () => listeners['pdf-ready']());
+  // The math plugin loads MathJax when reveal.js is ready
+  if (options.math === 'mathjax2') {
+    after(200, () => {
+      const queue = [];
+      const run = () => after(300, () => queue.length && queue.shift()());
+      window.MathJax = { Hub: { Queue: (f) => { queue.push(f); run(); } } };
+      MathJax.Hub.Queue(() => log('typeset'));
+    });
+  } else if (options.math === 'mathjax3') {
+    after(200, () => {
+      window.MathJax = { startup: { promise: new Promise(
+        (resolve) => after(300, () => { log('typeset'); resolve(); })) } };
+    });
+  }
+}));
+
+%(script)s
+
+window.slidefactory.ready.then(() => {
+  log('ready');
+  console.log(JSON.stringify(events));
+});
+'''
+
+
+def readiness_script():
+    """Return the script of the template that signals readiness"""
+    text = (ROOT / 'theme' / 'csc-plain' / 'template.html').read_text()
+    start = text.index('window.slidefactory = ')
+    return text[start:text.index('})();', start) + len('})();')]
+
+
+def run_template(**options):
+    if shutil.which('node') is None:
+        pytest.skip('node is not available')
+    script = HARNESS % dict(options=json.dumps(options),
+                            script=readiness_script())
+    p = subprocess.run(['node', '-e', script], capture_output=True,
+                       text=True, timeout=30, check=True)
+    return dict(json.loads(p.stdout))
+
+
+@pytest.mark.parametrize('math', ['mathjax2', 'mathjax3'])
+def test_ready_waits_for_math(math):
+    events = run_template(math=math)
+    assert events['typeset'] >= 600
+    assert events['ready'] >= events['typeset']
+
+
+def test_ready_without_math():
+    events = run_template(math='none')
+    assert 'typeset' not in events
+    assert events['ready'] < 300
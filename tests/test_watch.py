@@ -0,0 +1,139 @@
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from conftest import SLIDEFACTORY
+
+
+def wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def inotify(sf):
+    try:
+        return sf.Inotify()
+    except (OSError, AttributeError, TypeError):
+        pytest.skip('inotify not available')
+
+
+def test_inotify(inotify, tmp_path):
+    watched_dpath = tmp_path / 'watched'
+    watched_dpath.mkdir()
+    (tmp_path / 'other').mkdir()
+    inotify.watch(watched_dpath)
+    # Watching again or watching a file is a no-op
+    inotify.watch(watched_dpath)
+    inotify.watch(tmp_path / 'missing')
+    assert inotify.dpaths == {watched_dpath.resolve()}
+    assert not inotify.wait(0)
+
+    (tmp_path / 'other' / 'a.md').write_text('a')
+    assert not inotify.wait(0.1)
+    (watched_dpath / 'a.md').write_text('a')
+    assert inotify.wait(5)
+    # The pending events were consumed
+    assert not inotify.wait(0)
+    (watched_dpath / 'a.md').rename(watched_dpath / 'b.md')
+    assert inotify.wait(5)
+    (watched_dpath / 'b.md').unlink()
+    assert inotify.wait(5)
+
+
+def test_snapshot(sf, tmp_path):
+    fpath = tmp_path / 'a.md'
+    fpath.write_text('a')
+    snapshot = sf.take_snapshot([fpath, tmp_path / 'missing.md'])
+    assert snapshot[tmp_path / 'missing.md'] is None
+    assert sf.take_snapshot([fpath, tmp_path / 'missing.md']) == snapshot
+    fpath.write_text('changed')
+    assert sf.take_snapshot([fpath, tmp_path / 'missing.md']) != snapshot
+
+
+@pytest.fixture
+def watch(env, course, tmp_path):
+    """Start watching and return a function for waiting for its output"""
+    processes = []
+
+    def watch(*args):
+        p = subprocess.Popen(
+            [sys.executable, str(SLIDEFACTORY), 'watch', '--debounce', '0.1',
+             '-o', str(tmp_path / 'out'), *map(str, args),
+             str(course / 'module-01' / 'slides' / '01-deck.md')],
+            cwd=course, env=dict(env, PYTHONUNBUFFERED='1'),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        processes.append(p)
+        lines = []
+        threading.Thread(target=lambda: lines.extend(p.stdout),
+                         daemon=True).start()
+
+        def read_until(text):
+            wait_for(lambda: any(text in line for line in lines))
+            return ''.join(lines)
+        return p, read_until
+
+    yield watch
+    for p in processes:
+        p.kill()
+        p.wait()
+
+
+def rebuilt(out_fpath, text):
+    return out_fpath.is_file() and text in out_fpath.read_text()
+
+
+def test_rebuild(watch, course, tmp_path):
+    md_fpath = course / 'module-01' / 'slides' / '01-deck.md'
+    out_fpath = tmp_path / 'out' / '01-deck.html'
+    p, read_until = watch('--no-serve')
+    read_until('Watching for changes')
+    assert rebuilt(out_fpath, 'Slide 1')
+
+    md_fpath.write_text(md_fpath.read_text() + '\n# Added slide\n')
+    wait_for(lambda: rebuilt(out_fpath, 'Added slide'))
+
+    # Linked files are watched as well
+    image_fpath = course / 'module-01' / 'slides' / 'img' / 'image-1.png'
+    image_fpath.write_bytes(b'changed')
+    wait_for(lambda: (tmp_path / 'out' / 'img' / 'image-1.png')
+             .read_bytes() == b'changed')
+
+    # A failing conversion is reported and watching continues
+    image_fpath.unlink()
+    read_until('failed')
+    assert p.poll() is None
+    image_fpath.write_bytes(b'back')
+    md_fpath.write_text(md_fpath.read_text() + '\n# Fixed\n')
+    wait_for(lambda: rebuilt(out_fpath, 'Fixed'))
+
+    p.send_signal(signal.SIGINT)
+    assert p.wait(30) == 0
+    read_until('Stop watching')
+
+
+def test_serve_and_reload(watch, course):
+    md_fpath = course / 'module-01' / 'slides' / '01-deck.md'
+    _, read_until = watch('--port', '0')
+    output = read_until('Watching for changes')
+    url, = re.findall(r'http://localhost:\d+/01-deck\.html', output)
+    with urllib.request.urlopen(url, timeout=30) as response:
+        assert response.headers['Cache-Control'] == 'no-store'
+        content = response.read().decode()
+    assert 'Slide 1' in content
+    assert content.index('EventSource') < content.index('</body>')
+
+    events_url = url.rsplit('/', 1)[0] + '/__slidefactory_reload'
+    with urllib.request.urlopen(events_url, timeout=30) as events:
+        md_fpath.write_text(md_fpath.read_text() + '\n# Added slide\n')
+        assert events.readline() == b'data: reload\n'
+    with urllib.request.urlopen(url, timeout=30) as response:
+        assert 'Added slide' in response.read().decode()